@@ -9,12 +9,23 @@ requirements: git+https://github.com/openai/swarm.git
 """
 
 import os
+import re
+import threading
+import time
+import urllib.parse
 
-from typing import List, Union, Generator, Iterator
+from typing import Dict, List, Optional, Tuple, Union, Generator, Iterator
 from swarm import Swarm
 from pydantic import BaseModel, Field
 
-from pipelines.lilbro_utils import primary_agent, init_plex_client
+from pipelines.lilbro_utils import primary_agent, PlexClient, ToolCache
+
+# Function calls, hand-offs and the timing footer shown by SHOW_STEPS.
+STEP_MARKERS_RE = re.compile(
+    r"\n\n_Calling `[^`\n]*`\.\.\._\n\n"
+    r"|\n\n_[^\n]* handed off to [^\n]*\._\n\n"
+    r"|\n\n---\n_Steps: [^\n]*\._$"
+)
 
 
 class Pipeline:
@@ -35,6 +46,18 @@ class Pipeline:
             default="",
             description="Required API key to retrieve the model list.",
         )
+        TOOL_CACHE_TTL_SECONDS: int = Field(
+            default=300,
+            description="How long results of agent functions are reused within a conversation.",
+        )
+        SHOW_STEPS: bool = Field(
+            default=False,
+            description="Show function calls, hand-offs and the timing of each step in responses.",
+        )
+        USER_PLEX_HOSTS: str = Field(
+            default="",
+            description="Comma-separated hosts (e.g. 'plex.example.com' or '192.168.1.2:32400') that users may set as their own PLEX_BASE_URL; empty to only allow the default server.",
+        )
         pass
 
     class UserValves(BaseModel):
@@ -44,11 +67,11 @@ class Pipeline:
         )
         PLEX_BASE_URL: str = Field(
             default="",
-            description="The base URL for Plex API endpoints.",
+            description="The base URL of your Plex server, if not the default one; must be on a host allowed by the administrator.",
         )
         PLEX_TOKEN: str = Field(
             default="",
-            description="Required API key to retrieve the model list.",
+            description="Your token for the Plex server; required if PLEX_BASE_URL is set.",
         )
         pass
 
@@ -65,7 +88,8 @@ class Pipeline:
             }
         )
         self.client = Swarm()
-        init_plex_client(self.valves.PLEX_BASE_URL, self.valves.PLEX_TOKEN)
+        self.tool_caches: Dict[Tuple[str, str], ToolCache] = {}
+        self.tool_caches_lock = threading.Lock()
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
@@ -75,17 +99,175 @@ class Pipeline:
         print(f"on_shutdown:{__name__}")
         pass
 
+    def _tool_cache(self, body: dict) -> Optional[ToolCache]:
+        """
+        Return the tool cache of the user's conversation, dropping those of
+        expired conversations. Without a chat id, results are not reused, as
+        the conversation cannot be told apart from others.
+        """
+        chat_id = body.get("chat_id") or (body.get("metadata") or {}).get("chat_id")
+        if not chat_id:
+            return None
+        key = (str((body.get("user") or {}).get("id") or ""), str(chat_id))
+        with self.tool_caches_lock:
+            for expired_key, cache in list(self.tool_caches.items()):
+                if cache.is_expired():
+                    del self.tool_caches[expired_key]
+            if key not in self.tool_caches:
+                self.tool_caches[key] = ToolCache(self.valves.TOOL_CACHE_TTL_SECONDS)
+            return self.tool_caches[key]
+
+    @staticmethod
+    def _strip_steps(messages: List[dict]) -> List[dict]:
+        """Remove the step markers shown in earlier responses from the history given to the agents."""
+        stripped = []
+        for message in messages:
+            if message.get("role") == "assistant" and isinstance(
+                message.get("content"), str
+            ):
+                message = {
+                    **message,
+                    "content": STEP_MARKERS_RE.sub("", message["content"]),
+                }
+            stripped.append(message)
+        return stripped
+
+    def _plex_client(self, body: dict) -> PlexClient:
+        """
+        Return the client for the user's Plex server, falling back to the
+        default one. The default token is only ever sent to the default
+        server, so users with their own server must set their own token.
+        """
+        user_valves = (body.get("user") or {}).get("valves") or {}
+
+        def user_valve(name: str) -> str:
+            if isinstance(user_valves, dict):
+                return user_valves.get(name) or ""
+            return getattr(user_valves, name, "") or ""
+
+        base_url = user_valve("PLEX_BASE_URL")
+        token = user_valve("PLEX_TOKEN")
+        if not base_url:
+            return PlexClient.for_server(
+                self.valves.PLEX_BASE_URL, token or self.valves.PLEX_TOKEN
+            )
+        self._check_user_base_url(base_url)
+        if not token:
+            raise ValueError(
+                "The PLEX_TOKEN user valve must be set along with the PLEX_BASE_URL user valve"
+            )
+        return PlexClient.for_server(base_url, token)
+
+    def _check_user_base_url(self, base_url: str) -> None:
+        """
+        Make sure a user-provided server URL is on a host allowed by the
+        USER_PLEX_HOSTS valve, so that users cannot make the server send
+        requests to arbitrary hosts.
+        """
+        allowed_hosts = {
+            host.strip().lower()
+            for host in self.valves.USER_PLEX_HOSTS.split(",")
+            if host.strip()
+        }
+        parsed = urllib.parse.urlsplit(base_url)
+        try:
+            port = parsed.port
+        except ValueError:
+            port = None
+        host = (parsed.hostname or "").lower()
+        if parsed.scheme not in ("http", "https") or not host:
+            raise ValueError(f"Invalid PLEX_BASE_URL user valve: {base_url}")
+        if host not in allowed_hosts and f"{host}:{port}" not in allowed_hosts:
+            raise ValueError(
+                f"The PLEX_BASE_URL user valve must be on a host allowed by the administrator, not {parsed.netloc}"
+            )
+
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
-        response = self.client.run(
-            agent=primary_agent, messages=messages, stream=body.get("stream", False)
+        try:
+            plex_client = self._plex_client(body)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return "An error occurred: " + str(e)
+        output = self._run(
+            self._strip_steps(messages),
+            {
+                "plex_client": plex_client,
+                "tool_cache": self._tool_cache(body),
+            },
         )
+        if body.get("stream", False):
+            return output
+        return "".join(output)
 
-        try:
-            print(f"response: {response}")
+    def _run(self, messages: List[dict], context_variables: dict) -> Iterator[str]:
+        """
+        Run the agents, streaming their tokens, a line for each function call
+        and hand-off, and finally the time taken by each step: generating
+        (LLM), running functions (tool), or transferring to another agent
+        (hand-off), which Swarm does between an agent's completions.
+        """
+        tool_cache: Optional[ToolCache] = context_variables.get("tool_cache")
+        steps: List[Tuple[str, float]] = []
+        started_at = step_started_at = time.perf_counter()
+        sender = None
+        function_names: List[str] = []
 
-            return response.messages[-1]["content"]
+        def cache_hits() -> int:
+            return tool_cache.hits if tool_cache is not None else 0
+
+        hits_before = cache_hits()
+
+        def end_functions_step(now: float) -> None:
+            # Swarm runs the functions called by a completion before the next one.
+            if function_names:
+                if all(name.startswith("transfer_to_") for name in function_names):
+                    name = "hand-off"
+                else:
+                    name = f"tool {', '.join(function_names)}"
+                    if cache_hits() > hits_before:
+                        name += " (cached)"
+                steps.append((name, now - step_started_at))
+
+        try:
+            for chunk in self.client.run(
+                agent=primary_agent,
+                messages=messages,
+                context_variables=context_variables,
+                stream=True,
+            ):
+                now = time.perf_counter()
+                if chunk.get("delim") == "start":
+                    end_functions_step(now)
+                    step_started_at, function_names = now, []
+                    hits_before = cache_hits()
+                elif chunk.get("delim") == "end":
+                    steps.append((f"LLM ({sender})", now - step_started_at))
+                    step_started_at = now
+                    if self.valves.SHOW_STEPS:
+                        for name in function_names:
+                            if not name.startswith("transfer_to_"):
+                                yield f"\n\n_Calling `{name}`..._\n\n"
+                elif "response" in chunk:
+                    end_functions_step(now)
+                else:
+                    if chunk.get("sender") and chunk["sender"] != sender:
+                        if sender is not None and self.valves.SHOW_STEPS:
+                            yield f"\n\n_{sender} handed off to {chunk['sender']}._\n\n"
+                        sender = chunk["sender"]
+                    for tool_call in chunk.get("tool_calls") or ():
+                        name = (tool_call.get("function") or {}).get("name")
+                        if name:
+                            function_names.append(name)
+                    if chunk.get("content"):
+                        yield chunk["content"]
         except Exception as e:
             print(f"Error: {e}")
-            return "An error occurred: " + str(e)
+            yield "An error occurred: " + str(e)
+
+        timing = ", ".join(f"{name} {seconds:.1f} s" for name, seconds in steps)
+        timing += f"; total {time.perf_counter() - started_at:.1f} s"
+        print(f"Agent steps: {timing}")
+        if self.valves.SHOW_STEPS:
+            yield f"\n\n---\n_Steps: {timing}._"
@@ -1,2 +1,3 @@
+from .cache import *
 from .main import *
 from .plex import *
@@ -0,0 +1,68 @@
+import functools
+import inspect
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class ToolCache:
+    """
+    Results of agent functions within one conversation, reused for
+    `ttl_seconds` so that agents calling the same function again (e.g. after a
+    hand-off, or on the next turn) do not fetch the same data again.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.used_at = time.monotonic()
+        self._results: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def is_expired(self) -> bool:
+        """Whether the cache was not used within its TTL, so that all its results expired."""
+        return time.monotonic() - self.used_at >= self.ttl_seconds
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return whether an unexpired result is cached for `key`, and the result."""
+        self.used_at = time.monotonic()
+        cached = self._results.get(key)
+        if cached is None or self.used_at - cached[0] >= self.ttl_seconds:
+            return False, None
+        self.hits += 1
+        return True, cached[1]
+
+    def set(self, key: Hashable, result: Any) -> None:
+        self.used_at = time.monotonic()
+        self._results[key] = (self.used_at, result)
+
+
+def memoize(func: Callable) -> Callable:
+    """
+    Memoize an agent function in the `ToolCache` given as the run's
+    `tool_cache` context variable, by the function and its arguments.
+    Without a `tool_cache`, the function is just called. Exceptions are not cached.
+
+    The wrapper takes `context_variables`, so that Swarm passes them to it,
+    and passes them on if `func` takes them too.
+    """
+    takes_context = "context_variables" in inspect.signature(func).parameters
+
+    @functools.wraps(func)
+    def wrapper(context_variables: Optional[dict] = None, **kwargs):
+        context_variables = context_variables or {}
+        key = (
+            func.__module__,
+            func.__qualname__,
+            tuple(sorted((name, repr(value)) for name, value in kwargs.items())),
+        )
+        if takes_context:
+            kwargs["context_variables"] = context_variables
+        cache: Optional[ToolCache] = context_variables.get("tool_cache")
+        if cache is None:
+            return func(**kwargs)
+        found, result = cache.get(key)
+        if not found:
+            result = func(**kwargs)
+            cache.set(key, result)
+        return result
+
+    return wrapper
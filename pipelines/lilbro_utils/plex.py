@@ -1,44 +1,13 @@
 import requests
 import json
-from typing import List, Dict, Any, Optional
+import os
+import urllib.parse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass, field
 
-
-BASE_URL = ""
-TOKEN = ""
-
-
-def init_plex_client(base_url: str, token: str) -> None:
-    global BASE_URL, TOKEN
-    BASE_URL = base_url
-    TOKEN = token
-
-
-def fetcher(url: str, opts: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    headers = {"Accept": "application/json"}
-    if opts and "headers" in opts:
-        headers.update(opts["headers"])
-
-    response = requests.get(f"{BASE_URL}{url}/?X-Plex-Token={TOKEN}", headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} {response.text}")
-    return response.json()
-
-
-def get_libraries() -> Dict[str, Any]:
-    return fetcher("/library/sections")
-
-
-def get_library_items(section_id: str, tag: str = "all") -> Dict[str, Any]:
-    return fetcher(f"/library/sections/{section_id}/{tag}")
-
-
-def get_library_item_metadata(rating_key: str) -> Dict[str, Any]:
-    return fetcher(f"/library/metadata/{rating_key}")
-
-
-def get_library_item_children_metadata(rating_key: str) -> Dict[str, Any]:
-    return fetcher(f"/library/metadata/{rating_key}/children")
+from .cache import memoize
 
 
 @dataclass
@@ -137,9 +106,76 @@ class CompiledData:
 class PlexClient:
     """Plex Client to interact with Audiobook Library"""
 
-    @staticmethod
-    def get_audiobook_library_metadata() -> Dict[str, Any]:
-        libraries = get_libraries()
+    # Per-request timeout, and how many times to retry requests that failed
+    # with a connection error, a timeout or a transient server error.
+    TIMEOUT_SECONDS = 30
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_SECONDS = 0.5
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    _clients: Dict[Tuple[str, str], "PlexClient"] = {}
+
+    def __init__(self, base_url: str, token: str) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self._session = requests.Session()
+        self._session.headers.update(
+            {"Accept": "application/json", "X-Plex-Token": token}
+        )
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=self.MAX_RETRIES,
+                backoff_factor=self.RETRY_BACKOFF_SECONDS,
+                status_forcelist=self.RETRY_STATUSES,
+                allowed_methods=frozenset(("GET",)),
+                raise_on_status=False,
+            )
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    @classmethod
+    def for_server(cls, base_url: str, token: str) -> "PlexClient":
+        """
+        Return the process-wide client for a server and token, so that its
+        connections are reused across agent runs.
+        """
+        key = (base_url.rstrip("/"), token)
+        if key not in cls._clients:
+            cls._clients[key] = cls(*key)
+        return cls._clients[key]
+
+    def close(self) -> None:
+        self._session.close()
+
+    def fetch(
+        self, path: str, params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """GET a Plex API path (e.g. `/library/sections`) as JSON, retrying transient failures."""
+        response = self._session.get(
+            f"{self.base_url}{path}", params=params, timeout=self.TIMEOUT_SECONDS
+        )
+        if response.status_code != 200:
+            raise Exception(f"Error: {response.status_code} {response.text}")
+        return response.json()
+
+    def get_libraries(self) -> Dict[str, Any]:
+        return self.fetch("/library/sections")
+
+    def get_library_items(self, section_id: str, tag: str = "all") -> Dict[str, Any]:
+        section_id = urllib.parse.quote(str(section_id), safe="")
+        return self.fetch(f"/library/sections/{section_id}/{tag}")
+
+    def get_library_item_metadata(self, rating_key: str) -> Dict[str, Any]:
+        rating_key = urllib.parse.quote(str(rating_key), safe="")
+        return self.fetch(f"/library/metadata/{rating_key}")
+
+    def get_library_item_children_metadata(self, rating_key: str) -> Dict[str, Any]:
+        rating_key = urllib.parse.quote(str(rating_key), safe="")
+        return self.fetch(f"/library/metadata/{rating_key}/children")
+
+    def get_audiobook_library_metadata(self) -> Dict[str, Any]:
+        libraries = self.get_libraries()
         lib = next(
             (
                 d
@@ -152,62 +188,76 @@ class PlexClient:
             raise Exception("No audiobook library found")
         return lib
 
-    @staticmethod
-    def get_all_author_metadata() -> List[AuthorMetadata]:
-        library = PlexClient.get_audiobook_library_metadata()
-        metadata = get_library_items(library["key"])["MediaContainer"].get(
+    def get_all_author_metadata(self) -> List[AuthorMetadata]:
+        library = self.get_audiobook_library_metadata()
+        metadata = self.get_library_items(library["key"])["MediaContainer"].get(
             "Metadata", []
         )
         if not metadata:
             raise Exception("No metadata found")
         return [AuthorMetadata(**item) for item in metadata]
 
-    @staticmethod
-    def get_all_books_metadata() -> List[AudiobookMetadata]:
-        library = PlexClient.get_audiobook_library_metadata()
-        metadata = get_library_items(library["key"], "albums")["MediaContainer"].get(
-            "Metadata", []
-        )
+    def get_all_books_metadata(self) -> List[AudiobookMetadata]:
+        library = self.get_audiobook_library_metadata()
+        metadata = self.get_library_items(library["key"], "albums")[
+            "MediaContainer"
+        ].get("Metadata", [])
         if not metadata:
             raise Exception("No metadata found for books")
         return [AudiobookMetadata(**item) for item in metadata]
 
 
 def main():
+    client = PlexClient(
+        os.getenv("PLEX_BASE_URL", "http://host.docker.internal:32400"),
+        os.getenv("PLEX_TOKEN", ""),
+    )
     try:
         # Fetch all authors metadata
-        authors = PlexClient.get_all_author_metadata()
+        authors = client.get_all_author_metadata()
         print(json.dumps([author.__dict__ for author in authors], indent=2))
 
         # Fetch all books metadata
-        books = PlexClient.get_all_books_metadata()
+        books = client.get_all_books_metadata()
         print(json.dumps([book.__dict__ for book in books], indent=2))
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
     main()
 
 
-def fetch_audiobook_and_author_data() -> str:
+@memoize
+def fetch_library_json(context_variables: dict) -> str:
+    """Fetch metadata for all authors and audiobooks as compact JSON, reusing it within a conversation."""
+    client = context_variables["plex_client"]
+
+    # Fetch all authors metadata
+    authors = client.get_all_author_metadata()
+    authors_data = [author.__dict__ for author in authors]
+
+    # Fetch all books metadata
+    books = client.get_all_books_metadata()
+    books_data = [book.__dict__ for book in books]
+
+    # Combine data
+    combined_data = {"authors": authors_data, "books": books_data}
+
+    return json.dumps(combined_data, separators=(",", ":"))
+
+
+def fetch_audiobook_and_author_data(context_variables: dict) -> str:
     """Fetches metadata for all authors and audiobooks from the Plex server.
 
     Returns:
         str: JSON string with combined metadata or an error message.
     """
+    # Swarm passes the run's context variables, which hold the `PlexClient`
+    # and `ToolCache` to use, without exposing them to the model.
     try:
-        # Fetch all authors metadata
-        authors = PlexClient.get_all_author_metadata()
-        authors_data = [author.__dict__ for author in authors]
-
-        # Fetch all books metadata
-        books = PlexClient.get_all_books_metadata()
-        books_data = [book.__dict__ for book in books]
-
-        # Combine data
-        combined_data = {"authors": authors_data, "books": books_data}
-
-        return json.dumps(combined_data, indent=2)
+        return fetch_library_json(context_variables=context_variables)
     except Exception as e:
         return f"An error occurred: {e}"
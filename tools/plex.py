@@ -7,68 +7,77 @@ description: These tools can call the Plex API to query the Plex server for meta
 version: 0.2.0
 """
 
+import aiohttp
+from aiohttp import web
 import asyncio
+import collections
+import dataclasses
+import gc
+import heapq
+import hmac
 import inspect
+import itertools
 import os
+import random
+import re
+import sqlite3
 import sys
+import time
+import tracemalloc
 import typing
-import requests
 import urllib.parse
 from datetime import datetime
 
 from pydantic import BaseModel, Field
 from typing import Callable, Awaitable
-import requests
 import json
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass, field
 
 
-BASE_URL = ""
-TOKEN = ""
-
-
-def init_plex_client(base_url: str, token: str) -> None:
-    global BASE_URL, TOKEN
-    BASE_URL = base_url
-    TOKEN = token
-
-
-def fetcher(url: str, opts: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    headers = {"Accept": "application/json"}
-    if opts and "headers" in opts:
-        headers.update(opts["headers"])
-
-    response = requests.get(f"{BASE_URL}{url}/?X-Plex-Token={TOKEN}", headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} {response.text}")
-    return response.json()
-
-
-def get_libraries() -> Dict[str, Any]:
-    return fetcher("/library/sections")
-
-
-def get_library_items(section_id: str, tag: str = "all") -> Dict[str, Any]:
-    return fetcher(f"/library/sections/{section_id}/{tag}")
-
-
-def get_library_item_metadata(rating_key: str) -> Dict[str, Any]:
-    return fetcher(f"/library/metadata/{rating_key}")
-
-
-def get_library_item_children_metadata(rating_key: str) -> Dict[str, Any]:
-    return fetcher(f"/library/metadata/{rating_key}/children")
+class LazyField:
+    """
+    A rarely used field of a metadata record (e.g. `Media`), kept JSON-encoded
+    along with the record's other lazy fields in its `lazy_fields` slot, and
+    only decoded when accessed.
+    """
 
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
 
-@dataclass
+    def __get__(self, record: Any, owner: Optional[type] = None) -> Any:
+        if record is None:
+            return self
+        if record.lazy_fields is None:
+            return None
+        return json.loads(record.lazy_fields).get(self.name)
+
+
+# Fields that hold lists of tags (e.g. genres), and fields whose string
+# values are repeated across many items; both are interned by `from_plex_item`
+# so that all items share one copy of each tag and string.
+TAG_FIELDS = ("Genre", "Similar", "Country")
+REPEATED_STRING_FIELDS = (
+    "type",
+    "parentRatingKey",
+    "parentGuid",
+    "parentKey",
+    "parentTitle",
+    "parentThumb",
+    "librarySectionTitle",
+    "librarySectionUUID",
+    "studio",
+)
+
+
+@dataclass(slots=True, frozen=True)
 class TagData:
     id: int
     filter: str
     tag: str
 
 
-@dataclass
+@dataclass(slots=True)
 class AuthorMetadata:
     title: str
     ratingKey: str
@@ -82,25 +91,26 @@ class AuthorMetadata:
     lastViewedAt: Optional[int] = None
     addedAt: Optional[int] = None
     updatedAt: int = 0
-    Country: Optional[Any] = None
+    Country: Optional[typing.Tuple[TagData, ...]] = None
     Location: List[Dict[str, str]] = field(default_factory=list)
-    Genre: Optional[List[TagData]] = None
-    Similar: Optional[List[TagData]] = None
+    Genre: Optional[typing.Tuple[TagData, ...]] = None
+    Similar: Optional[typing.Tuple[TagData, ...]] = None
     titleSort: Optional[str] = None
-    Image: Optional[Any] = None
-    UltraBlurColors: Optional[Any] = None
     skipCount: Optional[int] = None
     art: Optional[str] = None
+    lazy_fields: Optional[bytes] = None
+    Image = LazyField()
+    UltraBlurColors = LazyField()
 
 
-@dataclass
+@dataclass(slots=True)
 class ExpandedAuthorMetadata(AuthorMetadata):
     librarySectionTitle: str = ""
     librarySectionID: str = ""
     librarySectionKey: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class AuthorChildrenMetadata:
     ratingKey: str
     key: str
@@ -120,10 +130,10 @@ class AuthorChildrenMetadata:
     updatedAt: int = 0
     loudnessAnalysisVersion: int = 0
     musicAnalysisVersion: int = 0
-    Genre: List[TagData] = field(default_factory=list)
+    Genre: typing.Tuple[TagData, ...] = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class AudiobookMetadata(AuthorChildrenMetadata):
     leafCount: int = 0
     allowSync: bool = True
@@ -131,19 +141,20 @@ class AudiobookMetadata(AuthorChildrenMetadata):
     librarySectionTitle: str = ""
     librarySectionUUID: str = ""
     lastViewedAt: int = 0
-    Media: Optional[List[Any]] = None
     studio: Optional[str] = None
     rating: Optional[str] = None
     viewCount: Optional[int] = None
     parentThumb: Optional[str] = None
-    Image: Optional[str] = None
-    UltraBlurColors: Optional[Any] = None
     skipCount: Optional[int] = None
     art: Optional[str] = None
     titleSort: Optional[str] = None
+    lazy_fields: Optional[bytes] = None
+    Media = LazyField()
+    Image = LazyField()
+    UltraBlurColors = LazyField()
 
 
-@dataclass
+@dataclass(slots=True)
 class CompiledData:
     title: str
     author: str
@@ -155,19 +166,424 @@ class CompiledData:
     genres: Optional[str]
 
 
+# Number of items per page when fetching library sections, and number of pages
+# fetched concurrently.
+PAGE_SIZE = 500
+PAGE_CONCURRENCY = 4
+
+_FIELDS_BY_CLASS: Dict[
+    type, typing.Tuple[frozenset, typing.Tuple[str, ...], typing.Tuple[str, ...]]
+] = {}
+_TAGS: Dict[typing.Tuple[Any, ...], TagData] = {}
+
+
+def intern_tag(tag: Dict[str, Any]) -> TagData:
+    """Return the shared `TagData` for a Plex tag object."""
+    key = (tag.get("id"), tag.get("filter"), tag.get("tag"))
+    if key not in _TAGS:
+        _TAGS[key] = TagData(
+            id=key[0],
+            filter=sys.intern(key[1] or ""),
+            tag=sys.intern(key[2] or ""),
+        )
+    return _TAGS[key]
+
+
+def from_plex_item(cls: type, item: Dict[str, Any]) -> Any:
+    """
+    Build a metadata record from a Plex item.
+    Fields unknown to `cls` (e.g. added by newer Plex versions) are ignored,
+    and fields Plex omitted that have no default (e.g. `year`) are set to None.
+    Tags and repeated strings are interned, and `LazyField`s are encoded.
+    """
+    if cls not in _FIELDS_BY_CLASS:
+        fields = dataclasses.fields(cls)
+        _FIELDS_BY_CLASS[cls] = (
+            frozenset(f.name for f in fields if f.name != "lazy_fields"),
+            tuple(
+                f.name
+                for f in fields
+                if f.default is dataclasses.MISSING
+                and f.default_factory is dataclasses.MISSING
+            ),
+            tuple(
+                name
+                for name in dir(cls)
+                if isinstance(getattr(cls, name, None), LazyField)
+            ),
+        )
+    names, required, lazy_names = _FIELDS_BY_CLASS[cls]
+    kwargs = {k: v for k, v in item.items() if k in names}
+    for name in required:
+        kwargs.setdefault(name, None)
+    for name in TAG_FIELDS:
+        if kwargs.get(name) is not None:
+            kwargs[name] = tuple(intern_tag(tag) for tag in kwargs[name])
+    for name in REPEATED_STRING_FIELDS:
+        if isinstance(kwargs.get(name), str):
+            kwargs[name] = sys.intern(kwargs[name])
+    lazy_fields = {k: item[k] for k in lazy_names if item.get(k) is not None}
+    if lazy_fields:
+        kwargs["lazy_fields"] = json.dumps(lazy_fields, separators=(",", ":")).encode(
+            "utf-8"
+        )
+    return cls(**kwargs)
+
+
+def record_dict(record: Any) -> Dict[str, Any]:
+    """
+    Fields of a metadata record as a JSON-serializable dict, with tags given
+    by name and `LazyField`s decoded.
+    """
+    data = {}
+    for f in dataclasses.fields(record):
+        value = getattr(record, f.name)
+        if f.name == "lazy_fields":
+            data.update(json.loads(value) if value is not None else {})
+            continue
+        if f.name in TAG_FIELDS and value is not None:
+            value = genre_names(value)
+        data[f.name] = value
+    return data
+
+
+def genre_names(genres: Optional[List[Any]]) -> List[str]:
+    """Names of genre tags, whether they are Plex JSON objects or `TagData`s."""
+    return [
+        (
+            genre
+            if isinstance(genre, str)
+            else genre["tag"] if isinstance(genre, dict) else genre.tag
+        )
+        for genre in genres or ()
+    ]
+
+
+def compiled_data_sort_key(item: CompiledData):
+    """Sort key for the default book order: most viewed first (descending), then by title."""
+    if item.viewCount is None or item.viewCount == 0:
+        return (-1, item.title.lower())
+    return (item.viewCount, item.title.lower())
+
+
+class LibraryIndex:
+    """
+    Books of a library joined with their authors, computed once and reusable
+    across lookups.
+
+    Authors are indexed by rating key, so joining each book to its author is
+    a dictionary lookup rather than a scan of all authors.
+
+    Books are also kept in the orders of `VIEWS`, so that tools can read the
+    top of a view instead of sorting the library on each call. `update`
+    keeps the views sorted by merging updated books into them.
+    """
+
+    # Orders in which books are kept, by name: which books are included (all
+    # if None), and the sort key, both given the book's `AudiobookMetadata`,
+    # and whether the order is descending.
+    VIEWS: Dict[
+        str,
+        typing.Tuple[
+            Optional[Callable[[AudiobookMetadata], Any]],
+            Callable[[AudiobookMetadata], Any],
+            bool,
+        ],
+    ] = {
+        # Most viewed first, then by title.
+        "books": (None, compiled_data_sort_key, True),
+        # Books completed at least once, most recently viewed first.
+        "recently_read": (
+            lambda book: book.viewCount,
+            lambda book: book.lastViewedAt or 0,
+            True,
+        ),
+        # Books never completed, by title.
+        "unread": (
+            lambda book: not book.viewCount,
+            lambda book: book.title.lower(),
+            False,
+        ),
+    }
+
+    def __init__(
+        self, authors: List[AuthorMetadata], books: List[AudiobookMetadata]
+    ) -> None:
+        self.authors_by_key: Dict[str, AuthorMetadata] = {
+            author.ratingKey: author for author in authors
+        }
+        self.records: Dict[str, AudiobookMetadata] = {}
+        self.books_by_key: Dict[str, CompiledData] = {}
+        self.books_by_author: Dict[str, List[CompiledData]] = {}
+        for book in books:
+            self._add(book)
+        self.views: Dict[str, List[CompiledData]] = {
+            name: self._sorted(name, self.books_by_key.values()) for name in self.VIEWS
+        }
+
+    @property
+    def books(self) -> List[CompiledData]:
+        return self.views["books"]
+
+    def _add(self, book: AudiobookMetadata) -> Optional[CompiledData]:
+        author = self.authors_by_key.get(book.parentRatingKey)
+        if author is None:
+            return None
+        compiled = CompiledData(
+            title=book.title,
+            author=author.title,
+            ratingKey=book.ratingKey,
+            authorRatingKey=author.ratingKey,
+            year=book.year,
+            lastViewedAt=convert_timestamp(book.lastViewedAt),
+            viewCount=book.viewCount,
+            genres=", ".join(genre_names(book.Genre)) or None,
+        )
+        self.records[compiled.ratingKey] = book
+        self.books_by_key[compiled.ratingKey] = compiled
+        self.books_by_author.setdefault(author.ratingKey, []).append(compiled)
+        return compiled
+
+    def _remove(self, rating_key: str) -> None:
+        compiled = self.books_by_key.pop(rating_key, None)
+        if compiled is None:
+            return
+        del self.records[rating_key]
+        self.books_by_author[compiled.authorRatingKey].remove(compiled)
+
+    def _sort_key(self, name: str) -> Callable[[CompiledData], Any]:
+        key = self.VIEWS[name][1]
+        return lambda compiled: key(self.records[compiled.ratingKey])
+
+    def _sorted(
+        self, name: str, books: typing.Iterable[CompiledData]
+    ) -> List[CompiledData]:
+        where, _, reverse = self.VIEWS[name]
+        if where is not None:
+            books = (book for book in books if where(self.records[book.ratingKey]))
+        return sorted(books, key=self._sort_key(name), reverse=reverse)
+
+    def update(
+        self, authors: List[AuthorMetadata], books: List[AudiobookMetadata]
+    ) -> None:
+        """
+        Merge updated (or new) authors and books into the index.
+        Books of updated authors are joined again. Each view is kept sorted by
+        merging the sorted updated books into the rest, in linear time.
+        """
+        self.authors_by_key.update((author.ratingKey, author) for author in authors)
+        updated = {book.ratingKey: book for book in books}
+        for author in authors:
+            for compiled in self.books_by_author.get(author.ratingKey, ()):
+                updated.setdefault(compiled.ratingKey, self.records[compiled.ratingKey])
+        for rating_key in updated:
+            self._remove(rating_key)
+        added = [book for book in map(self._add, updated.values()) if book]
+        for name, (_, _, reverse) in self.VIEWS.items():
+            self.views[name] = list(
+                heapq.merge(
+                    [
+                        book
+                        for book in self.views[name]
+                        if book.ratingKey not in updated
+                    ],
+                    self._sorted(name, added),
+                    key=self._sort_key(name),
+                    reverse=reverse,
+                )
+            )
+
+
 class PlexClient:
     """Plex Client to interact with Audiobook Library"""
 
     debug = False
 
-    @staticmethod
+    # Per-request timeout, and how many times to retry requests that failed
+    # with a connection error, a timeout or a transient server error.
+    TIMEOUT_SECONDS = 30
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_SECONDS = 0.5
+    RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+    # Clients are kept for this many servers and tokens, least recently used
+    # first out.
+    MAX_CLIENTS = 16
+
+    _clients: "collections.OrderedDict[typing.Tuple[str, str], PlexClient]" = (
+        collections.OrderedDict()
+    )
+
+    def __init__(self, base_url: str, token: str) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.library_cache = LibraryCache(self)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.machine_identifier: Optional[str] = None
+
+    @classmethod
+    def for_server(cls, base_url: str, token: str) -> "PlexClient":
+        """
+        Return the process-wide client for a server and token, so that its
+        connections and library cache are shared across tool calls.
+        """
+        key = (base_url.rstrip("/"), token)
+        if key in cls._clients:
+            cls._clients.move_to_end(key)
+            return cls._clients[key]
+        client = cls._clients[key] = cls(*key)
+        while len(cls._clients) > cls.MAX_CLIENTS:
+            _, evicted = cls._clients.popitem(last=False)
+            evicted._discard()
+        return client
+
+    def _discard(self) -> None:
+        """Close the session of a client dropped from the registry, without waiting for it."""
+        session, loop = self._session, self._session_loop
+        self._session = None
+        if session is None or session.closed or loop is None or loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions are bound to the event loop they were created in.
+        loop = asyncio.get_running_loop()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session_loop is not loop
+        ):
+            self._session = aiohttp.ClientSession(
+                headers={"Accept": "application/json", "X-Plex-Token": self.token},
+                timeout=aiohttp.ClientTimeout(total=self.TIMEOUT_SECONDS),
+                connector=aiohttp.TCPConnector(limit_per_host=2 * PAGE_CONCURRENCY),
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def fetch(
+        self, path: str, params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """GET a Plex API path (e.g. `/library/sections`) as JSON, retrying transient failures."""
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            try:
+                async with self._get_session().get(url, params=params) as response:
+                    if response.status == 200:
+                        return await response.json(content_type=None)
+                    error = Exception(
+                        f"Error: {response.status} {await response.text()}"
+                    )
+                    if response.status not in self.RETRY_STATUSES:
+                        raise error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            attempt += 1
+            if attempt > self.MAX_RETRIES:
+                raise error
+            await asyncio.sleep(self.RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+    async def get_machine_identifier(self) -> str:
+        """Return the server's unique identifier, which Plex webhooks give as `Server.uuid`."""
+        if self.machine_identifier is None:
+            identity = await self.fetch("/identity")
+            self.machine_identifier = identity["MediaContainer"]["machineIdentifier"]
+        return self.machine_identifier
+
+    async def get_libraries(self) -> Dict[str, Any]:
+        return await self.fetch("/library/sections")
+
+    async def get_library_items(
+        self,
+        section_id: str,
+        tag: str = "all",
+        params: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        section_id = urllib.parse.quote(str(section_id), safe="")
+        return await self.fetch(f"/library/sections/{section_id}/{tag}", params)
+
+    async def get_library_item_metadata(self, rating_key: str) -> Dict[str, Any]:
+        rating_key = urllib.parse.quote(str(rating_key), safe="")
+        return await self.fetch(f"/library/metadata/{rating_key}")
+
+    async def get_library_item_children_metadata(
+        self, rating_key: str
+    ) -> Dict[str, Any]:
+        rating_key = urllib.parse.quote(str(rating_key), safe="")
+        return await self.fetch(f"/library/metadata/{rating_key}/children")
+
+    async def iter_library_items(
+        self,
+        section_id: str,
+        tag: str,
+        cls: type,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> typing.AsyncIterator[List[Any]]:
+        """
+        Fetch the items of a library section page by page, yielding each page as
+        a list of `cls` in library order.
+
+        Pages after the first are fetched concurrently, at most `PAGE_CONCURRENCY`
+        at a time. Each page's JSON is converted as soon as it arrives and then
+        dropped, so memory use is bounded by the pages in flight rather than by
+        one response holding the whole library.
+        """
+
+        async def fetch_page(start: int) -> typing.Tuple[int, List[Any]]:
+            page_params = dict(params or {})
+            page_params["X-Plex-Container-Start"] = start
+            page_params["X-Plex-Container-Size"] = PAGE_SIZE
+            page = await self.get_library_items(section_id, tag, page_params)
+            container = page["MediaContainer"]
+            items = [
+                from_plex_item(cls, item) for item in container.get("Metadata", [])
+            ]
+            return int(container.get("totalSize", start + len(items))), items
+
+        total, items = await fetch_page(0)
+        yield items
+        pending = collections.deque()
+        try:
+            # Servers that ignore paging return everything in the first page.
+            for start in range(len(items), total, PAGE_SIZE):
+                pending.append(asyncio.ensure_future(fetch_page(start)))
+                if len(pending) >= PAGE_CONCURRENCY:
+                    _, items = await pending.popleft()
+                    yield items
+            while pending:
+                _, items = await pending.popleft()
+                yield items
+        finally:
+            for page in pending:
+                page.cancel()
+
+    async def fetch_library_items(
+        self,
+        section_id: str,
+        tag: str,
+        cls: type,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> List[Any]:
+        """Fetch all the items of a library section as a list of `cls`; see `iter_library_items`."""
+        items = []
+        async for page in self.iter_library_items(section_id, tag, cls, params):
+            items.extend(page)
+        return items
+
     async def get_audiobook_library_metadata(
-        event_emitter: typing.Callable[[dict], typing.Any] = None
+        self, event_emitter: typing.Callable[[dict], typing.Any] = None
     ) -> Dict[str, Any]:
         emitter = EventEmitter(event_emitter, debug=PlexClient.debug)
         await emitter.status("Getting Audiobook Library Metadata...")
         try:
-            libraries = get_libraries()
+            libraries = await self.get_libraries()
             lib = next(
                 (
                     d
@@ -185,84 +601,760 @@ class PlexClient:
             await emitter.fail(f"Error fetching audiobook library: {str(e)}")
             raise
 
-    @staticmethod
     async def get_all_author_metadata(
-        __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
     ) -> List[AuthorMetadata]:
-        library = await PlexClient.get_audiobook_library_metadata(
+        library = await self.get_audiobook_library_metadata(
             event_emitter=__event_emitter__
         )
-        metadata = get_library_items(library["key"])["MediaContainer"].get(
-            "Metadata", []
-        )
+        metadata = await self.fetch_library_items(library["key"], "all", AuthorMetadata)
         if not metadata:
             raise Exception("No metadata found")
-        return [AuthorMetadata(**item) for item in metadata]
+        return metadata
 
-    @staticmethod
     async def get_all_books_metadata(
-        __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
     ) -> List[AudiobookMetadata]:
-        library = await PlexClient.get_audiobook_library_metadata(
+        library = await self.get_audiobook_library_metadata(
             event_emitter=__event_emitter__
         )
-        metadata = get_library_items(library["key"], "albums")["MediaContainer"].get(
-            "Metadata", []
+        metadata = await self.fetch_library_items(
+            library["key"], "albums", AudiobookMetadata
         )
         if not metadata:
             raise Exception("No metadata found for books")
-        return [AudiobookMetadata(**item) for item in metadata]
+        return metadata
+
+    async def get_library_index(
+        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+    ) -> LibraryIndex:
+        return await self.library_cache.get(__event_emitter__)
 
-    @staticmethod
     async def get_all_metadata(
-        __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
     ) -> List[CompiledData]:
-        authors = await PlexClient.get_all_author_metadata(__event_emitter__)
-        books = await PlexClient.get_all_books_metadata(__event_emitter__)
-        compiled_data = []
-        for book in books:
-            author = next(
-                (a for a in authors if a.ratingKey == book.parentRatingKey), None
+        index = await self.get_library_index(__event_emitter__)
+        return index.books
+
+    async def get_library_database(
+        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+    ) -> "LibraryDatabase":
+        """Return the library database, once brought up to date like the library index."""
+        await self.get_library_index(__event_emitter__)
+        return self.library_cache.database
+
+
+class LibraryCache:
+    """
+    Cache of the audiobook library of a `PlexClient`'s server, shared by all
+    tool calls using that client.
+
+    Within `TTL_SECONDS` of the last check, the cached index is used as-is.
+    After that, the library section's `updatedAt`/`scannedAt` timestamps are
+    checked, which is one small request. Only if they changed are the authors
+    and books updated since the last pull fetched and merged in; if the
+    merged item counts disagree with the server (e.g. items were removed),
+    the whole library is pulled again.
+    Play state changes (view counts) do not bump these timestamps, so the
+    whole library is also pulled again every `FULL_REFRESH_SECONDS`, or
+    every `WEBHOOK_FULL_REFRESH_SECONDS` while the cache receives Plex
+    webhooks (see `handle_webhook`).
+    Concurrent callers share a single in-flight refresh.
+    """
+
+    TTL_SECONDS = 300
+    FULL_REFRESH_SECONDS = 3600
+
+    # Webhooks report finished books, but not deletions, books marked as read
+    # or unread by hand, or metadata edits, so the library is still pulled
+    # again periodically while they are received; and in case they stop,
+    # they are only relied on for this long after the last one.
+    WEBHOOK_FULL_REFRESH_SECONDS = 6 * 3600
+    WEBHOOK_SILENCE_SECONDS = 12 * TTL_SECONDS
+
+    # Section fields that change when the section's content changes.
+    SECTION_VERSION_FIELDS = ("updatedAt", "scannedAt", "contentChangedAt")
+
+    # Plex webhook events that change the library: a book (or a chapter of
+    # one) was finished, or an author or book was added.
+    WEBHOOK_EVENTS = frozenset(("media.scrobble", "library.new"))
+
+    def __init__(self, client: "PlexClient") -> None:
+        self._client = client
+        self.section: Optional[Dict[str, Any]] = None
+        self.authors: Dict[str, AuthorMetadata] = {}
+        self.books: Dict[str, AudiobookMetadata] = {}
+        self.index: Optional[LibraryIndex] = None
+        self.database = LibraryDatabase()
+        self.checked_at = 0.0
+        self.pulled_at = 0.0
+        # Newest `updatedAt` of the items pulled from the library listings.
+        self.pulled_until = 0
+        self.webhook_received_at: Optional[float] = None
+        self._refresh: Optional[asyncio.Future] = None
+
+    @property
+    def receives_webhooks(self) -> bool:
+        return (
+            self.webhook_received_at is not None
+            and time.monotonic() - self.webhook_received_at
+            < self.WEBHOOK_SILENCE_SECONDS
+        )
+
+    def is_fresh(self) -> bool:
+        return (
+            self.index is not None
+            and time.monotonic() - self.checked_at < self.TTL_SECONDS
+        )
+
+    async def get(
+        self, event_emitter: typing.Callable[[dict], typing.Any] = None
+    ) -> LibraryIndex:
+        """Return the library index, refreshing it first if it is stale."""
+        if self.is_fresh():
+            return self.index
+        refresh = self._refresh
+        if (
+            refresh is None
+            or refresh.done()
+            or refresh.get_loop() is not asyncio.get_running_loop()
+        ):
+            refresh = asyncio.ensure_future(self._revalidate(event_emitter))
+            self._refresh = refresh
+        # Shield the shared refresh from the cancellation of any one caller.
+        return await asyncio.shield(refresh)
+
+    def _section_version(self, section: Optional[Dict[str, Any]]) -> tuple:
+        if section is None:
+            return ()
+        return tuple(section.get(name) for name in self.SECTION_VERSION_FIELDS)
+
+    async def _revalidate(
+        self, event_emitter: typing.Callable[[dict], typing.Any]
+    ) -> LibraryIndex:
+        checked_at = time.monotonic()
+        section = await self._client.get_audiobook_library_metadata(
+            event_emitter=event_emitter
+        )
+        if (
+            self.index is None
+            or section["key"] != self.section["key"]
+            or checked_at - self.pulled_at
+            >= (
+                self.WEBHOOK_FULL_REFRESH_SECONDS
+                if self.receives_webhooks
+                else self.FULL_REFRESH_SECONDS
+            )
+        ):
+            await self._pull(section)
+            self.pulled_at = checked_at
+        elif self._section_version(section) != self._section_version(self.section):
+            if not await self._pull_updates(section):
+                await self._pull(section)
+                self.pulled_at = checked_at
+        self.section = section
+        self.checked_at = checked_at
+        return self.index
+
+    async def _pull(self, section: Dict[str, Any]) -> None:
+        """Pull the whole library."""
+        authors, books = await self._fetch(section)
+        if not authors:
+            raise Exception("No metadata found")
+        if not books:
+            raise Exception("No metadata found for books")
+        self.authors = {author.ratingKey: author for author in authors}
+        self.books = {book.ratingKey: book for book in books}
+        self.index = LibraryIndex(
+            list(self.authors.values()), list(self.books.values())
+        )
+        self.database.sync(authors, books, full=True)
+        self.pulled_until = max(item.updatedAt or 0 for item in (*authors, *books))
+
+    async def _pull_updates(self, section: Dict[str, Any]) -> bool:
+        """
+        Pull only the items updated since the newest cached item, and merge them in.
+
+        :return: Whether the merged library is consistent with the server's item counts.
+        """
+        # Plex's `>>=` filter is strictly greater than; back off by one second
+        # to catch items updated within the same second as the newest one.
+        authors, books = await self._fetch(
+            section, {"updatedAt>>": self.pulled_until - 1}
+        )
+        self.authors.update((author.ratingKey, author) for author in authors)
+        self.books.update((book.ratingKey, book) for book in books)
+        num_authors, num_books = await asyncio.gather(
+            self._count(section, "all"), self._count(section, "albums")
+        )
+        if num_authors != len(self.authors) or num_books != len(self.books):
+            return False
+        self.index.update(authors, books)
+        self.database.sync(authors, books, full=False)
+        self.pulled_until = max(
+            [self.pulled_until, *(item.updatedAt or 0 for item in (*authors, *books))]
+        )
+        return True
+
+    async def handle_webhook(self, payload: Dict[str, Any]) -> bool:
+        """
+        Patch the cached library with the item a Plex webhook event is about.
+        Only that item's book (or an added author and their books) is fetched,
+        and merged into the index and the database.
+
+        While any event about the library keeps arriving, finished books
+        arrive through `media.scrobble` events, so the whole library is only
+        pulled again every `WEBHOOK_FULL_REFRESH_SECONDS`.
+
+        :param payload: The event's JSON payload, as posted by Plex.
+        :return: Whether the event was about this cache's library, and patched it.
+        """
+        metadata = payload.get("Metadata") or {}
+        if (
+            self.index is None
+            or str(metadata.get("librarySectionID")) != self.section["key"]
+        ):
+            return False
+        # Patch the index a refresh in progress is about to replace, after it.
+        refresh = self._refresh
+        if (
+            refresh is not None
+            and not refresh.done()
+            and refresh.get_loop() is asyncio.get_running_loop()
+        ):
+            await asyncio.wait([refresh])
+        server = (payload.get("Server") or {}).get("uuid")
+        if server != await self._client.get_machine_identifier():
+            return False
+        self.webhook_received_at = time.monotonic()
+        if payload.get("event") not in self.WEBHOOK_EVENTS:
+            return False
+
+        authors: List[AuthorMetadata] = []
+        books: List[AudiobookMetadata] = []
+        if metadata.get("type") == "artist":
+            author_key = metadata.get("ratingKey")
+            books = await self._fetch_items(
+                AudiobookMetadata,
+                self._client.get_library_item_children_metadata(author_key),
             )
-            if author:
-                compiled_data.append(
-                    CompiledData(
-                        title=book.title,
-                        author=author.title,
-                        ratingKey=book.ratingKey,
-                        authorRatingKey=author.ratingKey,
-                        year=book.year,
-                        lastViewedAt=convert_timestamp(book.lastViewedAt),
-                        viewCount=book.viewCount,
-                        genres=book.Genre,
+        else:
+            # A book, or a track (chapter) of a book.
+            book_key = metadata.get(
+                "ratingKey" if metadata.get("type") == "album" else "parentRatingKey"
+            )
+            if book_key is None:
+                return False
+            books = await self._fetch_items(
+                AudiobookMetadata, self._client.get_library_item_metadata(book_key)
+            )
+            author_key = books[0].parentRatingKey if books else None
+        if author_key is not None and (
+            metadata.get("type") == "artist" or author_key not in self.authors
+        ):
+            authors = await self._fetch_items(
+                AuthorMetadata, self._client.get_library_item_metadata(author_key)
+            )
+        if not authors and not books:
+            return False
+
+        self.authors.update((author.ratingKey, author) for author in authors)
+        self.books.update((book.ratingKey, book) for book in books)
+        self.index.update(authors, books)
+        self.database.sync(authors, books, full=False)
+        return True
+
+    @staticmethod
+    async def _fetch_items(
+        cls: type, response: typing.Awaitable[Dict[str, Any]]
+    ) -> List[Any]:
+        container = (await response)["MediaContainer"]
+        return [from_plex_item(cls, item) for item in container.get("Metadata", [])]
+
+    async def _fetch(
+        self, section: Dict[str, Any], params: Optional[Dict[str, Any]] = None
+    ) -> typing.Tuple[List[AuthorMetadata], List[AudiobookMetadata]]:
+        return await asyncio.gather(
+            self._client.fetch_library_items(
+                section["key"], "all", AuthorMetadata, params
+            ),
+            self._client.fetch_library_items(
+                section["key"], "albums", AudiobookMetadata, params
+            ),
+        )
+
+    async def _count(self, section: Dict[str, Any], tag: str) -> int:
+        """Count the items of a section without fetching them."""
+        container = (
+            await self._client.get_library_items(
+                section["key"],
+                tag,
+                {"X-Plex-Container-Start": 0, "X-Plex-Container-Size": 0},
+            )
+        )["MediaContainer"]
+        return int(container.get("totalSize", container.get("size", 0)))
+
+
+class LibraryDatabase:
+    """
+    SQLite index of a library's authors and books, kept in sync by its
+    `LibraryCache`, for filtered and paginated queries that return only the
+    matching rows.
+
+    Titles, author names, summaries and genres are full-text indexed with
+    FTS5 where the SQLite build supports it; otherwise text queries fall back
+    to substring matching.
+    """
+
+    SCHEMA = """
+        CREATE TABLE authors (
+            id INTEGER PRIMARY KEY,
+            rating_key TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            summary TEXT
+        );
+        CREATE TABLE books (
+            id INTEGER PRIMARY KEY,
+            rating_key TEXT NOT NULL UNIQUE,
+            author_key TEXT NOT NULL,
+            title TEXT NOT NULL,
+            year INTEGER,
+            summary TEXT,
+            genres TEXT NOT NULL,
+            view_count INTEGER NOT NULL,
+            last_viewed_at INTEGER
+        );
+        CREATE INDEX books_author_key ON books (author_key);
+    """
+
+    # Full-text index over books, with rowids matching `books.id`.
+    FTS_SCHEMA = (
+        "CREATE VIRTUAL TABLE books_fts USING fts5(title, author, summary, genres)"
+    )
+
+    BOOK_SORTS = {
+        "title": "b.title COLLATE NOCASE",
+        "year": "b.year DESC, b.title COLLATE NOCASE",
+        "last_viewed": "b.last_viewed_at DESC, b.title COLLATE NOCASE",
+        "view_count": "b.view_count DESC, b.title COLLATE NOCASE",
+    }
+    AUTHOR_SORTS = {
+        "title": "a.title COLLATE NOCASE",
+        "books": "num_books DESC, a.title COLLATE NOCASE",
+        "read_books": "num_read_books DESC, a.title COLLATE NOCASE",
+    }
+
+    def __init__(self) -> None:
+        # Only used from the event loop's thread, which need not be the one
+        # that created the tool.
+        self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(self.SCHEMA)
+        try:
+            self._db.execute(self.FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            self.has_fts = False
+
+    def sync(
+        self,
+        authors: List[AuthorMetadata],
+        books: List[AudiobookMetadata],
+        full: bool,
+    ) -> None:
+        """
+        Bring the database up to date with pulled items.
+
+        :param full: Whether `authors` and `books` are the whole library, rather than only the items that changed.
+        """
+        with self._db:
+            if full:
+                self._db.execute("DELETE FROM authors")
+                self._db.execute("DELETE FROM books")
+                if self.has_fts:
+                    self._db.execute("DELETE FROM books_fts")
+            self._db.executemany(
+                """
+                INSERT INTO authors (rating_key, title, summary) VALUES (?, ?, ?)
+                ON CONFLICT (rating_key) DO UPDATE SET
+                    title = excluded.title, summary = excluded.summary
+                """,
+                [(a.ratingKey, a.title or "", a.summary) for a in authors],
+            )
+            book_keys = [(book.ratingKey,) for book in books]
+            if not full:
+                if self.has_fts:
+                    self._db.executemany(
+                        "DELETE FROM books_fts WHERE rowid IN (SELECT id FROM books WHERE rating_key = ?)",
+                        book_keys,
+                    )
+                self._db.executemany(
+                    "DELETE FROM books WHERE rating_key = ?", book_keys
+                )
+            self._db.executemany(
+                """
+                INSERT INTO books (
+                    rating_key, author_key, title, year, summary, genres,
+                    view_count, last_viewed_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        book.ratingKey,
+                        book.parentRatingKey,
+                        book.title or "",
+                        book.year,
+                        book.summary,
+                        # Delimited on both ends so that genres can be matched whole.
+                        "|" + "|".join(genre_names(book.Genre)) + "|",
+                        book.viewCount or 0,
+                        book.lastViewedAt or None,
                     )
+                    for book in books
+                ],
+            )
+            if not self.has_fts:
+                return
+            # (Re-)index changed books, and the books of renamed authors.
+            self._db.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS changed (id INTEGER PRIMARY KEY)"
+            )
+            self._db.execute("DELETE FROM changed")
+            if full:
+                self._db.execute("INSERT INTO changed SELECT id FROM books")
+            else:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO changed SELECT id FROM books WHERE rating_key = ?",
+                    book_keys,
+                )
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO changed SELECT id FROM books WHERE author_key = ?",
+                    [(author.ratingKey,) for author in authors],
+                )
+                self._db.execute(
+                    "DELETE FROM books_fts WHERE rowid IN (SELECT id FROM changed)"
+                )
+            self._db.execute("""
+                INSERT INTO books_fts (rowid, title, author, summary, genres)
+                SELECT b.id, b.title, a.title, b.summary, replace(b.genres, '|', ' ')
+                FROM books b JOIN authors a ON a.rating_key = b.author_key
+                WHERE b.id IN (SELECT id FROM changed)
+                """)
+
+    def _text_filter(
+        self, text: str, columns: typing.Tuple[str, ...]
+    ) -> typing.Tuple[str, List[Any]]:
+        """SQL condition and parameters matching books whose `columns` contain all the words of `text`."""
+        words = re.findall(r"\w+", text)
+        if self.has_fts:
+            # Quote each word, so that user text cannot inject FTS5 syntax,
+            # and match by prefix.
+            query = " ".join(f'"{word}"*' for word in words)
+            return "b.id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)", [
+                query
+            ]
+        conditions, params = [], []
+        for word in words:
+            conditions.append(
+                "(" + " OR ".join(f"{column} LIKE ?" for column in columns) + ")"
+            )
+            params.extend([f"%{word}%"] * len(columns))
+        return " AND ".join(conditions), params
+
+    def search_books(
+        self,
+        query: Optional[str] = None,
+        author: Optional[str] = None,
+        genre: Optional[str] = None,
+        year_from: Optional[int] = None,
+        year_to: Optional[int] = None,
+        read: Optional[bool] = None,
+        author_min_read_books: Optional[int] = None,
+        sort_by: str = "title",
+        limit: int = 20,
+        offset: int = 0,
+    ) -> typing.Tuple[int, List[Dict[str, Any]]]:
+        """
+        Find books matching all the given filters.
+
+        :return: 2-tuple `(total number of matches, matching books from offset to offset + limit)`.
+        """
+        conditions, params = [], []
+        if query and re.search(r"\w", query):
+            condition, condition_params = self._text_filter(
+                query, ("b.title", "a.title", "b.summary", "b.genres")
+            )
+            conditions.append(condition)
+            params.extend(condition_params)
+        if author:
+            conditions.append("a.title LIKE ?")
+            params.append(f"%{author}%")
+        if genre:
+            conditions.append("b.genres LIKE ?")
+            params.append(f"%|{genre}|%")
+        if year_from is not None:
+            conditions.append("b.year >= ?")
+            params.append(year_from)
+        if year_to is not None:
+            conditions.append("b.year <= ?")
+            params.append(year_to)
+        if read is not None:
+            conditions.append("b.view_count > 0" if read else "b.view_count = 0")
+        if author_min_read_books is not None:
+            conditions.append("""
+                b.author_key IN (
+                    SELECT author_key FROM books WHERE view_count > 0
+                    GROUP BY author_key HAVING COUNT(*) >= ?
+                )
+                """)
+            params.append(author_min_read_books)
+        where = " AND ".join(conditions) or "1"
+        source = "books b JOIN authors a ON a.rating_key = b.author_key"
+        total = self._db.execute(
+            f"SELECT COUNT(*) FROM {source} WHERE {where}", params
+        ).fetchone()[0]
+        rows = self._db.execute(
+            f"""
+            SELECT b.title, a.title AS author, b.rating_key, b.author_key, b.year,
+                b.last_viewed_at, b.view_count, b.genres
+            FROM {source} WHERE {where}
+            ORDER BY {self.BOOK_SORTS.get(sort_by, self.BOOK_SORTS["title"])}
+            LIMIT ? OFFSET ?
+            """,
+            params + [limit, offset],
+        ).fetchall()
+        return total, [
+            {
+                "title": row["title"],
+                "author": row["author"],
+                "ratingKey": row["rating_key"],
+                "authorRatingKey": row["author_key"],
+                "year": row["year"],
+                "lastViewedAt": convert_timestamp(row["last_viewed_at"]),
+                "viewCount": row["view_count"],
+                "genres": (
+                    row["genres"].strip("|").split("|") if row["genres"] != "||" else []
+                ),
+            }
+            for row in rows
+        ]
+
+    def search_authors(
+        self,
+        query: Optional[str] = None,
+        min_read_books: Optional[int] = None,
+        sort_by: str = "title",
+        limit: int = 20,
+        offset: int = 0,
+    ) -> typing.Tuple[int, List[Dict[str, Any]]]:
+        """
+        Find authors whose name contains all the words of `query`, with counts of their books.
+
+        :return: 2-tuple `(total number of matches, matching authors from offset to offset + limit)`.
+        """
+        conditions, params = [], []
+        for word in re.findall(r"\w+", query or ""):
+            conditions.append("a.title LIKE ?")
+            params.append(f"%{word}%")
+        having, having_params = "", []
+        if min_read_books is not None:
+            having = "HAVING num_read_books >= ?"
+            having_params.append(min_read_books)
+        where = " AND ".join(conditions) or "1"
+        grouped = f"""
+            SELECT a.title, a.rating_key, COUNT(b.id) AS num_books,
+                COUNT(CASE WHEN b.view_count > 0 THEN 1 END) AS num_read_books,
+                COALESCE(SUM(b.view_count), 0) AS view_count
+            FROM authors a JOIN books b ON b.author_key = a.rating_key
+            WHERE {where} GROUP BY a.id {having}
+        """
+        total = self._db.execute(
+            f"SELECT COUNT(*) FROM ({grouped})", params + having_params
+        ).fetchone()[0]
+        rows = self._db.execute(
+            f"""
+            {grouped}
+            ORDER BY {self.AUTHOR_SORTS.get(sort_by, self.AUTHOR_SORTS["title"])}
+            LIMIT ? OFFSET ?
+            """,
+            params + having_params + [limit, offset],
+        ).fetchall()
+        return total, [
+            {
+                "author": row["title"],
+                "ratingKey": row["rating_key"],
+                "books": row["num_books"],
+                "readBooks": row["num_read_books"],
+                "viewCount": row["view_count"],
+            }
+            for row in rows
+        ]
+
+
+class WebhookListener:
+    """
+    Small HTTP server receiving Plex webhooks, so that the cached libraries of
+    all `PlexClient`s are patched as soon as a book is finished or added
+    (see `LibraryCache.handle_webhook`), instead of when their cache expires.
+
+    Add `http://<host>:<port>/plex/webhook?token=<secret>` as a webhook in
+    the Plex server's settings (this requires Plex Pass). Plex posts each
+    event as multipart form data, with the event's JSON in the `payload`
+    field. Requests without the shared secret are rejected, since anyone
+    who can reach the listener could otherwise make it fetch items.
+    """
+
+    PATH = "/plex/webhook"
+
+    _listeners: Dict[int, "WebhookListener"] = {}
+
+    def __init__(
+        self, host: str, port: int, secret: str, record_path: Optional[str] = None
+    ):
+        """
+        :param secret: Shared secret that requests must pass as the `token` query parameter.
+        :param record_path: File to append each received payload to, as a line of JSON, for `replay_webhooks`.
+        """
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.record_path = record_path
+        self._runner: Optional[web.AppRunner] = None
+
+    @classmethod
+    async def start(
+        cls, host: str, port: int, secret: str, record_path: Optional[str] = None
+    ) -> "WebhookListener":
+        """
+        Start listening on the port in the running event loop. If already
+        listening on it, the secret is updated, and the listener is restarted
+        if on another host.
+        """
+        if not secret:
+            raise ValueError("A shared secret is required to receive Plex webhooks")
+        previous = cls._listeners.get(port)
+        if previous is not None and previous.host == host:
+            previous.secret = secret
+            return previous
+        listener = cls._listeners[port] = cls(host, port, secret, record_path)
+        try:
+            if previous is not None:
+                await previous.stop()
+            app = web.Application()
+            app.router.add_post(cls.PATH, listener._handle)
+            listener._runner = web.AppRunner(app, access_log=None)
+            await listener._runner.setup()
+            await web.TCPSite(listener._runner, host, port).start()
+        except Exception:
+            if cls._listeners.get(port) is listener:
+                del cls._listeners[port]
+            raise
+        return listener
+
+    async def stop(self) -> None:
+        if self._listeners.get(self.port) is self:
+            del self._listeners[self.port]
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        token = request.query.get("token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.json_response({"error": "Forbidden"}, status=403)
+        try:
+            if request.content_type == "application/json":
+                payload = await request.json()
+            else:
+                field = (await request.post()).get("payload") or "{}"
+                if isinstance(field, web.FileField):
+                    field = field.file.read()
+                payload = json.loads(field)
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            return web.json_response(
+                {"error": "Payload is not a JSON object"}, status=400
+            )
+        if self.record_path:
+            with open(self.record_path, "a") as f:
+                f.write(json.dumps(payload) + "\n")
+        patched = 0
+        for client in list(PlexClient._clients.values()):
+            try:
+                patched += await client.library_cache.handle_webhook(payload)
+            except Exception as e:
+                print(
+                    f"Error handling Plex webhook event {payload.get('event')}: {e}",
+                    file=sys.stderr,
                 )
+        return web.json_response({"patched": patched})
+
+
+async def replay_webhooks(path: str, url: str, secret: str) -> None:
+    """
+    Post recorded Plex webhook payloads to a webhook listener the way Plex
+    does, as a stand-in for a Plex server when testing.
+
+    :param path: File of payloads, one JSON object per line, as recorded by `WebhookListener`.
+    :param url: URL of the listener, e.g. `http://localhost:32500/plex/webhook`.
+    :param secret: The listener's shared secret.
+    """
+    async with aiohttp.ClientSession() as session:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                form = aiohttp.FormData()
+                # A content type makes this multipart form data, like Plex's.
+                form.add_field("payload", line.strip(), content_type="application/json")
+                async with session.post(
+                    url, data=form, params={"token": secret}
+                ) as response:
+                    print(
+                        f"{json.loads(line).get('event')}: {response.status} "
+                        f"{await response.text()}"
+                    )
 
-        # Sort the compiled data
-        def sort_key(item):
-            if item.viewCount is None or item.viewCount == 0:
-                return (-1, item.title.lower())
-            return (item.viewCount, item.title.lower())
 
-        compiled_data.sort(key=sort_key, reverse=True)
-        return compiled_data
+async def listen_for_webhooks(
+    host: str, port: int, secret: str, record_path: Optional[str]
+) -> None:
+    """Cache the library of the Plex server set by environment variables, and keep it patched from webhooks."""
+    client = PlexClient.for_server(
+        os.getenv("PLEX_BASE_URL", "http://host.docker.internal:32400"),
+        os.getenv("PLEX_TOKEN", ""),
+    )
+    index = await client.get_library_index()
+    listener = await WebhookListener.start(host, port, secret, record_path)
+    print(
+        f"Cached {len(index.books)} books; listening for Plex webhooks on "
+        f"http://{host}:{port}{WebhookListener.PATH}?token=..."
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await listener.stop()
+        await client.close()
 
 
 async def main():
+    client = PlexClient(
+        os.getenv("PLEX_BASE_URL", "http://host.docker.internal:32400"),
+        os.getenv("PLEX_TOKEN", ""),
+    )
     try:
         # Fetch all authors metadata
-        authors = await PlexClient.get_all_author_metadata()
-        print(json.dumps([author.__dict__ for author in authors], indent=2))
+        authors = await client.get_all_author_metadata()
+        print(json.dumps([record_dict(author) for author in authors], indent=2))
 
         # Fetch all books metadata
-        books = await PlexClient.get_all_books_metadata()
-        print(json.dumps([book.__dict__ for book in books], indent=2))
+        books = await client.get_all_books_metadata()
+        print(json.dumps([record_dict(book) for book in books], indent=2))
     except Exception as e:
         print(f"An error occurred: {e}")
-
-
-if __name__ == "__main__":
-    main()
+    finally:
+        await client.close()
 
 
 def filter_metadata(data: dict) -> dict:
@@ -386,94 +1478,429 @@ class Tools:
             default=os.getenv("PLEX_TOKEN", "your_api_here"),
             description="The token to authenticate with the Plex server",
         )
+        OUTPUT_FORMAT: typing.Literal["compact", "json"] = Field(
+            default="compact",
+            description="Format of tool results: 'compact' tab-separated tables of only the useful fields, cut to MAX_OUTPUT_TOKENS, or 'json' for full JSON objects",
+        )
+        MAX_OUTPUT_TOKENS: int = Field(
+            default=4000,
+            description="Approximate maximum number of tokens in compact tool results; the rest can be requested with a cursor",
+        )
+        WEBHOOK_PORT: int = Field(
+            default=int(os.getenv("PLEX_WEBHOOK_PORT", "0")),
+            description="Port to receive Plex webhooks on at /plex/webhook, to update the cached library as soon as books are finished or added; 0 to disable",
+        )
+        WEBHOOK_HOST: str = Field(
+            default="127.0.0.1",
+            description="Address to receive Plex webhooks on; '0.0.0.0' to receive them from other hosts",
+        )
+        WEBHOOK_SECRET: str = Field(
+            default=os.getenv("PLEX_WEBHOOK_SECRET", ""),
+            description="Shared secret that Plex must pass as the 'token' query parameter of the webhook URL; required to receive webhooks",
+        )
+        USER_PLEX_HOSTS: str = Field(
+            default="",
+            description="Comma-separated hosts (e.g. 'plex.example.com' or '192.168.1.2:32400') that users may set as their own PLEX_BASE_URL; empty to only allow the default server",
+        )
+
+    class UserValves(BaseModel):
+        PLEX_BASE_URL: str = Field(
+            default="",
+            description="The base URL of your Plex server, if not the default one; must be on a host allowed by the administrator",
+        )
+        PLEX_TOKEN: str = Field(
+            default="",
+            description="Your token to authenticate with the Plex server; required if PLEX_BASE_URL is set",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
-        init_plex_client(self.valves.PLEX_BASE_URL, self.valves.PLEX_TOKEN)
+        # Port of the webhook listener started for the valves, to stop it
+        # once they change.
+        self._webhook_port = 0
+
+    def _client(self, __user__: Optional[dict]) -> PlexClient:
+        """
+        Return the client for the user's Plex server, falling back to the
+        default one. The default token is only ever sent to the default
+        server, so users with their own server must set their own token.
+        """
+        self._listen_for_webhooks()
+        user_valves = (__user__ or {}).get("valves")
+        base_url = getattr(user_valves, "PLEX_BASE_URL", "")
+        token = getattr(user_valves, "PLEX_TOKEN", "")
+        if not base_url:
+            return PlexClient.for_server(
+                self.valves.PLEX_BASE_URL, token or self.valves.PLEX_TOKEN
+            )
+        self._check_user_base_url(base_url)
+        if not token:
+            raise ValueError(
+                "The PLEX_TOKEN user valve must be set along with the PLEX_BASE_URL user valve"
+            )
+        return PlexClient.for_server(base_url, token)
+
+    def _check_user_base_url(self, base_url: str) -> None:
+        """
+        Make sure a user-provided server URL is on a host allowed by the
+        USER_PLEX_HOSTS valve, so that users cannot make the server send
+        requests to arbitrary hosts.
+        """
+        allowed_hosts = {
+            host.strip().lower()
+            for host in self.valves.USER_PLEX_HOSTS.split(",")
+            if host.strip()
+        }
+        parsed = urllib.parse.urlsplit(base_url)
+        try:
+            port = parsed.port
+        except ValueError:
+            port = None
+        host = (parsed.hostname or "").lower()
+        if parsed.scheme not in ("http", "https") or not host:
+            raise ValueError(f"Invalid PLEX_BASE_URL user valve: {base_url}")
+        if host not in allowed_hosts and f"{host}:{port}" not in allowed_hosts:
+            raise ValueError(
+                f"The PLEX_BASE_URL user valve must be on a host allowed by the administrator, not {parsed.netloc}"
+            )
+
+    def _listen_for_webhooks(self) -> None:
+        """
+        Start the webhook listener in the background if enabled, keeping it
+        in line with the valves: the secret is updated in place, while a
+        change of host or port restarts it.
+        """
+        host = self.valves.WEBHOOK_HOST
+        secret = self.valves.WEBHOOK_SECRET
+        # Webhooks cannot be received without a secret.
+        port = self.valves.WEBHOOK_PORT if secret else 0
+        if port != self._webhook_port:
+            previous = WebhookListener._listeners.get(self._webhook_port)
+            if previous is not None:
+                asyncio.ensure_future(previous.stop())
+            self._webhook_port = port
+        if not port:
+            return
+        listener = WebhookListener._listeners.get(port)
+        if listener is not None and listener.host == host:
+            listener.secret = secret
+            return
+
+        def report_error(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is not None:
+                print(
+                    f"Error starting Plex webhook listener: {task.exception()}",
+                    file=sys.stderr,
+                )
+
+        task = asyncio.ensure_future(WebhookListener.start(host, port, secret))
+        task.add_done_callback(report_error)
+
+    def _format(
+        self,
+        rows: typing.Sequence[Any],
+        columns: typing.Sequence[str],
+        cursor: int = 0,
+    ) -> str:
+        """
+        Render the rows of a tool result from `cursor` on, in the configured output format.
+        Rows are dicts or metadata records; records are only converted as they are rendered.
+        """
+        cursor = max(0, cursor)
+        shown = (
+            row if isinstance(row, dict) else record_dict(row)
+            for row in itertools.islice(rows, cursor, None)
+        )
+        if self.valves.OUTPUT_FORMAT == "json":
+            return json.dumps(list(shown), indent=2)
+        return format_rows(
+            shown,
+            columns,
+            self.valves.MAX_OUTPUT_TOKENS,
+            offset=cursor,
+            total=len(rows),
+        )
 
     async def fetch_authors(
-        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self,
+        cursor: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
     ) -> str:
-        """Fetches metadata for all authors from the Plex server."""
+        """Fetches metadata for all authors from the Plex server.
+
+        Args:
+            cursor: Index of the first author to return, to continue a cut-off result (default: 0)
+        """
         try:
-            authors = await PlexClient.get_all_author_metadata(__event_emitter__)
-            authors_data = [filter_metadata(author.__dict__) for author in authors]
-            return json.dumps(authors_data, indent=2)
+            index = await self._client(__user__).get_library_index(__event_emitter__)
+            authors = index.authors_by_key.values()
+            authors_data = [filter_metadata(record_dict(author)) for author in authors]
+            for author in authors_data:
+                author["lastViewedAt"] = convert_timestamp(author.get("lastViewedAt"))
+            return self._format(authors_data, AUTHOR_COLUMNS, cursor)
         except Exception as e:
             raise Exception(f"Error fetching authors: {str(e)}")
 
     async def fetch_books(
-        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self,
+        cursor: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
     ) -> str:
-        """Fetches metadata for all audiobooks from the Plex server."""
+        """Fetches metadata for all audiobooks from the Plex server.
+
+        Args:
+            cursor: Index of the first book to return, to continue a cut-off result (default: 0)
+        """
         try:
-            compiled_data = await PlexClient.get_all_metadata(__event_emitter__)
-            return json.dumps([book.__dict__ for book in compiled_data], indent=2)
+            compiled_data = await self._client(__user__).get_all_metadata(
+                __event_emitter__
+            )
+            return self._format(compiled_data, BOOK_COLUMNS, cursor)
         except Exception as e:
             raise Exception(f"Error fetching books: {str(e)}")
 
     async def fetch_all_data(
-        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self,
+        cursor: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
     ) -> str:
-        """Fetches metadata for all authors and audiobooks from the Plex server."""
+        """Fetches metadata for all authors and audiobooks from the Plex server.
+
+        Args:
+            cursor: Index of the first book to return, to continue a cut-off result (default: 0)
+        """
         try:
-            compiled_data = await PlexClient.get_all_metadata(__event_emitter__)
-            compiled_data = [data.__dict__ for data in compiled_data]
-            return json.dumps(compiled_data, indent=2)
+            compiled_data = await self._client(__user__).get_all_metadata(
+                __event_emitter__
+            )
+            return self._format(compiled_data, BOOK_COLUMNS, cursor)
         except Exception as e:
             raise Exception(f"Error fetching all data: {str(e)}")
 
     async def fetch_recent_books(
-        self, n: int = 20, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self,
+        n: int = 20,
+        cursor: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
     ) -> str:
         """Fetches metadata for the n most recently viewed audiobooks from the Plex server.
 
         Args:
             n: Number of recent books to return (default: 20)
+            cursor: Index of the first book to return, to continue a cut-off result (default: 0)
             __event_emitter__: Optional event emitter for status updates
 
         Returns:
-            JSON string containing an array of CompiledData objects, sorted by viewCount,
-            including only books that have been completed at least once.
+            Table of books, most recently viewed first, including only books that
+            have been completed at least once.
         """
         try:
-            all_data = await PlexClient.get_all_metadata(__event_emitter__)
-            # Sort by viewCount descending and take top n
-            recent_books = sorted(
-                [book for book in all_data if book.viewCount and book.viewCount > 0],
-                key=lambda x: x.viewCount,
-                reverse=True,
-            )[:n]
-            return json.dumps([book.__dict__ for book in recent_books], indent=2)
+            index = await self._client(__user__).get_library_index(__event_emitter__)
+            recent_books = index.views["recently_read"][: max(0, n)]
+            return self._format(recent_books, BOOK_COLUMNS, cursor)
         except Exception as e:
             raise Exception(f"Error fetching recent books: {str(e)}")
 
     async def fetch_unread_books(
-        self, __event_emitter__: typing.Callable[[dict], typing.Any] = None
+        self,
+        cursor: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
     ) -> str:
         """Fetches metadata for all unread audiobooks from the Plex server.
 
         Args:
+            cursor: Index of the first book to return, to continue a cut-off result (default: 0)
             __event_emitter__: Optional event emitter for status updates
 
         Returns:
-            JSON string containing an array of CompiledData objects for unread books,
-            sorted alphabetically by title.
+            Table of unread books, sorted alphabetically by title.
         """
         try:
-            all_data = await PlexClient.get_all_metadata(__event_emitter__)
-            # Filter for unread books only
-            unread_books = [
-                book
-                for book in all_data
-                if book.viewCount is None or book.viewCount == 0
-            ]
-            # Sort alphabetically by title
-            unread_books.sort(key=lambda x: x.title.lower())
-            return json.dumps([book.__dict__ for book in unread_books], indent=2)
+            index = await self._client(__user__).get_library_index(__event_emitter__)
+            return self._format(index.views["unread"], BOOK_COLUMNS, cursor)
         except Exception as e:
             raise Exception(f"Error fetching unread books: {str(e)}")
 
+    async def search_books(
+        self,
+        query: str = "",
+        author: str = "",
+        genre: str = "",
+        year_from: Optional[int] = None,
+        year_to: Optional[int] = None,
+        read_status: str = "any",
+        author_min_read_books: Optional[int] = None,
+        sort_by: str = "title",
+        limit: int = 20,
+        offset: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
+    ) -> str:
+        """Searches the audiobooks of the Plex server and returns only the matching ones.
+        Prefer this over fetching all books whenever the question is about specific books.
+
+        Args:
+            query: Words to look for in titles, author names, summaries and genres (optional)
+            author: Only books by authors whose name contains this (optional)
+            genre: Only books with this exact genre, e.g. "Science Fiction" (optional)
+            year_from: Only books published in or after this year (optional)
+            year_to: Only books published in or before this year (optional)
+            read_status: "read" for books completed at least once, "unread" for the others, "any" for both (default: "any")
+            author_min_read_books: Only books by authors with at least this many books read (optional)
+            sort_by: "title", "year", "last_viewed" or "view_count" (default: "title")
+            limit: Maximum number of books to return (default: 20)
+            offset: Number of matching books to skip, to page through results (default: 0)
+
+        Returns:
+            Table of the requested page of matching books, and their total number.
+        """
+        try:
+            database = await self._client(__user__).get_library_database(
+                __event_emitter__
+            )
+            total, books = database.search_books(
+                query=query,
+                author=author,
+                genre=genre,
+                year_from=year_from,
+                year_to=year_to,
+                read={"read": True, "unread": False}.get(read_status.lower()),
+                author_min_read_books=author_min_read_books,
+                sort_by=sort_by,
+                limit=max(1, min(limit, 200)),
+                offset=max(0, offset),
+            )
+            if self.valves.OUTPUT_FORMAT == "json":
+                return json.dumps(
+                    {"total": total, "offset": offset, "books": books}, indent=2
+                )
+            return format_rows(
+                books,
+                BOOK_COLUMNS,
+                self.valves.MAX_OUTPUT_TOKENS,
+                offset=max(0, offset),
+                total=total,
+                cursor_name="offset",
+            )
+        except Exception as e:
+            raise Exception(f"Error searching books: {str(e)}")
+
+    async def search_authors(
+        self,
+        query: str = "",
+        min_read_books: Optional[int] = None,
+        sort_by: str = "title",
+        limit: int = 20,
+        offset: int = 0,
+        __user__: Optional[dict] = None,
+        __event_emitter__: typing.Callable[[dict], typing.Any] = None,
+    ) -> str:
+        """Searches the audiobook authors of the Plex server, with how many of their books there are and have been read.
+
+        Args:
+            query: Words to look for in author names (optional)
+            min_read_books: Only authors with at least this many books read (optional)
+            sort_by: "title", "books" or "read_books" (default: "title")
+            limit: Maximum number of authors to return (default: 20)
+            offset: Number of matching authors to skip, to page through results (default: 0)
+
+        Returns:
+            Table of the requested page of matching authors, and their total number.
+        """
+        try:
+            database = await self._client(__user__).get_library_database(
+                __event_emitter__
+            )
+            total, authors = database.search_authors(
+                query=query,
+                min_read_books=min_read_books,
+                sort_by=sort_by,
+                limit=max(1, min(limit, 200)),
+                offset=max(0, offset),
+            )
+            if self.valves.OUTPUT_FORMAT == "json":
+                return json.dumps(
+                    {"total": total, "offset": offset, "authors": authors}, indent=2
+                )
+            return format_rows(
+                authors,
+                AUTHOR_SEARCH_COLUMNS,
+                self.valves.MAX_OUTPUT_TOKENS,
+                offset=max(0, offset),
+                total=total,
+                cursor_name="offset",
+            )
+        except Exception as e:
+            raise Exception(f"Error searching authors: {str(e)}")
+
+
+# Columns shown by the tools in compact output, in order.
+BOOK_COLUMNS = ("title", "author", "year", "viewCount", "lastViewedAt", "genres")
+AUTHOR_COLUMNS = ("title", "viewCount", "lastViewedAt", "Genre")
+AUTHOR_SEARCH_COLUMNS = ("author", "books", "readBooks", "viewCount")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough number of LLM tokens in `text`, at about four characters per token."""
+    return (len(text) + 3) // 4
+
+
+def format_cell(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return ", ".join(format_cell(v) for v in value)
+    # Keep each row on one line, and each cell in its column.
+    return " ".join(str(value).split())
+
+
+def format_rows(
+    rows: typing.Iterable[Dict[str, Any]],
+    columns: typing.Sequence[str],
+    max_tokens: int,
+    offset: int = 0,
+    total: Optional[int] = None,
+    cursor_name: str = "cursor",
+) -> str:
+    """
+    Render rows compactly for an LLM: a header line of column names, then one
+    tab-separated line per row with only the given columns.
+
+    Rows are rendered until the next one would exceed `max_tokens`, and a
+    final line tells how many rows remain and how to get them.
+
+    :param rows: Rows to render, starting at position `offset` of the whole result.
+        Only the rows that are rendered are consumed.
+    :param total: Number of rows in the whole result, if more than `offset + len(rows)`.
+    :param cursor_name: Name of the tool argument that selects the first row.
+    """
+    if total is None:
+        total = offset + len(rows)
+    lines = ["\t".join(columns)]
+    # Leave room for the final line.
+    remaining_tokens = max_tokens - estimate_tokens(lines[0]) - 32
+    num_shown = 0
+    for row in rows:
+        line = "\t".join(format_cell(row.get(column)) for column in columns)
+        remaining_tokens -= estimate_tokens(line) + 1
+        if remaining_tokens < 0 and num_shown > 0:
+            break
+        lines.append(line)
+        num_shown += 1
+    if offset + num_shown < total:
+        lines.append(
+            f"# Rows {offset + 1}-{offset + num_shown} of {total}; "
+            f"call again with {cursor_name}={offset + num_shown} for more."
+        )
+    else:
+        lines.append(f"# {total} rows.")
+    return "\n".join(lines)
+
 
 def convert_view_count(view_count: Optional[int]) -> Optional[str]:
     """Convert view count to a readable status."""
@@ -491,3 +1918,279 @@ def convert_timestamp(unix_timestamp: Optional[int]) -> Optional[str]:
         return local_time.strftime("%Y-%m-%d")
     except (ValueError, TypeError):
         return None
+
+
+def synthetic_library(
+    num_authors: int = 4000, num_books: int = 15000, seed: int = 0
+) -> typing.Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Generate author and book metadata shaped like Plex responses, for benchmarks."""
+    rng = random.Random(seed)
+    genres = ["Science Fiction", "Fantasy", "History", "Biography", "Mystery"]
+    authors = []
+    for i in range(num_authors):
+        authors.append(
+            {
+                "title": f"Author {i}",
+                "ratingKey": str(100000 + i),
+                "key": f"/library/metadata/{100000 + i}/children",
+                "guid": f"plex://artist/{i:024x}",
+                "type": "artist",
+                "summary": f"Biography of author {i}.",
+                "addedAt": 1600000000 + i,
+                "updatedAt": 1600000000 + i,
+            }
+        )
+    books = []
+    for i in range(num_books):
+        author = authors[rng.randrange(num_authors)]
+        view_count = rng.choice([None, None, 1, 2, 3])
+        books.append(
+            {
+                "ratingKey": str(200000 + i),
+                "key": f"/library/metadata/{200000 + i}/children",
+                "parentRatingKey": author["ratingKey"],
+                "guid": f"plex://album/{i:024x}",
+                "parentGuid": author["guid"],
+                "type": "album",
+                "title": f"Book {i}",
+                "parentKey": f"/library/metadata/{author['ratingKey']}",
+                "parentTitle": author["title"],
+                "summary": f"Summary of book {i}. " * 20,
+                "index": 1,
+                "year": rng.randrange(1950, 2025),
+                "addedAt": 1600000000 + i,
+                "updatedAt": 1600000000 + i,
+                "lastViewedAt": (
+                    1700000000 + rng.randrange(10**7) if view_count else 0
+                ),
+                "viewCount": view_count,
+                "Genre": [
+                    {"id": g, "filter": f"genre={g}", "tag": genres[g]}
+                    for g in rng.sample(range(len(genres)), 2)
+                ],
+                "librarySectionID": 7,
+                "librarySectionTitle": "Audiobooks",
+                "librarySectionUUID": "1f2e3d4c-5b6a-7980-a1b2-c3d4e5f60718",
+                "thumb": f"/library/metadata/{200000 + i}/thumb/1700000000",
+                "parentThumb": f"/library/metadata/{author['ratingKey']}/thumb/1700000000",
+                "leafCount": 30,
+                "studio": "Audible Studios",
+                "Image": [
+                    {
+                        "alt": f"Book {i}",
+                        "type": "coverPoster",
+                        "url": f"/library/metadata/{200000 + i}/thumb/1700000000",
+                    }
+                ],
+                "UltraBlurColors": {
+                    "topLeft": "1a2b3c",
+                    "topRight": "4d5e6f",
+                    "bottomRight": "7a8b9c",
+                    "bottomLeft": "0d1e2f",
+                },
+                "Media": [
+                    {
+                        "id": 300000 + i,
+                        "duration": 36000000,
+                        "bitrate": 64,
+                        "audioChannels": 2,
+                        "audioCodec": "aac",
+                        "container": "m4b",
+                        "Part": [
+                            {
+                                "id": 400000 + i,
+                                "key": f"/library/parts/{400000 + i}/file.m4b",
+                                "duration": 36000000,
+                                "file": f"/data/audiobooks/{author['title']}/Book {i}/book.m4b",
+                                "size": 300000000,
+                                "container": "m4b",
+                            }
+                        ],
+                    }
+                ],
+            }
+        )
+    return authors, books
+
+
+def benchmark(num_authors: int = 4000, num_books: int = 15000) -> None:
+    """Time joining a synthetic library of the given size."""
+    author_items, book_items = synthetic_library(num_authors, num_books)
+    print(f"Synthetic library: {num_authors} authors, {num_books} books")
+
+    # Memory held by the cached records and index, built from parsed JSON the
+    # way PlexClient does; the response text itself is freed once parsed.
+    raw_authors, raw_books = json.dumps(author_items), json.dumps(book_items)
+    del author_items, book_items
+    gc.collect()
+    tracemalloc.start()
+    authors = [from_plex_item(AuthorMetadata, item) for item in json.loads(raw_authors)]
+    books = [from_plex_item(AudiobookMetadata, item) for item in json.loads(raw_books)]
+    gc.collect()
+    LibraryIndex(authors, books)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"  Cached records + index: {held / 1e6:.1f} MB "
+        f"({held / num_books:.0f} bytes/book)"
+    )
+
+    started_at = time.perf_counter()
+    scanned = []
+    for book in books:
+        author = next((a for a in authors if a.ratingKey == book.parentRatingKey), None)
+        if author:
+            scanned.append((book.ratingKey, author.ratingKey))
+    scan_seconds = time.perf_counter() - started_at
+    print(f"  Join by scanning authors: {scan_seconds * 1000:.1f} ms")
+
+    started_at = time.perf_counter()
+    index = LibraryIndex(authors, books)
+    index_seconds = time.perf_counter() - started_at
+    print(f"  LibraryIndex (join + sort): {index_seconds * 1000:.1f} ms")
+
+    assert sorted(scanned) == sorted(
+        (book.ratingKey, book.authorRatingKey) for book in index.books
+    ), "Indexed join disagrees with scanning join"
+
+    started_at = time.perf_counter()
+    for book in books:
+        index.books_by_key[book.ratingKey]
+    lookup_seconds = time.perf_counter() - started_at
+    print(
+        f"  Book lookups on the index: {lookup_seconds / len(books) * 1e9:.0f} ns/lookup"
+    )
+
+    # Selecting the books of a tool call from a sorted view, against
+    # filtering and sorting all books on each call; and rendering them.
+    def median_seconds(call: Callable[[], Any], runs: int = 21) -> float:
+        timings = []
+        for _ in range(runs):
+            started_at = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started_at)
+        return sorted(timings)[runs // 2]
+
+    calls = {
+        "fetch_recent_books(n=20)": (
+            lambda: sorted(
+                (book for book in index.books if book.viewCount),
+                key=lambda book: index.records[book.ratingKey].lastViewedAt,
+                reverse=True,
+            )[:20],
+            lambda: index.views["recently_read"][:20],
+        ),
+        "fetch_unread_books()": (
+            lambda: sorted(
+                (book for book in index.books if not book.viewCount),
+                key=lambda book: book.title.lower(),
+            ),
+            lambda: index.views["unread"],
+        ),
+    }
+    tools = Tools()
+    print("  Tool calls (selecting books by sorting -> from a view; rendering):")
+    for name, (sort_books, view_books) in calls.items():
+        assert sort_books() == view_books(), f"{name}: view disagrees with sorting"
+        print(
+            f"    {name}: {median_seconds(sort_books) * 1000:.2f} ms -> "
+            f"{median_seconds(view_books) * 1000:.3f} ms; "
+            f"{median_seconds(lambda: tools._format(view_books(), BOOK_COLUMNS)) * 1000:.2f} ms"
+        )
+
+    updated = [
+        dataclasses.replace(book, viewCount=(book.viewCount or 0) + 1)
+        for book in books[:10]
+    ]
+    started_at = time.perf_counter()
+    index.update([], updated)
+    update_seconds = time.perf_counter() - started_at
+    print(
+        f"  Merging {len(updated)} updated books into the views: {update_seconds * 1000:.1f} ms"
+    )
+    assert (
+        index.views == LibraryIndex(authors, books[10:] + updated).views
+    ), "Merged index disagrees with rebuilt index"
+
+    # Size of tool output per book, in bytes and in tokens as counted by the
+    # tokenizer of OpenAI models if available, or estimated otherwise.
+    count_tokens, tokenizer = estimate_tokens, "estimated"
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        count_tokens = lambda text: len(encoding.encode(text))
+        tokenizer = "cl100k_base"
+    except Exception:
+        pass  # Not installed, or its encoding cannot be downloaded.
+    rows = [record_dict(book) for book in index.books]
+    outputs = {
+        "JSON (indent=2, all fields)": json.dumps(rows, indent=2),
+        "Compact (tab-separated, projected)": format_rows(
+            rows, BOOK_COLUMNS, max_tokens=sys.maxsize
+        ),
+    }
+    print(f"  Tool output per book ({tokenizer} tokens):")
+    for name, output in outputs.items():
+        print(
+            f"    {name}: {len(output.encode('utf-8')) / len(rows):.1f} bytes, "
+            f"{count_tokens(output) / len(rows):.1f} tokens"
+        )
+    budgeted = format_rows(rows, BOOK_COLUMNS, max_tokens=4000)
+    print(
+        f"    Compact within a 4000-token budget: {len(budgeted.splitlines()) - 2} books, "
+        f"{count_tokens(budgeted)} tokens"
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Plex audiobook library tool.")
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Benchmark library operations on a synthetic library instead of querying Plex.",
+    )
+    parser.add_argument("--authors", type=int, default=4000)
+    parser.add_argument("--books", type=int, default=15000)
+    parser.add_argument(
+        "--listen",
+        type=int,
+        metavar="PORT",
+        help="Cache the library and keep it patched from Plex webhooks received on this port.",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="With --listen, the address to listen on.",
+    )
+    parser.add_argument(
+        "--secret",
+        default=os.getenv("PLEX_WEBHOOK_SECRET", ""),
+        help="Shared secret of the webhook listener, passed as the 'token' query parameter (default: PLEX_WEBHOOK_SECRET environment variable).",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="With --listen, append received webhook payloads to this file.",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="Post the webhook payloads recorded in this file to --webhook-url, like Plex would.",
+    )
+    parser.add_argument(
+        "--webhook-url", default=f"http://localhost:32500{WebhookListener.PATH}"
+    )
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(num_authors=args.authors, num_books=args.books)
+    elif args.listen:
+        asyncio.run(
+            listen_for_webhooks(args.host, args.listen, args.secret, args.record)
+        )
+    elif args.replay:
+        asyncio.run(replay_webhooks(args.replay, args.webhook_url, args.secret))
+    else:
+        asyncio.run(main())
@@ -36,7 +36,6 @@ license: Apache-2.0
 #
 
 import asyncio
-import argparse
 import json
 import os
 import os.path
@@ -44,25 +43,24 @@ import pydantic
 import subprocess
 import sys
 import tempfile
+import types
 import typing
 import inspect
 import uuid
 import base64
-import ctypes
-import ctypes.util
 import copy
+import fcntl
 import hashlib
 import platform
 import re
 import shutil
+import selectors
 import signal
 import socket
 import struct
 import threading
 import time
-import urllib.request
 import datetime
-import urllib.error
 
 
 class _Tools:
@@ -82,6 +80,11 @@ class _Tools:
             default=128,
             description=f"Maximum number of megabytes that the interpreter has when running. Must run as root with host cgroups writable (`--mount=type=bind,source=/sys/fs/cgroup,target=/sys/fs/cgroup,readonly=false`) for this to work. Set to 0 to disable memory limits. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}MAX_RAM_MEGABYTES",
         )
+        MAX_OUTPUT_KILOBYTES: int = pydantic.Field(
+            ge=1,
+            default=1024,
+            description=f"Maximum number of kilobytes kept from each of the standard output and error streams of the code; the middle of longer output is left out. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}MAX_OUTPUT_KILOBYTES.",
+        )
         REQUIRE_RESOURCE_LIMITING: bool = pydantic.Field(
             default=True,
             description=f"Whether to enforce resource limiting, which requires cgroups v2 to be available; may be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}REQUIRE_RESOURCE_LIMITING.",
@@ -92,7 +95,32 @@ class _Tools:
         )
         CHECK_FOR_UPDATES: bool = pydantic.Field(
             default=True,
-            description=f"Whether to automatically check for updates; may be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}CHECK_FOR_UPDATES. Use the 'HTTPS_PROXY' environment variable to control the proxy used for update checks.",
+            description=f"Whether to automatically check for updates; may be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}CHECK_FOR_UPDATES. Checks run in the background and never delay code execution. Use the 'HTTPS_PROXY' environment variable to control the proxy used for update checks, or enable UPDATE_CHECK_OFFLINE to never access the network for them.",
+        )
+        UPDATE_CHECK_OFFLINE: bool = pydantic.Field(
+            default=False,
+            description=f"Whether to never access the network to check for updates, and only use the result of a check already done by another process of the same user. Setting the 'CODE_EVAL_UPDATE_CHECK_OFFLINE' environment variable to 'true' has the same effect. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}UPDATE_CHECK_OFFLINE.",
+        )
+        MAX_CONCURRENT_SANDBOXES: int = pydantic.Field(
+            ge=1,
+            default=8,
+            description=f"Maximum number of sandboxes allowed to run at the same time on this host, across all users, tools and functions; further executions wait in a queue that is fair across users. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}MAX_CONCURRENT_SANDBOXES.",
+        )
+        TELEMETRY_PROMETHEUS_TEXTFILE_PATH: str = pydantic.Field(
+            default="",
+            description=f"If set, write code execution metrics (time spent in each phase, CPU and peak memory usage, output size) to this file in the Prometheus text format after every execution, e.g. for node_exporter's textfile collector. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}TELEMETRY_PROMETHEUS_TEXTFILE_PATH.",
+        )
+        TELEMETRY_OPENTELEMETRY: bool = pydantic.Field(
+            default=False,
+            description=f"Whether to export each code execution as an OpenTelemetry trace with one span per phase; requires the 'opentelemetry-api' package and a tracer provider configured in Open WebUI. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}TELEMETRY_OPENTELEMETRY.",
+        )
+        PREINSTALLED_PACKAGES: str = pydantic.Field(
+            default="",
+            description=f"Comma-separated list of pip requirement specifiers (e.g. 'numpy, pandas>=2') of Python packages that code can import without installing them. They are installed on the host the first time they are needed, which may take a while, then made available read-only to every sandbox. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}PREINSTALLED_PACKAGES.",
+        )
+        PACKAGE_CACHE_PATH: str = pydantic.Field(
+            default="$DATA_DIR/cache/functions/run_code/packages",
+            description=f"Path of the directory in which packages listed in PREINSTALLED_PACKAGES are installed. If it begins by '$DATA_DIR', this will be replaced with the DATA_DIR environment variable. May be overridden by environment variable {_VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX}PACKAGE_CACHE_PATH.",
         )
         DEBUG: bool = pydantic.Field(
             default=False,
@@ -117,6 +145,8 @@ class _Tools:
                     override = override.lower() == "true"
                 elif type(valve_value) is type(42):
                     override = int(override)
+                elif type(valve_value) is type(""):
+                    pass
                 else:
                     valve_value_type = type(valve_value)
                     raise ValueError(f"Unknown valve type: {valve_value_type}")
@@ -131,6 +161,7 @@ class _Tools:
         self,
         bash_command: str,
         __event_emitter__: typing.Callable[[dict], typing.Any] = None,
+        __user__: typing.Optional[dict] = None,
     ) -> str:
         """
         Run a bash command-line or script safely in a gVisor sandbox.
@@ -143,6 +174,7 @@ class _Tools:
             language=Sandbox.LANGUAGE_BASH,
             code=bash_command,
             event_emitter=__event_emitter__,
+            user=__user__,
         )
         return json.dumps(
             {
@@ -157,6 +189,7 @@ class _Tools:
         self,
         python_code: str,
         __event_emitter__: typing.Callable[[dict], typing.Any] = None,
+        __user__: typing.Optional[dict] = None,
     ) -> str:
         """
         Run Python code safely in a gVisor sandbox.
@@ -169,6 +202,7 @@ class _Tools:
             language=Sandbox.LANGUAGE_PYTHON,
             code=python_code,
             event_emitter=__event_emitter__,
+            user=__user__,
         )
         return json.dumps(
             {
@@ -184,6 +218,7 @@ class _Tools:
         language: str,
         code: str,
         event_emitter: typing.Callable[[dict], typing.Any] = None,
+        user: typing.Optional[dict] = None,
     ) -> str:
         """
         Run code safely in a gVisor sandbox.
@@ -191,6 +226,7 @@ class _Tools:
         :param language: Programming language of the code.
         :param code: The code to run.
         :param event_emitter: Event emitter to send status updates to.
+        :param user: The Open WebUI user running the code, used for fair queueing.
 
         :return: A dictionary with the following fields: `status`, `output`.
         """
@@ -200,10 +236,10 @@ class _Tools:
         execution_tracker: typing.Optional[CodeExecutionTracker] = None
 
         if valves.CHECK_FOR_UPDATES:
-            if UpdateCheck.need_check():
-                await emitter.status("Checking for updates...")
             try:
-                newer_version = UpdateCheck.get_newer_version()
+                newer_version = UpdateCheck.get_newer_version(
+                    offline=valves.UPDATE_CHECK_OFFLINE
+                )
             except UpdateCheck.VersionCheckError as e:
                 emitter.set_status_prefix(f"[Code execution update check failed: {e}] ")
             else:
@@ -219,6 +255,7 @@ class _Tools:
             if execution_tracker is not None:
                 execution_tracker.set_error(error_message)
                 await emitter.code_execution(execution_tracker)
+                await self._record_telemetry(execution_tracker, status)
             if debug:
                 await emitter.fail(
                     f"[DEBUG MODE] {error_message}; language={language}; code={code}; valves=[{valves}]"
@@ -242,6 +279,8 @@ class _Tools:
                 await emitter.status("Auto-installing gVisor...")
                 Sandbox.install_runsc()
 
+            package_cache_dir = await self._package_cache_dir(emitter)
+
             status = "UNKNOWN"
             output = None
             language_title = language.title()
@@ -275,10 +314,19 @@ class _Tools:
                     max_ram_bytes=max_ram_bytes,
                     require_resource_limiting=valves.REQUIRE_RESOURCE_LIMITING,
                     persistent_home_dir=None,
+                    max_output_bytes=valves.MAX_OUTPUT_KILOBYTES * 1024,
+                    package_cache_dir=package_cache_dir,
                 )
 
                 try:
-                    result = sandbox.run()
+                    admission = AdmissionController.get(valves.MAX_CONCURRENT_SANDBOXES)
+                    async with admission.admit(
+                        user_id=(user or {}).get("id"), emitter=emitter
+                    ) as admitted:
+                        execution_tracker.add_phase_timing(
+                            "queue", admitted.queue_seconds
+                        )
+                        result = await asyncio.to_thread(sandbox.run)
                 except Sandbox.ExecutionTimeoutError as e:
                     await emitter.fail(
                         f"Code timed out after {valves.MAX_RUNTIME_SECONDS} seconds"
@@ -304,6 +352,8 @@ class _Tools:
                     await emitter.message(
                         f"\n<details>\n<summary>Code Execution</summary>\nI executed the following {language} code:\n```{language}\n{code}\n```\n```Output\n{output.strip()}\n```\n</details>\n"
                     )
+                finally:
+                    execution_tracker.record_sandbox(sandbox)
                 if output:
                     output = output.strip()
                     execution_tracker.set_output(output)
@@ -323,6 +373,7 @@ class _Tools:
                         description=f"[DEBUG MODE] status={status}; output={output}; valves=[{valves}]; debug={per_file_logs}",
                     )
             await emitter.code_execution(execution_tracker)
+            await self._record_telemetry(execution_tracker, status)
             return {
                 "status": status,
                 "output": output,
@@ -338,6 +389,36 @@ class _Tools:
         except Exception as e:
             return await _fail(f"Unhandled exception: {e}")
 
+    async def _package_cache_dir(self, emitter):
+        """
+        Make sure the packages listed in the PREINSTALLED_PACKAGES valve are
+        installed in the package cache.
+
+        :return: The directory to mount in sandboxes, or `None` if no packages are configured.
+        """
+        requirements = PackageCache.parse_requirements(
+            self.valves.PREINSTALLED_PACKAGES
+        )
+        if not requirements:
+            return None
+        package_cache = PackageCache(self.valves.PACKAGE_CACHE_PATH, requirements)
+        if not package_cache.ready():
+            await emitter.status("Installing Python packages (only needed once)...")
+        return await asyncio.to_thread(package_cache.ensure)
+
+    async def _record_telemetry(self, execution_tracker, status):
+        """
+        Add a finished code execution to the process-wide telemetry, and export
+        it as configured by the valves.
+        """
+        await asyncio.to_thread(
+            ExecutionTelemetry.record,
+            execution_tracker,
+            status,
+            prometheus_textfile_path=self.valves.TELEMETRY_PROMETHEUS_TEXTFILE_PATH,
+            opentelemetry=self.valves.TELEMETRY_OPENTELEMETRY,
+        )
+
 
 class Tools:
     Valves = _Tools.Valves
@@ -349,6 +430,7 @@ class Tools:
         self,
         bash_command: str,
         __event_emitter__: typing.Callable[[dict], typing.Any] = None,
+        __user__: typing.Optional[dict] = None,
     ) -> str:
         """
         Run a bash command-line or script safely in a gVisor sandbox.
@@ -360,12 +442,14 @@ class Tools:
         return await _Tools(self.valves).run_bash_command(
             bash_command=bash_command,
             __event_emitter__=__event_emitter__,
+            __user__=__user__,
         )
 
     async def run_python_code(
         self,
         python_code: str,
         __event_emitter__: typing.Callable[[dict], typing.Any] = None,
+        __user__: typing.Optional[dict] = None,
     ) -> str:
         """
         Run Python code safely in a gVisor sandbox.
@@ -377,6 +461,7 @@ class Tools:
         return await _Tools(self.valves).run_python_code(
             python_code=python_code,
             __event_emitter__=__event_emitter__,
+            __user__=__user__,
         )
 
 
@@ -484,12 +569,28 @@ class CodeExecutionTracker:
         self.code = code
         self.language = language
         self._result = {}
+        self._telemetry = {}
+        self._telemetry_recorded = False
 
     def set_error(self, error):
         self._result["error"] = error
 
     def set_output(self, output):
         self._result["output"] = output
+        self._telemetry["output_bytes"] = len((output or "").encode("utf-8"))
+
+    def add_phase_timing(self, phase, seconds):
+        phases = self._telemetry.setdefault("phases", {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def record_sandbox(self, sandbox):
+        """Record the phase timings and resource usage of the last run of `sandbox`."""
+        for phase, seconds in sandbox.timings().items():
+            self.add_phase_timing(phase, seconds)
+        self._telemetry.update(sandbox.resource_usage())
+
+    def telemetry(self):
+        return copy.deepcopy(self._telemetry)
 
     def add_file(self, name, url):
         if "files" not in self._result:
@@ -511,9 +612,904 @@ class CodeExecutionTracker:
         }
         if "output" in self._result or "error" in self._result:
             data["result"] = self._result
+        if self._telemetry:
+            data["telemetry"] = self._telemetry
         return data
 
 
+class ExecutionTelemetry:
+    """
+    Process-wide aggregate of the telemetry of finished code executions.
+
+    It can be exported in the Prometheus text exposition format, to a file
+    picked up by node_exporter's textfile collector. If the `opentelemetry-api`
+    package is installed, each execution can also be exported as a trace.
+    """
+
+    # Upper bounds of the phase histogram buckets, in seconds; a +Inf bucket follows.
+    PHASE_BUCKETS_SECONDS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    # Upper bounds of the peak memory histogram buckets, in bytes; a +Inf bucket follows.
+    MEMORY_PEAK_BUCKETS_BYTES = tuple(2**i * 1024 * 1024 for i in range(4, 13))
+
+    # Phases of a code execution in the order in which they happen. Used to
+    # lay out trace spans end to end, since only their durations are known.
+    PHASES = (
+        "queue",
+        "setup",
+        "switcheroo",
+        "runsc_spawn",
+        "first_connect",
+        "eval",
+        "copy_out",
+        "shutdown",
+        "storage",
+    )
+
+    _LOCK = threading.Lock()
+    _PHASE_HISTOGRAMS = {}
+    _MEMORY_PEAK_HISTOGRAM = None
+    _EXECUTIONS = {}
+    _CPU_SECONDS = 0.0
+    _OUTPUT_BYTES = 0
+
+    @classmethod
+    def record(
+        cls,
+        tracker: CodeExecutionTracker,
+        status: str,
+        prometheus_textfile_path: str = "",
+        opentelemetry: bool = False,
+    ):
+        """
+        Add a finished code execution to the aggregate, then export it.
+        Recording the same tracker more than once has no effect.
+        Export failures are logged but not raised.
+
+        :param tracker: The tracker of the finished code execution.
+        :param status: The final status of the code execution.
+        :param prometheus_textfile_path: If set, write all metrics to this file.
+        :param opentelemetry: Whether to also export the execution as an OpenTelemetry trace.
+        """
+        telemetry = tracker.telemetry()
+        with cls._LOCK:
+            if tracker._telemetry_recorded:
+                return
+            tracker._telemetry_recorded = True
+            for phase, seconds in telemetry.get("phases", {}).items():
+                if phase not in cls._PHASE_HISTOGRAMS:
+                    cls._PHASE_HISTOGRAMS[phase] = AdmissionController._Histogram(
+                        cls.PHASE_BUCKETS_SECONDS
+                    )
+                cls._PHASE_HISTOGRAMS[phase].observe(seconds)
+            if "memory_peak_bytes" in telemetry:
+                if cls._MEMORY_PEAK_HISTOGRAM is None:
+                    cls._MEMORY_PEAK_HISTOGRAM = AdmissionController._Histogram(
+                        cls.MEMORY_PEAK_BUCKETS_BYTES
+                    )
+                cls._MEMORY_PEAK_HISTOGRAM.observe(telemetry["memory_peak_bytes"])
+            cls._EXECUTIONS[status] = cls._EXECUTIONS.get(status, 0) + 1
+            cls._CPU_SECONDS += telemetry.get("cpu_seconds", 0.0)
+            cls._OUTPUT_BYTES += telemetry.get("output_bytes", 0)
+            prometheus_text = cls._prometheus_text_locked()
+        if prometheus_textfile_path:
+            try:
+                cls._write_textfile(prometheus_textfile_path, prometheus_text)
+            except OSError as e:
+                print(
+                    f"Warning: Failed to write telemetry to {prometheus_textfile_path}: {e}",
+                    file=sys.stderr,
+                )
+        if opentelemetry:
+            try:
+                cls._export_trace(tracker, status, telemetry)
+            except Exception as e:
+                print(
+                    f"Warning: Failed to export OpenTelemetry trace: {e}",
+                    file=sys.stderr,
+                )
+
+    @classmethod
+    def prometheus_text(cls) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        with cls._LOCK:
+            return cls._prometheus_text_locked()
+
+    @classmethod
+    def _prometheus_text_locked(cls):
+        lines = []
+
+        def _histogram(name, help_text, labeled_snapshots):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, snapshot in labeled_snapshots:
+                for bucket, count in snapshot["buckets"]:
+                    le = "+Inf" if bucket == float("inf") else str(bucket)
+                    bucket_labels = ",".join(labels + [f'le="{le}"'])
+                    lines.append(f"{name}_bucket{{{bucket_labels}}} {count}")
+                sample_labels = "{" + ",".join(labels) + "}" if labels else ""
+                lines.append(f"{name}_sum{sample_labels} {snapshot['sum']}")
+                lines.append(f"{name}_count{sample_labels} {snapshot['count']}")
+
+        lines.append(
+            "# HELP code_eval_executions_total Finished code executions, by status."
+        )
+        lines.append("# TYPE code_eval_executions_total counter")
+        for status, count in sorted(cls._EXECUTIONS.items()):
+            lines.append(f'code_eval_executions_total{{status="{status}"}} {count}')
+        lines.append(
+            "# HELP code_eval_cpu_seconds_total CPU time used by sandboxed code."
+        )
+        lines.append("# TYPE code_eval_cpu_seconds_total counter")
+        lines.append(f"code_eval_cpu_seconds_total {cls._CPU_SECONDS}")
+        lines.append(
+            "# HELP code_eval_output_bytes_total Output returned by sandboxed code."
+        )
+        lines.append("# TYPE code_eval_output_bytes_total counter")
+        lines.append(f"code_eval_output_bytes_total {cls._OUTPUT_BYTES}")
+        _histogram(
+            "code_eval_phase_seconds",
+            "Wall time spent in each phase of code execution.",
+            [
+                ([f'phase="{phase}"'], histogram.snapshot())
+                for phase, histogram in sorted(cls._PHASE_HISTOGRAMS.items())
+            ],
+        )
+        if cls._MEMORY_PEAK_HISTOGRAM is not None:
+            _histogram(
+                "code_eval_memory_peak_bytes",
+                "Peak memory usage of sandboxed code.",
+                [([], cls._MEMORY_PEAK_HISTOGRAM.snapshot())],
+            )
+        with AdmissionController._INSTANCE_LOCK:
+            admission = AdmissionController._INSTANCE
+        if admission is not None:
+            for name, snapshot in admission.histograms().items():
+                _histogram(
+                    f"code_eval_admission_{name}",
+                    f"Admission control {name.replace('_', ' ')}.",
+                    [([], snapshot)],
+                )
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def _write_textfile(cls, path, text):
+        """Atomically replace the file at `path` with `text`."""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".code_eval_", suffix=".prom.tmp", dir=directory
+        )
+        try:
+            with os.fdopen(fd, "w") as textfile_f:
+                textfile_f.write(text)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def _export_trace(cls, tracker, status, telemetry):
+        """
+        Export a code execution as a root span with one child span per phase.
+        Does nothing if the `opentelemetry-api` package is not installed.
+        """
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            return
+        tracer = trace.get_tracer("code_eval")
+        phases = telemetry.get("phases", {})
+        durations_ns = [
+            (phase, int(phases[phase] * 1e9)) for phase in cls.PHASES if phase in phases
+        ]
+        end_ns = time.time_ns()
+        start_ns = end_ns - sum(duration_ns for _, duration_ns in durations_ns)
+        attributes = {
+            "code_eval.name": tracker.name,
+            "code_eval.language": tracker.language,
+            "code_eval.status": status,
+        }
+        for key in ("memory_peak_bytes", "cpu_seconds", "output_bytes"):
+            if key in telemetry:
+                attributes[f"code_eval.{key}"] = telemetry[key]
+        root_span = tracer.start_span(
+            "code_execution", start_time=start_ns, attributes=attributes
+        )
+        context = trace.set_span_in_context(root_span)
+        phase_start_ns = start_ns
+        for phase, duration_ns in durations_ns:
+            phase_span = tracer.start_span(
+                f"code_execution.{phase}", context=context, start_time=phase_start_ns
+            )
+            phase_start_ns += duration_ns
+            phase_span.end(end_time=phase_start_ns)
+        root_span.end(end_time=end_ns)
+
+
+class AdmissionController:
+    """
+    Host-wide admission control for sandboxes.
+
+    At most `max_concurrent_sandboxes` sandboxes run at the same time on this
+    host. Within this process, waiting executions are admitted in round-robin
+    order across users, so that one user's burst does not starve others.
+    Across processes, each running sandbox holds an exclusive `flock` on one
+    of `max_concurrent_sandboxes` slot files in a directory shared by every
+    process on the host.
+    """
+
+    # Directory containing the slot lock files.
+    SLOTS_PATH = os.path.join(tempfile.gettempdir(), "run_code_admission")
+
+    # Upper bounds of the histogram buckets, in seconds; a +Inf bucket follows.
+    HISTOGRAM_BUCKETS_SECONDS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    # How often to refresh the queue position shown to waiting users.
+    STATUS_UPDATE_INTERVAL_SECONDS = 1.0
+
+    # Process-wide instance. Populated using `get`.
+    _INSTANCE = None
+    _INSTANCE_LOCK = threading.Lock()
+
+    class _Histogram:
+        def __init__(self, buckets):
+            self._buckets = tuple(buckets) + (float("inf"),)
+            self._counts = [0] * len(self._buckets)
+            self._sum = 0.0
+            self._count = 0
+
+        def observe(self, value):
+            for i, bucket in enumerate(self._buckets):
+                if value <= bucket:
+                    self._counts[i] += 1
+                    break
+            self._sum += value
+            self._count += 1
+
+        def snapshot(self):
+            cumulative = []
+            total = 0
+            for bucket, count in zip(self._buckets, self._counts):
+                total += count
+                cumulative.append((bucket, total))
+            return {"buckets": cumulative, "sum": self._sum, "count": self._count}
+
+    class _Waiter:
+        def __init__(self, user_id, loop):
+            self.user_id = user_id
+            self.loop = loop
+            self.future = loop.create_future()
+
+    class _Admission:
+        def __init__(self, controller, user_id, emitter):
+            self._controller = controller
+            self._user_id = user_id
+            self._emitter = emitter
+            self._slot = None
+            self._started_at = None
+            self.queue_seconds = None
+
+        async def __aenter__(self):
+            queued_at = time.monotonic()
+            self._slot, self._started_at = await self._controller._acquire(
+                self._user_id, self._emitter
+            )
+            self.queue_seconds = self._started_at - queued_at
+            return self
+
+        async def __aexit__(self, *args, **kwargs):
+            self._controller._release(self._slot, self._started_at)
+
+    @classmethod
+    def get(cls, max_concurrent_sandboxes: int):
+        """Return the process-wide admission controller, updating its limit."""
+        with cls._INSTANCE_LOCK:
+            if cls._INSTANCE is None:
+                cls._INSTANCE = cls(max_concurrent_sandboxes)
+            else:
+                cls._INSTANCE.set_max_concurrent_sandboxes(max_concurrent_sandboxes)
+            return cls._INSTANCE
+
+    def __init__(
+        self, max_concurrent_sandboxes: int, slots_path: typing.Optional[str] = None
+    ):
+        self._lock = threading.Lock()
+        self._max_concurrent_sandboxes = max(1, int(max_concurrent_sandboxes))
+        self._slots_path = slots_path or self.SLOTS_PATH
+        self._running = 0
+        self._queues = {}  # User ID -> list of waiters, in arrival order.
+        self._rotation = []  # User IDs with waiters, in the order they will be served.
+        self._held_slots = set()
+        self._next_wait_slot = 0
+        self._queue_wait_histogram = self._Histogram(self.HISTOGRAM_BUCKETS_SECONDS)
+        self._execution_histogram = self._Histogram(self.HISTOGRAM_BUCKETS_SECONDS)
+
+    def set_max_concurrent_sandboxes(self, max_concurrent_sandboxes: int):
+        with self._lock:
+            self._max_concurrent_sandboxes = max(1, int(max_concurrent_sandboxes))
+            self._dispatch()
+
+    def admit(self, user_id: typing.Optional[str], emitter):
+        """
+        Return an async context manager which waits for a free sandbox slot,
+        reporting the queue position through `emitter`, and holds it until exit.
+        """
+        return self._Admission(self, user_id or "", emitter)
+
+    def histograms(self) -> dict:
+        """
+        Return queue-wait and execution time histograms, with cumulative
+        bucket counts in the same style as Prometheus histograms.
+        """
+        with self._lock:
+            return {
+                "queue_wait_seconds": self._queue_wait_histogram.snapshot(),
+                "execution_seconds": self._execution_histogram.snapshot(),
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrent_sandboxes": self._max_concurrent_sandboxes,
+                "running": self._running,
+                "queued": sum(len(q) for q in self._queues.values()),
+            }
+
+    @classmethod
+    def _flock_in_thread(cls, fd, on_done):
+        """
+        Take an exclusive `flock` on `fd` in a dedicated thread, then call
+        `on_done(error)` from that thread; `error` is `None` on success.
+        If `on_done` returns False, nobody wants the lock anymore and `fd`
+        is closed, which releases it.
+        """
+
+        def _wait():
+            error = None
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except OSError as e:
+                error = e
+            wanted = False
+            try:
+                wanted = on_done(error)
+            finally:
+                if not wanted:
+                    os.close(fd)
+
+        threading.Thread(target=_wait, name="flock-wait", daemon=True).start()
+
+    @classmethod
+    def flock_with_timeout(cls, fd, timeout_seconds):
+        """
+        Take an exclusive `flock` on `fd`, waiting at most `timeout_seconds`.
+        Waits by blocking in a helper thread rather than polling.
+
+        :raises TimeoutError: If the lock was not acquired in time. In this case,
+                              `fd` is owned by the helper thread, which closes it.
+        :raises OSError: If the lock cannot be taken at all.
+        """
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+        lock = threading.Lock()
+        done = threading.Event()
+        state = {"abandoned": False, "error": None}
+
+        def on_done(error):
+            with lock:
+                if state["abandoned"]:
+                    return False
+                state["error"] = error
+                done.set()
+                return True
+
+        cls._flock_in_thread(fd, on_done)
+        if not done.wait(timeout_seconds):
+            with lock:
+                if not done.is_set():
+                    state["abandoned"] = True
+                    raise TimeoutError(
+                        f"Lock not acquired within {timeout_seconds} seconds"
+                    )
+        if state["error"] is not None:
+            raise state["error"]
+
+    def _dispatch(self):
+        """Admit waiters while there is room. Must be called with `_lock` held."""
+        while self._running < self._max_concurrent_sandboxes and self._rotation:
+            user_id = self._rotation.pop(0)
+            waiter = self._queues[user_id].pop(0)
+            if self._queues[user_id]:
+                self._rotation.append(user_id)
+            else:
+                del self._queues[user_id]
+            self._running += 1
+            try:
+                waiter.loop.call_soon_threadsafe(self._grant, waiter)
+            except RuntimeError:  # Event loop is closed.
+                self._running -= 1
+
+    def _grant(self, waiter):
+        """Runs on the waiter's event loop."""
+        if waiter.future.cancelled():
+            self._release_process_slot()
+        else:
+            waiter.future.set_result(True)
+
+    def _queue_position(self, waiter):
+        """Return the 1-based position of `waiter` in the queue, or `None` if admitted."""
+        with self._lock:
+            queue = self._queues.get(waiter.user_id, ())
+            if waiter not in queue:
+                return None
+            index = queue.index(waiter)
+            rotation_index = self._rotation.index(waiter.user_id)
+            ahead = index
+            for i, user_id in enumerate(self._rotation):
+                if user_id != waiter.user_id:
+                    turns = index + 1 if i < rotation_index else index
+                    ahead += min(len(self._queues[user_id]), turns)
+            return ahead + 1
+
+    def _abandon(self, waiter):
+        """Give up on a waiter which is no longer interested. Runs on its event loop."""
+        with self._lock:
+            queue = self._queues.get(waiter.user_id, [])
+            if waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.user_id]
+                    self._rotation.remove(waiter.user_id)
+                return
+        if waiter.future.done() and not waiter.future.cancelled():
+            self._release_process_slot()
+        else:
+            # `_grant` is still pending and will release the slot.
+            waiter.future.cancel()
+
+    def _release_process_slot(self):
+        with self._lock:
+            self._running -= 1
+            self._dispatch()
+
+    async def _acquire(self, user_id, emitter):
+        queued_at = time.monotonic()
+        waiter = None
+        with self._lock:
+            if self._running < self._max_concurrent_sandboxes and not self._rotation:
+                self._running += 1
+            else:
+                waiter = self._Waiter(user_id, asyncio.get_running_loop())
+                if user_id not in self._queues:
+                    self._queues[user_id] = []
+                    self._rotation.append(user_id)
+                self._queues[user_id].append(waiter)
+        if waiter is not None:
+            try:
+                await self._wait_in_queue(waiter, emitter)
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        try:
+            slot = await self._acquire_host_slot(emitter)
+        except BaseException:
+            self._release_process_slot()
+            raise
+        queue_wait_seconds = time.monotonic() - queued_at
+        with self._lock:
+            self._queue_wait_histogram.observe(queue_wait_seconds)
+        await emitter.clear_status()
+        return slot, time.monotonic()
+
+    async def _wait_in_queue(self, waiter, emitter):
+        last_position = None
+        while True:
+            position = self._queue_position(waiter)
+            if position is not None and position != last_position:
+                await emitter.status(
+                    f"Waiting for a free sandbox (position {position} in queue)..."
+                )
+                last_position = position
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(waiter.future),
+                    timeout=self.STATUS_UPDATE_INTERVAL_SECONDS,
+                )
+            except asyncio.TimeoutError:
+                continue
+            return
+
+    def _open_slot(self, index):
+        return os.open(
+            os.path.join(self._slots_path, f"slot_{index}.lock"),
+            os.O_RDWR | os.O_CREAT,
+            0o600,
+        )
+
+    async def _acquire_host_slot(self, emitter):
+        """
+        Take a host-wide slot, waiting for another process to free one if needed.
+
+        :return: A (slot index, locked file descriptor) tuple, or `None` if the
+                 slots directory is not usable, in which case only the
+                 in-process limit applies.
+        """
+        try:
+            os.makedirs(self._slots_path, mode=0o700, exist_ok=True)
+        except OSError:
+            return None
+        with self._lock:
+            candidates = [
+                i
+                for i in range(self._max_concurrent_sandboxes)
+                if i not in self._held_slots
+            ]
+            self._next_wait_slot += 1
+            wait_slot = candidates[self._next_wait_slot % len(candidates)]
+        for index in candidates:
+            try:
+                fd = self._open_slot(index)
+            except OSError:
+                return None
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            with self._lock:
+                self._held_slots.add(index)
+            return index, fd
+
+        # All slots are taken by other processes; block on one of them.
+        await emitter.status("Waiting for a free sandbox (host is busy)...")
+        try:
+            fd = self._open_slot(wait_slot)
+        except OSError:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        lock = threading.Lock()
+        state = {"abandoned": False, "acquired": False}
+
+        def _resolve(error):
+            if not future.done():
+                if error is None:
+                    future.set_result(True)
+                else:
+                    future.set_exception(error)
+
+        def on_done(error):
+            with lock:
+                if state["abandoned"]:
+                    return False
+                state["acquired"] = error is None
+                try:
+                    loop.call_soon_threadsafe(_resolve, error)
+                except RuntimeError:  # Event loop is closed.
+                    return False
+                return True
+
+        self._flock_in_thread(fd, on_done)
+        try:
+            await future
+        except OSError:
+            os.close(fd)
+            return None
+        except BaseException:
+            with lock:
+                state["abandoned"] = True
+                acquired = state["acquired"]
+            if acquired:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            raise
+        with self._lock:
+            self._held_slots.add(wait_slot)
+        return wait_slot, fd
+
+    def _release(self, slot, started_at):
+        execution_seconds = time.monotonic() - started_at
+        if slot is not None:
+            index, fd = slot
+            with self._lock:
+                self._held_slots.discard(index)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        with self._lock:
+            self._execution_histogram.observe(execution_seconds)
+        self._release_process_slot()
+
+
+class PackageCache:
+    """
+    Host-managed cache of Python packages, made available read-only to sandboxes.
+
+    Each set of requirements is installed once with `pip install --target`
+    into a directory named after a hash of the requirements and of the Python
+    interpreter, so that different sets coexist and identical ones are shared
+    by every process on the host. Downloaded wheels are kept in a common pip
+    cache directory, so overlapping sets do not download packages again.
+    """
+
+    # Directory under the cache root where each set of requirements is installed.
+    ENVIRONMENTS_DIRECTORY = "envs"
+
+    # Directory under the cache root used as pip's own cache.
+    PIP_CACHE_DIRECTORY = "pip"
+
+    # File marking an installation as complete and import-checked.
+    COMPLETE_MARKER = ".complete"
+
+    # How long to let `pip install` run, and to wait for another process to install the same requirements.
+    INSTALL_TIMEOUT_SECONDS = 900
+
+    # How long to let the import check run.
+    IMPORT_CHECK_TIMEOUT_SECONDS = 120
+
+    # Installations that are known to be complete in this process, by path.
+    _READY = set()
+    _READY_LOCK = threading.Lock()
+
+    @classmethod
+    def parse_requirements(cls, requirements_str: str) -> list:
+        """
+        Parse a comma- or newline-separated list of pip requirement specifiers.
+
+        :raises Sandbox.EnvironmentNeedsSetupException: If an entry is not a requirement specifier.
+        """
+        requirements = []
+        for requirement in re.split(r"[,\n]", requirements_str):
+            requirement = requirement.strip()
+            if not requirement:
+                continue
+            if not re.match(r"^[A-Za-z0-9]", requirement):
+                raise Sandbox.EnvironmentNeedsSetupException(
+                    f"Invalid package requirement: {requirement!r}"
+                )
+            requirements.append(requirement)
+        return requirements
+
+    @classmethod
+    def _normalize_name(cls, name):
+        return re.sub(r"[-_.]+", "-", name).lower()
+
+    def __init__(self, root_path: str, requirements: list):
+        """
+        Constructor.
+
+        :param root_path: Cache directory. If it begins by '$DATA_DIR', this is replaced with the DATA_DIR environment variable.
+        :param requirements: List of pip requirement specifiers to install.
+        """
+        if root_path.startswith("$DATA_DIR" + os.sep):
+            root_path = os.path.join(
+                os.environ.get("DATA_DIR", "/app/backend/data"),
+                root_path[len("$DATA_DIR" + os.sep) :].lstrip(os.sep),
+            )
+        self._root_path = os.path.normpath(os.path.abspath(root_path))
+        self._requirements = sorted(set(requirements))
+        key = hashlib.sha256()
+        key.update(sys.version.encode("utf-8"))
+        key.update(platform.machine().encode("utf-8"))
+        for requirement in self._requirements:
+            key.update(b"\0" + requirement.encode("utf-8"))
+        self._environment_path = os.path.join(
+            self._root_path, self.ENVIRONMENTS_DIRECTORY, key.hexdigest()[:32]
+        )
+
+    @property
+    def site_packages_path(self) -> str:
+        """Directory to add to `PYTHONPATH` to use the installed packages."""
+        return os.path.join(self._environment_path, "site-packages")
+
+    def ready(self) -> bool:
+        """Whether the packages are already installed and import-checked."""
+        with self._READY_LOCK:
+            if self._environment_path in self._READY:
+                return True
+        return os.path.isfile(
+            os.path.join(self._environment_path, self.COMPLETE_MARKER)
+        )
+
+    def ensure(self) -> str:
+        """
+        Install the packages unless already done, and check that they can be imported.
+        Blocks while another process installs the same requirements.
+
+        :return: The path of the site-packages directory to mount in sandboxes.
+        :raises Sandbox.EnvironmentNeedsSetupException: If installation or the import check fails.
+        """
+        with self._READY_LOCK:
+            if self._environment_path in self._READY:
+                return self.site_packages_path
+        complete_marker_path = os.path.join(
+            self._environment_path, self.COMPLETE_MARKER
+        )
+        if not os.path.isfile(complete_marker_path):
+            try:
+                os.makedirs(os.path.dirname(self._environment_path), exist_ok=True)
+                lock_fd = os.open(
+                    self._environment_path + ".lock", os.O_RDWR | os.O_CREAT, 0o644
+                )
+            except OSError as e:
+                raise Sandbox.EnvironmentNeedsSetupException(
+                    f"Cannot create package cache directory {self._root_path} ({e}); please adjust permissions or reconfigure the package cache directory."
+                )
+            try:
+                AdmissionController.flock_with_timeout(
+                    lock_fd, self.INSTALL_TIMEOUT_SECONDS
+                )
+            except TimeoutError as e:
+                # `lock_fd` now belongs to the lock waiter thread.
+                raise Sandbox.EnvironmentNeedsSetupException(
+                    f"Timed out waiting for another process to install packages: {e}"
+                )
+            except OSError as e:
+                os.close(lock_fd)
+                raise Sandbox.EnvironmentNeedsSetupException(
+                    f"Cannot lock package cache: {e}"
+                )
+            try:
+                if not os.path.isfile(complete_marker_path):
+                    self._install()
+                    with open(complete_marker_path, "w") as marker_f:
+                        marker_f.write("\n".join(self._requirements) + "\n")
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                os.close(lock_fd)
+        # Import the packages once per process, even when installed by another
+        # one: this fails early if the cache was tampered with, and brings the
+        # files into the page cache before the first sandbox needs them.
+        self._import_check()
+        with self._READY_LOCK:
+            self._READY.add(self._environment_path)
+        return self.site_packages_path
+
+    def _install(self):
+        """Install the requirements from scratch. Must hold the installation lock."""
+        if os.path.isdir(self._environment_path):
+            # Left over by an interrupted installation.
+            shutil.rmtree(self._environment_path)
+        os.makedirs(self._environment_path, mode=0o755)
+        pip_env = os.environ.copy()
+        pip_env["PIP_CACHE_DIR"] = os.path.join(
+            self._root_path, self.PIP_CACHE_DIRECTORY
+        )
+        pip_env["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+        try:
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "pip",
+                    "install",
+                    "--no-input",
+                    "--no-warn-script-location",
+                    f"--target={self.site_packages_path}",
+                    "--",
+                ]
+                + self._requirements,
+                env=pip_env,
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+                timeout=self.INSTALL_TIMEOUT_SECONDS,
+                check=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise Sandbox.EnvironmentNeedsSetupException(
+                f"Installing packages {self._requirements} failed: {e.stderr.strip()[-2048:]}"
+            )
+        except subprocess.TimeoutExpired:
+            raise Sandbox.EnvironmentNeedsSetupException(
+                f"Installing packages {self._requirements} took more than {self.INSTALL_TIMEOUT_SECONDS} seconds"
+            )
+        os.chmod(self._environment_path, 0o755)
+
+    @staticmethod
+    def _recorded_top_level_modules(dist_info_path):
+        """
+        Names of the top-level modules and packages that a distribution
+        installed, according to the files listed in its RECORD. Used when it
+        has no `top_level.txt`, which not every build backend writes.
+        """
+        import csv
+
+        modules = set()
+        try:
+            with open(os.path.join(dist_info_path, "RECORD"), newline="") as record_f:
+                for row in csv.reader(record_f):
+                    if not row:
+                        continue
+                    parts = row[0].replace("\\", "/").split("/")
+                    if parts[0] in ("", "..", "__pycache__") or parts[0].endswith(
+                        (".dist-info", ".data")
+                    ):
+                        continue
+                    if len(parts) > 1:
+                        if parts[-1].endswith((".py", ".so", ".pyd")):
+                            modules.add(parts[0])
+                    elif parts[0].endswith(".py"):
+                        modules.add(parts[0][: -len(".py")])
+                    elif parts[0].endswith((".so", ".pyd")):
+                        modules.add(parts[0].split(".", 1)[0])
+        except FileNotFoundError:
+            pass
+        return modules
+
+    def _top_level_modules(self):
+        """
+        Names of the top-level modules provided by the requested packages.
+        Packages whose modules cannot be determined are left out.
+        """
+        wanted = set()
+        for requirement in self._requirements:
+            name = re.match(r"[A-Za-z0-9][A-Za-z0-9._-]*", requirement).group(0)
+            wanted.add(self._normalize_name(name))
+        modules = set()
+        for entry in os.listdir(self.site_packages_path):
+            if not entry.endswith(".dist-info"):
+                continue
+            distribution_name = entry[: -len(".dist-info")].rsplit("-", 1)[0]
+            if self._normalize_name(distribution_name) not in wanted:
+                continue
+            wanted.discard(self._normalize_name(distribution_name))
+            top_level_path = os.path.join(
+                self.site_packages_path, entry, "top_level.txt"
+            )
+            if os.path.isfile(top_level_path):
+                with open(top_level_path) as top_level_f:
+                    modules.update(line.strip() for line in top_level_f)
+            else:
+                modules.update(
+                    self._recorded_top_level_modules(
+                        os.path.join(self.site_packages_path, entry)
+                    )
+                )
+        return sorted(m for m in modules if m.isidentifier() and not m.startswith("_"))
+
+    def _import_check(self):
+        """
+        Import every requested package on the host, with the same `PYTHONPATH`
+        as in the sandbox.
+        """
+        modules = self._top_level_modules()
+        check_env = os.environ.copy()
+        check_env["PYTHONPATH"] = self.site_packages_path
+        try:
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import importlib, sys\nfor m in sys.argv[1:]: importlib.import_module(m)",
+                ]
+                + modules,
+                env=check_env,
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+                timeout=self.IMPORT_CHECK_TIMEOUT_SECONDS,
+                check=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise Sandbox.EnvironmentNeedsSetupException(
+                f"Cannot import installed packages {modules}: {e.stderr.strip()[-2048:]}"
+            )
+        except subprocess.TimeoutExpired:
+            raise Sandbox.EnvironmentNeedsSetupException(
+                f"Importing installed packages {modules} took more than {self.IMPORT_CHECK_TIMEOUT_SECONDS} seconds"
+            )
+
+
 class Sandbox:
     """
     Sandbox manages a gVisor sandbox's lifecycle.
@@ -573,6 +1569,14 @@ class Sandbox:
         "/var",
     ]
 
+    # Where the package cache, if any, is mounted read-only in the sandbox.
+    # It is also added to `PYTHONPATH` for the code being evaluated.
+    PACKAGE_CACHE_MOUNT_PATH = "/sandbox/packages"
+
+    # Where the workspace directory, if any, is mounted read-only in the
+    # sandbox. Its contents are copied into the home directory on startup.
+    WORKSPACE_MOUNT_PATH = "/sandbox/workspace"
+
     # The following directories will exist in the sandbox environment but
     # will appear as empty and writable.
     # This is useful to have a filesystem that feels like a normal Linux
@@ -685,6 +1689,11 @@ class Sandbox:
     # Environment variable used to detect interpreter re-execution.
     _MARKER_ENVIRONMENT_VARIABLE = "__CODE_EXECUTION_STAGE"
 
+    # Environment variable that relocates the paths used by the in-sandbox
+    # server, as a JSON dictionary. Only set when the server does not actually
+    # run inside gVisor, e.g. under the benchmark's stand-in `runsc`.
+    _SERVER_PATHS_ENVIRONMENT_VARIABLE = "__CODE_EXECUTION_SERVER_PATHS"
+
     # Re-execution stages.
     _STAGE_SANDBOX = "SANDBOX"
     _STAGE_SERVER = "SERVER"
@@ -710,19 +1719,50 @@ class Sandbox:
         _TIMEOUT_SLACK_FINAL + 1
     )  # Wait for sandbox process to exit.
 
+    # Default for the maximum number of bytes kept from each of stdout and
+    # stderr of a code execution. Past this, the middle of the stream is
+    # replaced by a marker saying how many bytes were left out.
+    DEFAULT_MAX_OUTPUT_BYTES = 1024 * 1024
+
+    # Wire protocol between `_SandboxClient` and `_InSandboxServer`.
+    # Each message is made of:
+    #   - 4 bytes of magic, the last of which is the protocol version;
+    #   - the length of the header, as a 4-byte big-endian integer;
+    #   - the header: a JSON object, which lists the name and length of each body;
+    #   - the raw bytes of each body, in order.
+    # Code and output streams travel as bodies, so they are never
+    # JSON-escaped nor buffered more than once.
+    _PROTOCOL_MAGIC = b"SBX\x02"
+    _PROTOCOL_PREFIX = struct.Struct(">4sI")
+    _PROTOCOL_MAX_HEADER_BYTES = 16 * 1024 * 1024
+    _PROTOCOL_BODY_SLACK_BYTES = 1024 * 1024
+
     # libc bindings.
     # Populated using `_libc`.
     _LIBC = None
 
+    # Cached outcomes of environment probes, computed once per process.
+    # Populated using `_probe`; cleared using `refresh_probes`.
+    _PROBES = {}
+    _PROBES_LOCK = threading.Lock()
+    # Settings `check_setup` was called with. Probes run again the first time
+    # new settings are seen, e.g. once valves were changed after fixing the
+    # environment, but not when the tool and the function take turns.
+    _PROBES_SETTINGS_SEEN = set()
+
     class _Libc:
         """
         Wrapper over libc functions.
         """
 
         def __init__(self):
+            import ctypes
+            import ctypes.util
+
             libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
             libc.mount.argtypes = (ctypes.c_char_p,)
             self._libc = libc
+            self._get_errno = ctypes.get_errno
 
         def mount(self, source, target, fs, options):
             if (
@@ -735,7 +1775,7 @@ class Sandbox:
                 )
                 < 0
             ):
-                errno = ctypes.get_errno()
+                errno = self._get_errno()
                 raise OSError(
                     errno,
                     f"mount({source}, {target}, {fs}, {options}): {os.strerror(errno)}",
@@ -743,7 +1783,7 @@ class Sandbox:
 
         def umount(self, path):
             if self._libc.umount(path.encode("ascii")) < 0:
-                errno = ctypes.get_errno()
+                errno = self._get_errno()
                 raise OSError(errno, f"umount({path}): {os.strerror(errno)}")
 
         def unshare(self, flags):
@@ -1123,6 +2163,40 @@ class Sandbox:
                         f"{first_exception} (other attempts: {other_exceptions})"
                     )
 
+        def resource_usage(self):
+            """
+            Resources used by the processes of the sandbox cgroup, if resource limiting is enabled.
+            Must be called before `cleanup`.
+
+            :return: A dictionary with "memory_peak_bytes" and "cpu_seconds", for each one that could be read.
+            """
+            usage = {}
+            if not self._do_resource_limiting or self._codeeval_cgroup_name is None:
+                return usage
+            sandbox_cgroup = (
+                self._initial_cgroup_name,
+                self._codeeval_cgroup_name,
+                self._CGROUP_SANDBOX_NAME,
+            )
+            try:
+                memory_peak_path = self._cgroup_path(*sandbox_cgroup, "memory.peak")
+                with self._open(memory_peak_path, "rb") as memory_peak_f:
+                    usage["memory_peak_bytes"] = int(
+                        memory_peak_f.read().decode("ascii").strip()
+                    )
+            except (OSError, ValueError):
+                pass
+            try:
+                cpu_stat_path = self._cgroup_path(*sandbox_cgroup, "cpu.stat")
+                with self._open(cpu_stat_path, "rb") as cpu_stat_f:
+                    for line in cpu_stat_f.read().decode("ascii").splitlines():
+                        key, _, value = line.partition(" ")
+                        if key == "usage_usec":
+                            usage["cpu_seconds"] = int(value) / 1000000
+            except (OSError, ValueError):
+                pass
+            return usage
+
         def _best_effort_remove_cgroup_subtree(self, codeeval_name):
             for cgroup_components in (
                 (
@@ -1667,7 +2741,13 @@ class Sandbox:
         """
 
         def __init__(self):
-            pass
+            paths = json.loads(
+                os.environ.get(Sandbox._SERVER_PATHS_ENVIRONMENT_VARIABLE, "{}")
+            )
+            self._sandbox_path = paths.get("sandbox", "/sandbox")
+            self._persistent_path = paths.get("persistent", "/sandbox/persistent")
+            self._home_path = paths.get("home", "/home/user")
+            self._workspace_path = paths.get("workspace", Sandbox.WORKSPACE_MOUNT_PATH)
 
         def run(self):
             """
@@ -1676,36 +2756,34 @@ class Sandbox:
             """
             keep_going = True
             server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            server_socket.bind("/sandbox/socket")
+            server_socket.bind(os.path.join(self._sandbox_path, "socket"))
             server_socket.listen(1)
             server_socket_closed = False
             try:
-                with open("/sandbox/started", "wb") as started_f:
+                if self._workspace_path and os.path.isdir(self._workspace_path):
+                    shutil.copytree(
+                        self._workspace_path,
+                        self._home_path,
+                        symlinks=True,
+                        dirs_exist_ok=True,
+                    )
+                started_marker_path = os.path.join(self._sandbox_path, "started")
+                with open(started_marker_path, "wb") as started_f:
                     started_f.write(b"OK\n")
+                try:
+                    with socket.socket(
+                        socket.AF_UNIX, socket.SOCK_STREAM
+                    ) as ready_socket:
+                        ready_socket.connect(os.path.join(self._sandbox_path, "ready"))
+                except OSError:
+                    pass  # The client falls back to checking the started marker.
                 while keep_going:
                     client_socket, _ = server_socket.accept()
+                    response = None
+                    response_bodies = {}
                     try:
-                        request_size_buf = client_socket.recv(8)
-                        if len(request_size_buf) != 8:
-                            raise Sandbox.SandboxRuntimeException(
-                                f"Server did not receive 8 bytes for request size: {repr(request_size_buf)}"
-                            )
-                        request_length = struct.unpack(">Q", request_size_buf)[0]
-                        request_bytes = []
-                        remaining_bytes = request_length
-                        while remaining_bytes > 0:
-                            packet_size = min(remaining_bytes, 0x100000)
-                            request_data = client_socket.recv(packet_size)
-                            if len(request_data) == 0:
-                                break
-                            remaining_bytes -= len(request_data)
-                            request_bytes.append(request_data)
-                        if remaining_bytes > 0:
-                            raise Sandbox.SandboxRuntimeException(
-                                f"Got partial request; {remaining_bytes}/{request_length} bytes still expected"
-                            )
-                        request_data = json.loads(
-                            (b"".join(request_bytes)).decode("utf-8")
+                        request_data, request_bodies = Sandbox._recv_message(
+                            client_socket
                         )
                         if "type" not in request_data or "kwargs" not in request_data:
                             raise Sandbox.SandboxRuntimeException(
@@ -1713,9 +2791,11 @@ class Sandbox:
                             )
                         request_type = request_data["type"]
                         request_kwargs = request_data.get("kwargs", {})
-                        response = None
+                        request_kwargs.update(request_bodies)
                         if request_type == "code_eval":
-                            response = self._handle_code_eval(**request_kwargs)
+                            response, response_bodies = self._handle_code_eval(
+                                **request_kwargs
+                            )
                         elif request_type == "copy_out":
                             response = self._handle_copy_out(**request_kwargs)
                         elif request_type == "terminate":
@@ -1728,21 +2808,27 @@ class Sandbox:
                                 f"Invalid request type: {request_type}"
                             )
                     except Exception as e:
-                        response = {"exception": Sandbox._json_exception_encode(e)}
+                        response, response_bodies = Sandbox._protocol_exception_encode(
+                            e
+                        )
                     assert response is not None, "Logic error"
                     try:
-                        response_bytes = json.dumps(response).encode("utf-8")
-                        client_socket.sendall(struct.pack(">Q", len(response_bytes)))
-                        client_socket.sendall(response_bytes)
+                        Sandbox._send_message(client_socket, response, response_bodies)
                     finally:
                         client_socket.close()
             finally:
                 if not server_socket_closed:
                     server_socket.close()
 
-        def _handle_code_eval(self, language, code, max_runtime_seconds):
+        def _handle_code_eval(
+            self, language, code, max_runtime_seconds, max_output_bytes
+        ):
             """
             Handle a single code evaluation request.
+
+            :param code: The code to run, as UTF-8 bytes.
+            :param max_output_bytes: Maximum number of bytes to keep from each of stdout and stderr.
+            :return: A (response, bodies) tuple; bodies hold stdout and stderr.
             """
             if language not in Sandbox.SUPPORTED_LANGUAGES:
                 raise Sandbox.SandboxRuntimeException(
@@ -1762,44 +2848,55 @@ class Sandbox:
                 raise Sandbox.SandboxRuntimeException(
                     "Exceeded the code execution deadline"
                 )
+            code_text = code.decode("utf-8", errors="replace")
+            deadline = time.time() + max_runtime_seconds + Sandbox._TIMEOUT_SLACK_FINAL
+            process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            stdout = Sandbox._BoundedCapture(process.stdout, max_output_bytes)
+            stderr = Sandbox._BoundedCapture(process.stderr, max_output_bytes)
+
+            def _write_code():
+                try:
+                    process.stdin.write(code + b"\n")
+                    process.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass  # The interpreter exited without reading all of it.
+
+            threading.Thread(target=_write_code, daemon=True).start()
             try:
-                result = subprocess.run(
-                    cmd,
-                    input=code + "\n",
-                    text=True,
-                    capture_output=True,
-                    timeout=max_runtime_seconds + Sandbox._TIMEOUT_SLACK_FINAL,
-                    check=True,
-                )
-            except subprocess.TimeoutExpired as e:
+                returncode = process.wait(timeout=max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
                 raise Sandbox.ExecutionTimeoutError(
-                    code=code,
+                    code=code_text,
                     returncode=126,
                     cmd=cmd,
-                    output=e.stdout or "",
-                    stderr=e.stderr or "",
+                    output=stdout.text(deadline),
+                    stderr=stderr.text(deadline),
                 )
-            except subprocess.CalledProcessError as e:
+            if returncode != 0:
                 raise Sandbox.CodeExecutionError(
-                    code=code,
-                    returncode=e.returncode,
+                    code=code_text,
+                    returncode=returncode,
                     cmd=cmd,
-                    output=e.stdout or "",
-                    stderr=e.stderr or "",
+                    output=stdout.text(deadline),
+                    stderr=stderr.text(deadline),
                 )
-            else:
-                return {
-                    "args": cmd,
-                    "returncode": 0,
-                    "stdout": result.stdout,
-                    "stderr": result.stderr,
-                }
+            return {"args": cmd, "returncode": 0}, {
+                "stdout": stdout.result(deadline),
+                "stderr": stderr.result(deadline),
+            }
 
         def _handle_copy_out(self):
-            if os.path.isdir("/sandbox/persistent"):
+            if self._persistent_path and os.path.isdir(self._persistent_path):
                 shutil.copytree(
-                    "/home/user",
-                    "/sandbox/persistent",
+                    self._home_path,
+                    self._persistent_path,
                     ignore_dangling_symlinks=True,
                     dirs_exist_ok=True,
                 )
@@ -1817,16 +2914,27 @@ class Sandbox:
         class _ServerDiedError(Exception):
             """Raised when the server dies mid-request."""
 
-        def __init__(self, sandbox_shared_path, runsc_popen):
+        def __init__(
+            self, sandbox_shared_path, runsc_popen, ready_socket, timings=None
+        ):
             """
             Constructor.
 
             :param sandbox_shared_path: Path to the dir mounted as /sandbox in the sandbox.
             :param runsc_popen: subprocess.Popen object to runsc, to check for liveness.
+            :param ready_socket: Listening socket bound to `ready` in `sandbox_shared_path`, which the server connects to once it has started.
+            :param timings: Optional dictionary of phase name to seconds, to which the time spent waiting for the server to come up ("first_connect") and in each request is added.
             """
             self._sandbox_shared_path = sandbox_shared_path
             self._runsc_popen = runsc_popen
+            self._ready_socket = ready_socket
             self._first_request = True
+            self._timings = timings if timings is not None else {}
+
+        def _add_timing(self, phase, started_at):
+            self._timings[phase] = (
+                self._timings.get(phase, 0.0) + time.monotonic() - started_at
+            )
 
         def _check_server_alive(self):
             """Check if the server is alive.
@@ -1841,8 +2949,25 @@ class Sandbox:
             else:
                 raise self._ServerDiedError()
 
-        def _request(self, request_type, deadline, **request_kwargs):
-            """Connect and get a socket to the server."""
+        def _request(
+            self,
+            request_type,
+            deadline,
+            request_bodies=None,
+            max_response_bytes=None,
+            timing_phase=None,
+            **request_kwargs,
+        ):
+            """
+            Send a request to the server and wait for its response.
+
+            :param request_bodies: Dictionary of raw byte strings to send along with the request.
+            :param max_response_bytes: Refuse responses with more body bytes than this.
+            :param timing_phase: If set, the time spent on the request once connected is added to this phase.
+            :return: A (response, response bodies) tuple.
+            """
+            connect_started_at = time.monotonic()
+            first_request = self._first_request
             if self._first_request:
                 connect_deadline = min(
                     deadline, time.time() + Sandbox._TIMEOUT_SLACK_CONNECT_FIRST_REQUEST
@@ -1853,13 +2978,12 @@ class Sandbox:
                     deadline, time.time() + Sandbox._TIMEOUT_SLACK_CONNECT
                 )
             started_marker_path = os.path.join(self._sandbox_shared_path, "started")
-            while time.time() < connect_deadline and not os.path.exists(
-                started_marker_path
-            ):
-                time.sleep(0.05)
-            if time.time() >= connect_deadline and not os.path.exists(
-                started_marker_path
-            ):
+            if first_request:
+                # Block until the server connects to the ready socket, or the deadline.
+                with selectors.DefaultSelector() as selector:
+                    selector.register(self._ready_socket, selectors.EVENT_READ)
+                    selector.select(max(0.0, connect_deadline - time.time()))
+            if not os.path.exists(started_marker_path):
                 raise Sandbox.SandboxRuntimeException(
                     f"Sandbox did not start in time: {started_marker_path} still does not exist"
                 )
@@ -1871,60 +2995,44 @@ class Sandbox:
                 raise Sandbox.SandboxRuntimeException(
                     f"Cannot connect to socket at {socket_path}: {e}"
                 )
+            if first_request:
+                self._add_timing("first_connect", connect_started_at)
+            request_started_at = time.monotonic()
             try:
-                client_socket.settimeout(0.5)
-                request_bytes = json.dumps(
-                    {
-                        "type": request_type,
-                        "kwargs": request_kwargs,
-                    }
-                ).encode("utf-8")
-                client_socket.sendall(struct.pack(">Q", len(request_bytes)))
-                client_socket.sendall(request_bytes)
-                response_size = None
-                remaining_bytes = -1
-                response_bytes = []
-                while (
-                    response_size is None or remaining_bytes > 0
-                ) and time.time() < deadline:
-                    try:
-                        if response_size is None:
-                            response_size_buf = client_socket.recv(8)
-                            if len(response_size_buf) != 8:
-                                self._check_server_alive()
-                                raise Sandbox.SandboxRuntimeException(
-                                    f"Client did not get 8 bytes for response size: {repr(response_size_buf)}"
-                                )
-                            response_size = struct.unpack(">Q", response_size_buf)[0]
-                            remaining_bytes = response_size
-                        if remaining_bytes > 0:
-                            packet_data = client_socket.recv(
-                                min(remaining_bytes, 0x100000)
-                            )
-                            if len(packet_data) == 0:
-                                self._check_server_alive()
-                                break
-                            remaining_bytes -= len(packet_data)
-                            response_bytes.append(packet_data)
-                    except socket.timeout:
-                        continue
-                if time.time() >= deadline:
+                client_socket.settimeout(
+                    max(deadline - time.time(), Sandbox._TIMEOUT_SLACK_FINAL)
+                )
+                try:
+                    Sandbox._send_message(
+                        client_socket,
+                        {"type": request_type, "kwargs": request_kwargs},
+                        request_bodies,
+                    )
+                    response, response_bodies = Sandbox._recv_message(
+                        client_socket,
+                        deadline=deadline,
+                        max_body_bytes=max_response_bytes,
+                    )
+                except TimeoutError:
                     self._check_server_alive()
                     raise self._RequestTimeoutError()
-                try:
-                    response = json.loads((b"".join(response_bytes)).decode("utf-8"))
-                except json.decoder.JSONDecodeError as e:
+                except (EOFError, ConnectionError) as e:
+                    self._check_server_alive()
                     raise Sandbox.SandboxRuntimeException(
-                        f"Invalid response JSON: {e} ({repr(response_bytes)})"
+                        f"Lost connection to in-sandbox server: {e}"
                     )
                 if "exception" in response:
-                    raise Sandbox._json_exception_decode(response["exception"])
-                return response
+                    raise Sandbox._protocol_exception_decode(
+                        response["exception"], response_bodies
+                    )
+                return response, response_bodies
             finally:
                 client_socket.close()
+                if timing_phase is not None:
+                    self._add_timing(timing_phase, request_started_at)
 
         def code_eval(
-            self, language, code, max_runtime_seconds
+            self, language, code, max_runtime_seconds, max_output_bytes
         ) -> subprocess.CompletedProcess:
             """Run a single snippet of code."""
             request_deadline = (
@@ -1932,13 +3040,19 @@ class Sandbox:
                 + max_runtime_seconds
                 + Sandbox._TIMEOUT_SLACK_CODE_EVAL_REQUEST
             )
+            code_bytes = code.encode("utf-8")
             try:
-                response = self._request(
+                response, response_bodies = self._request(
                     "code_eval",
                     request_deadline,
+                    request_bodies={"code": code_bytes},
+                    max_response_bytes=2 * max_output_bytes
+                    + len(code_bytes)
+                    + Sandbox._PROTOCOL_BODY_SLACK_BYTES,
                     language=language,
-                    code=code,
                     max_runtime_seconds=max_runtime_seconds,
+                    max_output_bytes=max_output_bytes,
+                    timing_phase="eval",
                 )
             except self._RequestTimeoutError:
                 raise Sandbox.ExecutionTimeoutError(
@@ -1960,16 +3074,190 @@ class Sandbox:
                 return subprocess.CompletedProcess(
                     args=response["args"],
                     returncode=response["returncode"],
-                    stdout=response.get("stdout"),
-                    stderr=response.get("stderr"),
+                    stdout=response_bodies.get("stdout", b"").decode(
+                        "utf-8", errors="replace"
+                    ),
+                    stderr=response_bodies.get("stderr", b"").decode(
+                        "utf-8", errors="replace"
+                    ),
                 )
 
         def copy_out(self):
-            self._request("copy_out", time.time() + Sandbox._TIMEOUT_SLACK_COPY_OUT)
+            self._request(
+                "copy_out",
+                time.time() + Sandbox._TIMEOUT_SLACK_COPY_OUT,
+                timing_phase="copy_out",
+            )
 
         def terminate(self):
             self._request("terminate", time.time() + Sandbox._TIMEOUT_SLACK_TERMINATE)
 
+    class _BoundedCapture:
+        """
+        Drains a stream in a background thread, keeping at most `max_bytes` of
+        it: the head and the tail, with a marker standing in for the middle.
+        """
+
+        def __init__(self, stream, max_bytes):
+            self._lock = threading.Lock()
+            self._head = bytearray()
+            self._tail = bytearray()
+            self._head_max = max_bytes // 2
+            self._tail_max = max_bytes - self._head_max
+            self._total = 0
+            self._thread = threading.Thread(
+                target=self._drain, args=(stream,), daemon=True
+            )
+            self._thread.start()
+
+        def _drain(self, stream):
+            try:
+                while True:
+                    chunk = stream.read1(0x10000)
+                    if not chunk:
+                        break
+                    with self._lock:
+                        self._total += len(chunk)
+                        head_room = self._head_max - len(self._head)
+                        if head_room > 0:
+                            self._head += chunk[:head_room]
+                            chunk = chunk[head_room:]
+                        self._tail += chunk
+                        excess = len(self._tail) - self._tail_max
+                        if excess > 0:
+                            del self._tail[:excess]
+            finally:
+                stream.close()
+
+        def result(self, deadline) -> bytes:
+            """
+            Return the captured data. Waits until `deadline` for the stream to
+            be fully drained, e.g. if a child process still holds it open.
+            """
+            self._thread.join(timeout=max(0, deadline - time.time()))
+            with self._lock:
+                omitted = self._total - len(self._head) - len(self._tail)
+                if omitted <= 0:
+                    return bytes(self._head + self._tail)
+                marker = f"\n[... {omitted} bytes of output omitted ...]\n"
+                return bytes(self._head + marker.encode("utf-8") + self._tail)
+
+        def text(self, deadline) -> str:
+            """Like `result`, but decoded as UTF-8."""
+            return self.result(deadline).decode("utf-8", errors="replace")
+
+    @classmethod
+    def _recv_exactly(cls, sock, num_bytes, deadline=None) -> bytearray:
+        """
+        Receive exactly `num_bytes` from `sock` into a single preallocated buffer.
+
+        :raises TimeoutError: If `deadline` passes first.
+        :raises EOFError: If the connection is closed first.
+        """
+        buf = bytearray(num_bytes)
+        view = memoryview(buf)
+        received = 0
+        selector = None
+        if deadline is not None:
+            # Unlike `select.select`, works with file descriptors above 1023.
+            selector = selectors.DefaultSelector()
+            selector.register(sock, selectors.EVENT_READ)
+        try:
+            while received < num_bytes:
+                if selector is not None:
+                    remaining_seconds = deadline - time.time()
+                    if remaining_seconds <= 0:
+                        raise TimeoutError(f"Received {received}/{num_bytes} bytes")
+                    if not selector.select(remaining_seconds):
+                        continue
+                num_received = sock.recv_into(view[received:])
+                if num_received == 0:
+                    raise EOFError(
+                        f"Connection closed after {received}/{num_bytes} bytes"
+                    )
+                received += num_received
+        finally:
+            if selector is not None:
+                selector.close()
+        return buf
+
+    @classmethod
+    def _send_message(cls, sock, header, bodies=None):
+        """Send a protocol message made of a JSON-able `header` and a dictionary of raw `bodies`."""
+        bodies = bodies or {}
+        header = dict(header)
+        header["bodies"] = [[name, len(body)] for name, body in bodies.items()]
+        header_bytes = json.dumps(header).encode("utf-8")
+        sock.sendall(
+            cls._PROTOCOL_PREFIX.pack(cls._PROTOCOL_MAGIC, len(header_bytes))
+            + header_bytes
+        )
+        for body in bodies.values():
+            # The peer may already be gone once it has every byte it expects.
+            if body:
+                sock.sendall(body)
+
+    @classmethod
+    def _recv_message(cls, sock, deadline=None, max_body_bytes=None):
+        """
+        Receive a protocol message.
+
+        :return: A (header, bodies) tuple.
+        :raises Sandbox.SandboxRuntimeException: If the message is malformed or too large.
+        """
+        magic, header_length = cls._PROTOCOL_PREFIX.unpack(
+            cls._recv_exactly(sock, cls._PROTOCOL_PREFIX.size, deadline)
+        )
+        if magic != cls._PROTOCOL_MAGIC:
+            raise cls.SandboxRuntimeException(f"Bad protocol magic: {magic!r}")
+        if header_length > cls._PROTOCOL_MAX_HEADER_BYTES:
+            raise cls.SandboxRuntimeException(
+                f"Protocol header too large: {header_length} bytes"
+            )
+        try:
+            header = json.loads(
+                cls._recv_exactly(sock, header_length, deadline).decode("utf-8")
+            )
+        except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
+            raise cls.SandboxRuntimeException(f"Invalid protocol header: {e}")
+        body_lengths = header.pop("bodies", [])
+        total_body_bytes = sum(length for _, length in body_lengths)
+        if max_body_bytes is not None and total_body_bytes > max_body_bytes:
+            raise cls.SandboxRuntimeException(
+                f"Protocol message too large: {total_body_bytes} > {max_body_bytes} bytes"
+            )
+        bodies = {}
+        for name, length in body_lengths:
+            bodies[name] = bytes(cls._recv_exactly(sock, length, deadline))
+        return header, bodies
+
+    @classmethod
+    def _protocol_exception_encode(cls, e):
+        """
+        Encode an exception as a protocol (header, bodies) tuple.
+        Code and output streams of `ExecutionError`s travel as bodies.
+        """
+        exception_info = cls._json_exception_encode(e)
+        bodies = {}
+        if "kwargs" in exception_info:
+            kwargs = dict(exception_info["kwargs"])
+            for name in ("code", "output", "stderr"):
+                value = kwargs.pop(name, None)
+                if type(value) is type(""):
+                    value = value.encode("utf-8", errors="replace")
+                if value is not None:
+                    bodies[name] = value
+            exception_info["kwargs"] = kwargs
+        return {"exception": exception_info}, bodies
+
+    @classmethod
+    def _protocol_exception_decode(cls, exception_info, bodies):
+        """Inverse of `_protocol_exception_encode`."""
+        if "kwargs" in exception_info:
+            for name, value in bodies.items():
+                exception_info["kwargs"][name] = value.decode("utf-8", errors="replace")
+        return cls._json_exception_decode(exception_info)
+
     class SandboxException(Exception):
         """
         Base class for all exceptions generated by `Sandbox`.
@@ -2154,6 +3442,40 @@ class Sandbox:
             "stderr_is_text": stderr_is_text,
         }
 
+    @classmethod
+    def _json_stage_output(cls, sandbox, **output):
+        """
+        Wrap the outcome of a re-execution stage along with the time spent in
+        each of its phases and the resources it used, if any.
+        """
+        if sandbox is not None and sandbox._timings:
+            output["timings"] = sandbox._timings
+        if sandbox is not None and sandbox._resource_usage:
+            output["resource_usage"] = sandbox._resource_usage
+        return output
+
+    @classmethod
+    def _json_snippet_outcomes_encode(cls, outcomes):
+        """Return JSON-encoded per-snippet outcomes of an independent-snippets run."""
+        encoded = []
+        for outcome in outcomes:
+            if isinstance(outcome, subprocess.CompletedProcess):
+                encoded.append({"result": cls._json_completed_process_encode(outcome)})
+            else:
+                encoded.append({"exception": cls._json_exception_encode(outcome)})
+        return encoded
+
+    @classmethod
+    def _json_snippet_outcomes_decode(cls, encoded):
+        """Decode JSON-encoded per-snippet outcomes of an independent-snippets run."""
+        outcomes = []
+        for outcome in encoded:
+            if "exception" in outcome:
+                outcomes.append(cls._json_exception_decode(outcome["exception"]))
+            else:
+                outcomes.append(cls._json_completed_process_decode(outcome["result"]))
+        return outcomes
+
     @classmethod
     def _concatenate_outputs(cls, streams, encoding="utf-8"):
         """
@@ -2305,27 +3627,124 @@ class Sandbox:
             )
 
     @classmethod
-    def get_runsc_path(cls):
+    def get_runsc_path(cls):
+        """
+        Returns the absolute path where the `runsc` binary is installed.
+
+        :return: Absolute path to `runsc` binary, or `None` if not installed.
+        """
+        runsc_path = shutil.which("runsc")
+        if runsc_path:
+            return runsc_path
+        if os.path.exists(cls.AUTO_INSTALLATION_PATH):
+            return cls.AUTO_INSTALLATION_PATH
+        return None
+
+    @classmethod
+    def runsc_needs_installation(cls):
+        """
+        Checks whether the `runsc` binary is installed.
+
+        :return: Whether the `runsc` binary is installed.
+        """
+        return cls._probe("runsc_path") is None
+
+    @classmethod
+    def cgroups_usable(cls) -> bool:
+        """
+        Checks whether cgroups can be used for resource limiting.
+
+        :return: Whether `check_cgroups` passes.
+        """
+        try:
+            cls._probe("cgroups")
+        except cls.EnvironmentNeedsSetupException:
+            return False
+        return True
+
+    @classmethod
+    def _probe_functions(cls):
+        return {
+            "platform": cls.check_platform,
+            "bash": lambda: shutil.which("bash"),
+            "unshare_binary": lambda: shutil.which("unshare"),
+            "unshare_syscall": cls.check_unshare,
+            "cgroups": cls.check_cgroups,
+            "runsc_path": cls.get_runsc_path,
+        }
+
+    @classmethod
+    def _probe(cls, name):
         """
-        Returns the absolute path where the `runsc` binary is installed.
-
-        :return: Absolute path to `runsc` binary, or `None` if not installed.
+        Return the outcome of the named environment probe, running it only if
+        it has not run yet in this process. Exceptions are cached and re-raised.
         """
-        runsc_path = shutil.which("runsc")
-        if runsc_path:
-            return runsc_path
-        if os.path.exists(cls.AUTO_INSTALLATION_PATH):
-            return cls.AUTO_INSTALLATION_PATH
-        return None
+        with cls._PROBES_LOCK:
+            probe = cls._PROBES.get(name)
+        if probe is None:
+            start = time.monotonic()
+            try:
+                value, error = cls._probe_functions()[name](), None
+            except Exception as e:
+                value, error = None, e
+            probe = {
+                "value": value,
+                "error": error,
+                "duration_seconds": time.monotonic() - start,
+                "probed_at": time.time(),
+            }
+            with cls._PROBES_LOCK:
+                cls._PROBES[name] = probe
+        if probe["error"] is not None:
+            raise probe["error"].with_traceback(None)
+        return probe["value"]
 
     @classmethod
-    def runsc_needs_installation(cls):
+    def _forget_probe(cls, name):
+        with cls._PROBES_LOCK:
+            cls._PROBES.pop(name, None)
+
+    @classmethod
+    def refresh_probes(cls):
         """
-        Checks whether the `runsc` binary is installed.
+        Discard cached environment probe outcomes and probe the environment again.
+        Useful after fixing the environment without restarting the process.
+        """
+        with cls._PROBES_LOCK:
+            cls._PROBES = {}
+        for name in cls._probe_functions():
+            try:
+                cls._probe(name)
+            except Exception:
+                pass  # Cached; reported by `diagnostics` or raised on use.
 
-        :return: Whether the `runsc` binary is installed.
+    @classmethod
+    def diagnostics(cls) -> dict:
+        """
+        Report on each environment probe: whether it passed, its value or
+        error, when it ran, and how long it took. Runs probes not run yet.
         """
-        return cls.get_runsc_path() is None
+        report = {}
+        for name in cls._probe_functions():
+            try:
+                cls._probe(name)
+            except Exception:
+                pass
+            with cls._PROBES_LOCK:
+                probe = cls._PROBES[name]
+            entry = {
+                "ok": probe["error"] is None,
+                "duration_ms": round(probe["duration_seconds"] * 1000, 3),
+                "probed_at": datetime.datetime.fromtimestamp(
+                    probe["probed_at"]
+                ).isoformat(),
+            }
+            if probe["error"] is not None:
+                entry["error"] = str(probe["error"])
+            elif probe["value"] is not None:
+                entry["value"] = probe["value"]
+            report[name] = entry
+        return report
 
     @classmethod
     def install_runsc(cls):
@@ -2337,6 +3756,8 @@ class Sandbox:
         """
         if not cls.runsc_needs_installation():
             return
+        import urllib.request
+
         uname = platform.uname()
         release_url_dir = f"https://storage.googleapis.com/gvisor/releases/release/latest/{uname.machine}"
         os.makedirs(
@@ -2368,6 +3789,7 @@ class Sandbox:
                 )
             os.chmod(download_path, mode=0o755)
             os.rename(download_path, cls.AUTO_INSTALLATION_PATH)
+        cls._forget_probe("runsc_path")
 
     @classmethod
     def check_setup(
@@ -2378,6 +3800,7 @@ class Sandbox:
     ):
         """
         Verifies that the environment is compatible with running sandboxes.
+        Environment probes run once per process and settings; see `refresh_probes`.
 
         :param language: The programming language to run.
         :param auto_install_allowed: Whether auto-installation of `runsc` is allowed.
@@ -2388,21 +3811,26 @@ class Sandbox:
         :raises PlatformNotSupportedException: If running on an unsupported platform.
         :raises FixableException: If another issue occurs but that can be fixed by the user.
         """
+        settings = (auto_install_allowed, require_resource_limiting)
+        with cls._PROBES_LOCK:
+            if settings not in cls._PROBES_SETTINGS_SEEN:
+                cls._PROBES = {}
+                cls._PROBES_SETTINGS_SEEN.add(settings)
         if language not in cls.SUPPORTED_LANGUAGES:
             raise ValueError(f"Unsupported language: {language}")
-        if shutil.which("bash") is None:
+        if cls._probe("bash") is None:
             raise cls.EnvironmentNeedsSetupException(
                 "bash is not installed (`bash` binary not found in $PATH); please install it"
             )
-        if shutil.which("unshare") is None:
+        if cls._probe("unshare_binary") is None:
             raise cls.EnvironmentNeedsSetupException(
                 "unshare is not installed (`unshare` binary not found in $PATH); please install it"
             )
-        cls.check_platform()
-        cls.check_unshare()
+        cls._probe("platform")
+        cls._probe("unshare_syscall")
         if require_resource_limiting:
-            cls.check_cgroups()
-        if not auto_install_allowed and cls.get_runsc_path() is None:
+            cls._probe("cgroups")
+        if not auto_install_allowed and cls._probe("runsc_path") is None:
             raise cls.GVisorNotInstalledException(
                 "gVisor is not installed (runsc binary not found in $PATH); please install it or enable AUTO_INSTALL valve for auto installation"
             )
@@ -2424,23 +3852,36 @@ class Sandbox:
         if cls._MARKER_ENVIRONMENT_VARIABLE not in os.environ:
             return
         result = None
+        sandbox = None
         output_stream = sys.stderr
         try:
             directives = json.load(sys.stdin)
-            sandbox = cls(**directives["settings"])
+            # Settings may carry values probed by the parent process, which are
+            # not constructor arguments.
+            sandbox = cls.__new__(cls)
+            sandbox._init(directives["settings"])
             if directives["stage"] == cls._STAGE_SANDBOX:
                 output_stream = sys.stdout
                 result = cls._json_completed_process_encode(sandbox._run())
+                if sandbox._independent_snippets:
+                    result["snippets"] = cls._json_snippet_outcomes_encode(
+                        sandbox._snippet_outcomes
+                    )
             elif directives["stage"] == cls._STAGE_SERVER:
                 cls._InSandboxServer().run()
                 result = {}
             else:
                 raise ValueError(f"Invalid stage in directives: {directives}")
         except Exception as e:
-            json.dump({"exception": cls._json_exception_encode(e)}, output_stream)
+            json.dump(
+                cls._json_stage_output(
+                    sandbox, exception=cls._json_exception_encode(e)
+                ),
+                output_stream,
+            )
         else:
             assert result is not None, "Logic error"
-            json.dump({"result": result}, output_stream)
+            json.dump(cls._json_stage_output(sandbox, result=result), output_stream)
         finally:
             output_stream.flush()
             sys.exit(0)
@@ -2455,6 +3896,10 @@ class Sandbox:
         max_ram_bytes: typing.Optional[int] = None,
         require_resource_limiting: bool = False,
         persistent_home_dir: typing.Optional[str] = None,
+        independent_snippets: bool = False,
+        max_output_bytes: typing.Optional[int] = None,
+        package_cache_dir: typing.Optional[str] = None,
+        workspace_dir: typing.Optional[str] = None,
     ):
         """
         Constructor.
@@ -2467,6 +3912,10 @@ class Sandbox:
         :param max_ram_bytes: How many bytes of RAM the interpreter should be allowed to use, or `None` for no limit.
         :param require_resource_limiting: If true, refuse to launch a sandbox if the host doesn't support resource limiting via cgroups.
         :param persistent_home_dir: Optional directory which will be mapped read-write to this real host directory.
+        :param independent_snippets: If true, each snippet gets the full `max_runtime_seconds` and a failing snippet does not prevent the following ones from running. Use `run_each` to get per-snippet outcomes.
+        :param max_output_bytes: Maximum number of bytes to keep from each of stdout and stderr of each snippet, or `None` for `DEFAULT_MAX_OUTPUT_BYTES`. The middle of longer output is left out.
+        :param package_cache_dir: Optional directory of Python packages, typically from `PackageCache.ensure`, which will be mapped read-only and importable.
+        :param workspace_dir: Optional directory whose contents are copied into the home directory before any code runs, e.g. files kept from a previous execution. Mapped read-only.
         """
         self._init(
             {
@@ -2478,6 +3927,10 @@ class Sandbox:
                 "max_ram_bytes": max_ram_bytes,
                 "require_resource_limiting": require_resource_limiting,
                 "persistent_home_dir": persistent_home_dir,
+                "independent_snippets": independent_snippets,
+                "max_output_bytes": max_output_bytes,
+                "package_cache_dir": package_cache_dir,
+                "workspace_dir": workspace_dir,
             }
         )
 
@@ -2498,8 +3951,17 @@ class Sandbox:
             "require_resource_limiting"
         ] or all((self._max_ram_bytes is None,))
         self._persistent_home_dir = self._settings["persistent_home_dir"]
+        self._independent_snippets = self._settings.get("independent_snippets", False)
+        self._snippet_outcomes = None
+        self._max_output_bytes = (
+            self._settings.get("max_output_bytes") or self.DEFAULT_MAX_OUTPUT_BYTES
+        )
+        self._package_cache_dir = self._settings.get("package_cache_dir")
+        self._workspace_dir = self._settings.get("workspace_dir")
         self._sandboxed_command = None
         self._switcheroo = None
+        self._timings = {}
+        self._resource_usage = {}
 
     def _setup_sandbox(self):
         """
@@ -2531,10 +3993,9 @@ class Sandbox:
         oci_config["root"]["path"] = rootfs_path
         do_resource_limiting = True
         if not self._require_resource_limiting:
-            try:
-                self.check_cgroups()
-            except self.EnvironmentNeedsSetupException:
-                do_resource_limiting = False
+            do_resource_limiting = self._settings.get("cgroups_usable")
+            if do_resource_limiting is None:
+                do_resource_limiting = self.cgroups_usable()
         self._switcheroo = self._Switcheroo(
             libc=self._libc(),
             log_path=os.path.join(self._logs_path, "switcheroo.txt"),
@@ -2542,7 +4003,9 @@ class Sandbox:
             do_resource_limiting=do_resource_limiting,
         )
         try:
+            switcheroo_started_at = time.monotonic()
             self._switcheroo.do()
+            self._add_timing("switcheroo", switcheroo_started_at)
         except Exception as e:
             try:
                 switcheroo_status = self._switcheroo._status()
@@ -2647,6 +4110,35 @@ class Sandbox:
                     "options": ["rw"],
                 }
             )
+        if self._package_cache_dir is not None:
+            if not os.path.isdir(self._package_cache_dir):
+                raise self.SandboxException(
+                    f"Package cache directory {self._package_cache_dir} does not exist"
+                )
+            oci_config["mounts"].append(
+                {
+                    "type": "bind",
+                    "source": self._package_cache_dir,
+                    "destination": self.PACKAGE_CACHE_MOUNT_PATH,
+                    "options": ["ro", "rbind"],
+                }
+            )
+            oci_config["process"]["env"].append(
+                f"PYTHONPATH={self.PACKAGE_CACHE_MOUNT_PATH}"
+            )
+        if self._workspace_dir is not None:
+            if not os.path.isdir(self._workspace_dir):
+                raise self.SandboxException(
+                    f"Workspace directory {self._workspace_dir} does not exist"
+                )
+            oci_config["mounts"].append(
+                {
+                    "type": "bind",
+                    "source": self._workspace_dir,
+                    "destination": self.WORKSPACE_MOUNT_PATH,
+                    "options": ["ro"],
+                }
+            )
 
         # Sort mounts to ensure proper overlay order.
         oci_config["mounts"].sort(key=lambda m: m["destination"])
@@ -2659,8 +4151,11 @@ class Sandbox:
 
         # Generate command line to run in the sandbox.
         oci_config["process"]["env"].append(f"{self._MARKER_ENVIRONMENT_VARIABLE}=1")
+        # `-E`: The server itself ignores `PYTHONPATH`, so that cached packages
+        # cannot shadow its own dependencies. The code it runs does not.
         self._sandboxed_command = [
             sys.executable,
+            "-E",
             "/sandbox/self.py",
         ]
 
@@ -2688,13 +4183,20 @@ class Sandbox:
         :raises Sandbox.ExecutionTimeoutError: If the code interpreter ran for longer than configured.
         :raises Sandbox.InterruptedExecutionError: If the code interpreter died without providing a return code; usually due to running over resource limits.
         :raises sandbox.CodeExecutionError: If the code interpreter failed to execute the given code. This does not represent a sandbox failure.
+
+        In independent-snippets mode, per-snippet errors are not raised; they
+        are recorded in `self._snippet_outcomes` instead.
         """
         runsc = None
+        ready_socket = None
         resource_monitor_cancel = None
         runsc_memfd_stdout = None
         runsc_memfd_stderr = None
         try:
+            setup_started_at = time.monotonic()
             self._setup_sandbox()
+            self._add_timing("setup", setup_started_at)
+            self._timings["setup"] -= self._timings.get("switcheroo", 0.0)
             network_mode = "host" if self._networking_allowed else "none"
             runsc_argv = [
                 self.get_runsc_path(),
@@ -2718,6 +4220,10 @@ class Sandbox:
                 }
             )
             started_marker_path = os.path.join(self._sandbox_shared_path, "started")
+            # Bound before spawning runsc, so that the server can always connect to it.
+            ready_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            ready_socket.bind(os.path.join(self._sandbox_shared_path, "ready"))
+            ready_socket.listen(1)
             resource_monitor_cancel = self._switcheroo.monitor_cgroup_resources()
             memfd_uuid = str(uuid.uuid4())
             runsc_memfd_stdout = os.fdopen(
@@ -2726,6 +4232,7 @@ class Sandbox:
             runsc_memfd_stderr = os.fdopen(
                 os.memfd_create(f"runsc-stderr.{memfd_uuid}"), "wb+"
             )
+            spawn_started_at = time.monotonic()
             try:
                 runsc = subprocess.Popen(
                     runsc_argv,
@@ -2742,34 +4249,73 @@ class Sandbox:
                 raise self.SandboxRuntimeException(f"Spawn runsc: OSError: {e}")
             except Exception as e:
                 raise self.SandboxRuntimeException(f"Spawn runsc: {e}")
+            self._add_timing("runsc_spawn", spawn_started_at)
             sandbox_client = self._SandboxClient(
-                sandbox_shared_path=self._sandbox_shared_path, runsc_popen=runsc
+                sandbox_shared_path=self._sandbox_shared_path,
+                runsc_popen=runsc,
+                ready_socket=ready_socket,
+                timings=self._timings,
             )
             overall_deadline = time.time() + self._max_runtime_seconds
             overall_cmd = []
             overall_code = []
             overall_stdout = []
             overall_stderr = []
+            server_died = False
+            self._snippet_outcomes = []
             for language, code in self._snippets:
                 overall_cmd.append(f"{language} /dev/stdin")
                 if len(self._snippets) == 1:
                     overall_code = [code]
                 else:
                     overall_code.append(f"({language}, {code})")
-                seconds_remaining = overall_deadline - time.time()
-                result = sandbox_client.code_eval(
-                    language=language,
-                    code=code,
-                    max_runtime_seconds=seconds_remaining,
-                )
+                if not self._independent_snippets:
+                    seconds_remaining = overall_deadline - time.time()
+                    result = sandbox_client.code_eval(
+                        language=language,
+                        code=code,
+                        max_runtime_seconds=seconds_remaining,
+                        max_output_bytes=self._max_output_bytes,
+                    )
+                elif server_died:
+                    # The sandbox is gone; the remaining snippets never ran.
+                    self._snippet_outcomes.append(
+                        self.InterruptedExecutionError(
+                            code=code,
+                            returncode=127,
+                            cmd=[language],
+                            output=None,
+                            stderr=None,
+                        )
+                    )
+                    continue
+                else:
+                    try:
+                        result = sandbox_client.code_eval(
+                            language=language,
+                            code=code,
+                            max_runtime_seconds=self._max_runtime_seconds,
+                            max_output_bytes=self._max_output_bytes,
+                        )
+                    except self.InterruptedExecutionError as e:
+                        server_died = True
+                        self._snippet_outcomes.append(e)
+                        continue
+                    except self.ExecutionError as e:
+                        self._snippet_outcomes.append(e)
+                        continue
+                    self._snippet_outcomes.append(result)
                 if result.stdout is not None:
                     overall_stdout.append(result.stdout)
                 if result.stderr is not None:
                     overall_stderr.append(result.stderr)
             overall_stdout = self._concatenate_outputs(overall_stdout)
             overall_stderr = self._concatenate_outputs(overall_stderr)
-            sandbox_client.copy_out()
-            sandbox_client.terminate()
+            if not server_died:
+                sandbox_client.copy_out()
+            shutdown_started_at = time.monotonic()
+            if not server_died:
+                sandbox_client.terminate()
             runsc_stdout = None
             runsc_stderr = None
             try:
@@ -2780,10 +4326,14 @@ class Sandbox:
                     runsc.wait(timeout=self._TIMEOUT_SLACK_WAIT_FOR_SANDBOX_SHUTDOWN)
                 except Exception:
                     pass
+            self._add_timing("shutdown", shutdown_started_at)
             if runsc.poll() is None:
                 raise self.SandboxRuntimeException("Sandbox did not terminate")
             if runsc.returncode != 0:
-                if os.path.isfile(started_marker_path):
+                if os.path.isfile(started_marker_path) and self._independent_snippets:
+                    # Already recorded against the snippet that was running.
+                    pass
+                elif os.path.isfile(started_marker_path):
                     raise self.InterruptedExecutionError(
                         code="; ".join(overall_code),
                         returncode=127,
@@ -2840,6 +4390,8 @@ class Sandbox:
                 stderr=overall_stderr,
             )
         finally:
+            if ready_socket is not None:
+                ready_socket.close()
             if runsc_memfd_stdout is not None:
                 runsc_memfd_stdout.close()
             if runsc_memfd_stderr is not None:
@@ -2856,6 +4408,7 @@ class Sandbox:
                 except Exception:
                     pass
             if self._switcheroo is not None:
+                self._resource_usage = self._switcheroo.resource_usage()
                 self._switcheroo.cleanup()
 
     def run(self) -> subprocess.CompletedProcess:
@@ -2872,6 +4425,9 @@ class Sandbox:
         reexec_path = os.path.join(self._tmp_dir, "self.py")
         with open(reexec_path, "w") as reexec_f:
             reexec_f.write(self._SelfFile.contents())
+        if not self._require_resource_limiting:
+            # Probed once in this process rather than once per execution.
+            self._settings["cgroups_usable"] = self.cgroups_usable()
         new_env = os.environ.copy()
         new_env[self._MARKER_ENVIRONMENT_VARIABLE] = "1"
         directives = json.dumps(
@@ -2880,6 +4436,9 @@ class Sandbox:
                 "settings": self._settings,
             }
         )
+        self._timings = {}
+        self._resource_usage = {}
+        started_at = time.monotonic()
         try:
             result = subprocess.run(
                 (sys.executable, reexec_path),
@@ -2892,7 +4451,72 @@ class Sandbox:
         except subprocess.CalledProcessError as e:
             raise self.SandboxRuntimeException(f"{e} (stderr: {e.stderr})")
         else:
-            return self._process_json_wrapped_result(result)
+            self._add_timing("total", started_at)
+            try:
+                stage_output = json.loads(result.stdout)
+                self._timings.update(stage_output.get("timings", {}))
+                self._resource_usage = stage_output.get("resource_usage", {})
+            except (json.decoder.JSONDecodeError, AttributeError):
+                pass  # Reported by `_process_json_wrapped_result` below.
+            completed_process = self._process_json_wrapped_result(result)
+            if self._independent_snippets:
+                self._snippet_outcomes = self._json_snippet_outcomes_decode(
+                    json.loads(result.stdout)["result"]["snippets"]
+                )
+            return completed_process
+
+    def _add_timing(self, phase, started_at):
+        """
+        Add the time elapsed since `started_at`, a `time.monotonic` value, to the given phase.
+        """
+        self._timings[phase] = (
+            self._timings.get(phase, 0.0) + time.monotonic() - started_at
+        )
+
+    def timings(self) -> dict:
+        """
+        Wall-clock time spent in each phase of the last `run`, in seconds.
+        Phases that were not reached are missing.
+
+        :return: A dictionary with some of the following keys:
+                 "setup": Preparing the bundle and OCI config, excluding the switcheroo.
+                 "switcheroo": Moving into fresh namespaces and cgroups.
+                 "runsc_spawn": Starting the `runsc` process.
+                 "first_connect": Waiting for the in-sandbox server to accept requests.
+                 "eval": Running the code snippets, summed across snippets.
+                 "copy_out": Copying the home directory out to persistent storage.
+                 "shutdown": Stopping the server and waiting for `runsc` to exit.
+                 "total": The whole re-execution, as seen from the calling process.
+        """
+        return dict(self._timings)
+
+    def resource_usage(self) -> dict:
+        """
+        Resources used by the code during the last `run`, when resource
+        limiting through cgroups was in effect.
+
+        :return: A dictionary with some of the following keys:
+                 "memory_peak_bytes": Peak memory usage of the sandbox cgroup, from `memory.peak`.
+                 "cpu_seconds": CPU time used by the sandbox cgroup, from `cpu.stat`.
+        """
+        return dict(self._resource_usage)
+
+    def run_each(self) -> list:
+        """
+        Run all snippets in a single sandbox, one after the other, and report on each one.
+        Requires `independent_snippets` to have been set in the constructor.
+
+        :return: A list with one entry per snippet, in order: a `CompletedProcess` if the
+                 snippet ran to completion, or the `Sandbox.ExecutionError` it failed with.
+        :raises FixableException: If an issue occurs but that can be fixed by the user.
+        :raises Sandbox.SandboxRuntimeException: If the sandbox failed to start or behaved incorrectly regardless of the code being evaluated.
+        """
+        if not self._independent_snippets:
+            raise self.SandboxRuntimeException(
+                "run_each requires a sandbox created with independent_snippets=True"
+            )
+        self.run()
+        return list(self._snippet_outcomes)
 
     def debug_logs(self, write_fn: typing.Callable[[str, str], typing.Any]):
         """
@@ -2974,12 +4598,28 @@ class UpdateCheck:
     RELEASES_URL = "https://github.com/EtiennePerot/safe-code-execution/releases.atom"
     USER_URL = "https://github.com/EtiennePerot/safe-code-execution/"
     ENABLED = True
-    SELF_VERSION = None
+    # Must match the "version" line of the frontmatter at the top of this file;
+    # `--import_time` verifies that. A constant, so that loading this file does
+    # not need to read and parse it again.
+    SELF_VERSION = (0, 8, 0)
     LAST_UPDATE_CHECK = None
     LAST_UPDATE_CACHE = None
     UPDATE_CHECK_INTERVAL = datetime.timedelta(days=3)
     VERSION_REGEX = re.compile(r"<title>\s*(v?\d+(?:\.\d+)+)\s*</title>")
 
+    # Update checks run in a background thread, with this timeout on network
+    # operations. Their result is cached in a file shared by all processes,
+    # under the Open WebUI data directory rather than a world-writable one.
+    CHECK_TIMEOUT_SECONDS = 5
+    CACHE_PATH = "$DATA_DIR/cache/functions/run_code/update_check.json"
+
+    # If this environment variable is set to "true", never access the network
+    # to check for updates, like the UPDATE_CHECK_OFFLINE valve.
+    OFFLINE_ENVIRONMENT_VARIABLE = "CODE_EVAL_UPDATE_CHECK_OFFLINE"
+
+    _CHECK_THREAD = None
+    _CHECK_THREAD_LOCK = threading.Lock()
+
     class VersionCheckError(Exception):
         pass
 
@@ -3008,9 +4648,10 @@ class UpdateCheck:
         cls.ENABLED = False
 
     @classmethod
-    def init_from_frontmatter(cls, file_with_frontmatter):
-        if not cls.ENABLED:
-            return
+    def frontmatter_version(cls, file_with_frontmatter):
+        """
+        Parse the version out of the frontmatter of the given file.
+        """
         with open(file_with_frontmatter, "rb") as f:
             contents = f.read().decode("ascii").strip()
         if not contents.startswith('"""'):
@@ -3031,15 +4672,47 @@ class UpdateCheck:
                 version = line[len("version:") :].strip()
         if version is None:
             raise cls.VersionCheckError("Version metadata not found")
-        cls.SELF_VERSION = cls._parse_version(version)
+        return cls._parse_version(version)
 
     @classmethod
     def _get_current_version(cls):
-        assert (
-            cls.SELF_VERSION is not None
-        ), "UpdateCheck.init_from_frontmatter must be called first."
         return cls.SELF_VERSION
 
+    @classmethod
+    def is_offline(cls, offline=False):
+        return (
+            offline
+            or os.environ.get(cls.OFFLINE_ENVIRONMENT_VARIABLE, "").lower() == "true"
+        )
+
+    @classmethod
+    def _cache_path(cls):
+        """The path of the on-disk cache, with a leading '$DATA_DIR' expanded."""
+        if cls.CACHE_PATH.startswith("$DATA_DIR" + os.sep):
+            return os.path.join(
+                os.environ.get("DATA_DIR", "/app/backend/data"),
+                cls.CACHE_PATH[len("$DATA_DIR" + os.sep) :].lstrip(os.sep),
+            )
+        return cls.CACHE_PATH
+
+    @classmethod
+    def _open_private(cls, path, flags):
+        """
+        Open a file of the on-disk cache without following symlinks.
+        Files owned by another user or writable by others are not trusted.
+
+        :return: A file descriptor, or `None` if the file cannot be used.
+        """
+        try:
+            fd = os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        except OSError:
+            return None
+        file_stat = os.fstat(fd)
+        if file_stat.st_uid != os.geteuid() or file_stat.st_mode & 0o022:
+            os.close(fd)
+            return None
+        return fd
+
     @classmethod
     def need_check(cls):
         if cls.LAST_UPDATE_CHECK is None:
@@ -3049,38 +4722,146 @@ class UpdateCheck:
         )
 
     @classmethod
-    def _get_latest_version(cls):
-        if not cls.need_check():
-            if type(cls.LAST_UPDATE_CACHE) is type(()):
-                return cls.LAST_UPDATE_CACHE
-            raise cls.LAST_UPDATE_CACHE
+    def _load_cache(cls):
+        """Load the result of a check done by any process from the on-disk cache, if newer."""
+        fd = cls._open_private(cls._cache_path(), os.O_RDONLY)
+        if fd is None:
+            return  # No cache, or untrusted cache.
+        try:
+            with os.fdopen(fd, "r") as f:
+                cache = json.load(f)
+            last_check = datetime.datetime.fromtimestamp(cache["checked_at"])
+            if cache.get("error") is not None:
+                result = cls.VersionCheckError(cache["error"])
+            else:
+                result = cls._parse_version(cache["latest_version"])
+        except Exception:
+            return  # No cache, or unreadable cache.
+        if cls.LAST_UPDATE_CHECK is None or last_check > cls.LAST_UPDATE_CHECK:
+            cls.LAST_UPDATE_CHECK = last_check
+            cls.LAST_UPDATE_CACHE = result
+
+    @classmethod
+    def _store_cache(cls):
+        """Atomically write the current check result to the on-disk cache."""
+        cache = {"checked_at": cls.LAST_UPDATE_CHECK.timestamp()}
+        if type(cls.LAST_UPDATE_CACHE) is type(()):
+            cache["latest_version"] = cls._format_version(cls.LAST_UPDATE_CACHE)
+        else:
+            cache["error"] = str(cls.LAST_UPDATE_CACHE)
+        cache_path = cls._cache_path()
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=".update_check_", dir=os.path.dirname(cache_path)
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # Not fatal; the result is still cached in memory.
+
+    @classmethod
+    def _fetch_latest_version(cls):
+        """Fetch the latest release version over the network."""
+        import urllib.error
+        import urllib.request
+
+        try:
+            with urllib.request.urlopen(
+                url=cls.RELEASES_URL, timeout=cls.CHECK_TIMEOUT_SECONDS
+            ) as response:
+                releases_xml = response.read()
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise cls.VersionCheckError(
+                f"Failed to retrieve latest version: {e} (URL: {cls.RELEASES_URL})"
+            )
+        latest_version = None
+        for match in cls.VERSION_REGEX.finditer(releases_xml.decode("utf-8")):
+            version = cls._parse_version(match.group(1))
+            if latest_version is None or cls._compare(version, latest_version) == 1:
+                latest_version = version
+        if latest_version is None:
+            raise cls.VersionCheckError(
+                f"Failed to retrieve latest version: no release found (URL: {cls.RELEASES_URL})"
+            )
+        return latest_version
+
+    @classmethod
+    def _background_check(cls):
+        """Check for the latest version, unless another process is already doing so."""
+        cache_path = cls._cache_path()
+        try:
+            os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+        except OSError:
+            pass  # The result is then only cached in memory.
+        lock_fd = cls._open_private(cache_path + ".lock", os.O_RDWR | os.O_CREAT)
         try:
+            if lock_fd is not None:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # Another process is checking; it will update the cache.
+            cls._load_cache()
+            if not cls.need_check():
+                return
             try:
-                releases_xml = urllib.request.urlopen(url=cls.RELEASES_URL).read()
-            except urllib.error.HTTPError as e:
-                cls.LAST_UPDATE_CACHE = cls.VersionCheckError(
-                    f"Failed to retrieve latest version: {e} (URL: {cls.RELEASES_URL})"
-                )
-                raise cls.LAST_UPDATE_CACHE
-            latest_version = None
-            for match in cls.VERSION_REGEX.finditer(releases_xml.decode("utf-8")):
-                version = cls._parse_version(match.group(1))
-                if latest_version is None or cls._compare(version, latest_version) == 1:
-                    latest_version = version
-            if latest_version is None:
-                cls.LAST_UPDATE_CACHE = cls.VersionCheckError(
-                    f"Failed to retrieve latest version: no release found (URL: {cls.RELEASES_URL})"
-                )
-                raise cls.LAST_UPDATE_CACHE
-            cls.LAST_UPDATE_CACHE = latest_version
-            return latest_version
-        finally:
+                cls.LAST_UPDATE_CACHE = cls._fetch_latest_version()
+            except cls.VersionCheckError as e:
+                cls.LAST_UPDATE_CACHE = e
             cls.LAST_UPDATE_CHECK = datetime.datetime.now()
+            cls._store_cache()
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+
+    @classmethod
+    def start_check(cls, offline=False):
+        """
+        Start checking for the latest version in a background thread, if the
+        cached result is stale and no check is already running. Never blocks.
+        Does nothing if `offline` or the offline environment variable is set.
+        """
+        if not cls.ENABLED or cls.is_offline(offline):
+            return
+        with cls._CHECK_THREAD_LOCK:
+            if cls._CHECK_THREAD is not None and cls._CHECK_THREAD.is_alive():
+                return
+            cls._CHECK_THREAD = threading.Thread(
+                target=cls._background_check, name="UpdateCheck", daemon=True
+            )
+            cls._CHECK_THREAD.start()
+
+    @classmethod
+    def wait_for_check(cls, timeout=None):
+        """Wait for a running background check to finish. Useful for tests."""
+        with cls._CHECK_THREAD_LOCK:
+            check_thread = cls._CHECK_THREAD
+        if check_thread is not None:
+            check_thread.join(timeout=timeout)
+
+    @classmethod
+    def _get_latest_version(cls, offline=False):
+        """
+        Return the latest known version, or `None` if not known yet.
+        Starts a background check if the known result is stale.
+        """
+        if cls.need_check():
+            cls._load_cache()
+        if cls.need_check():
+            cls.start_check(offline)
+        if cls.LAST_UPDATE_CACHE is None:
+            return None
+        if type(cls.LAST_UPDATE_CACHE) is type(()):
+            return cls.LAST_UPDATE_CACHE
+        raise cls.LAST_UPDATE_CACHE
 
     @classmethod
-    def get_newer_version(cls) -> typing.Optional[str]:
+    def get_newer_version(cls, offline=False) -> typing.Optional[str]:
         """
-        Check for the latest version and return it if newer than current.
+        Return the latest version if it is known and newer than current.
+        Never blocks on the network; see `start_check`.
+
+        :param offline: If true, only use the result of a check already done by another process.
 
         :raises VersionCheckError: If there was an error checking for version.
         :return: The latest version number if newer than current, else None.
@@ -3092,18 +4873,87 @@ class UpdateCheck:
         except cls.VersionCheckError as e:
             raise e.__class__(f"Checking current version: {e}")
         try:
-            latest_version = cls._get_latest_version()
+            latest_version = cls._get_latest_version(offline)
         except cls.VersionCheckError as e:
             raise e.__class__(f"Checking latest version: {e}")
+        if latest_version is None:
+            return None
         if cls._compare(current_version, latest_version) == -1:
             return cls._format_version(latest_version)
         return None
 
 
-UpdateCheck.init_from_frontmatter(os.path.abspath(__file__))
+class SharedEngine:
+    """
+    Makes the classes above process-wide, so that the run_code tool and the
+    run_code action share environment probes, admission control, the package
+    cache, telemetry and update check state when both are installed.
+
+    The first file to load registers its classes as a module in `sys.modules`,
+    named after the version and a hash of the source code of these classes.
+    Files loaded afterwards with the exact same source use those classes
+    instead of their own; any difference gets a separate engine.
+    """
+
+    MODULE_NAME_PREFIX = "_run_code_engine_"
+    CLASS_NAMES = (
+        "EventEmitter",
+        "CodeExecutionTracker",
+        "ExecutionTelemetry",
+        "AdmissionController",
+        "PackageCache",
+        "Sandbox",
+        "UpdateCheck",
+    )
+
+    # The shared source code spans from the first line to the second one.
+    _SOURCE_START = "\n# fmt: off\n"
+    _SOURCE_END = "\nclass SharedEngine:\n"
+
+    @classmethod
+    def module_name(cls, source: str) -> str:
+        """
+        Return the name under which the engine defined in `source` is shared.
+        """
+        start = source.index(cls._SOURCE_START)
+        end = source.index(cls._SOURCE_END, start)
+        source_hash = hashlib.sha256(source[start:end].encode("utf-8")).hexdigest()
+        version = "_".join(str(c) for c in UpdateCheck.SELF_VERSION)
+        return f"{cls.MODULE_NAME_PREFIX}v{version}_{source_hash[:16]}"
+
+    @classmethod
+    def adopt(cls, module_globals: dict) -> types.ModuleType:
+        """
+        Replace the engine classes in `module_globals` by the process-wide
+        ones, registering them first if no other file did yet.
+        Registered engines stay loaded for the lifetime of the process.
+
+        :return: The engine module.
+        """
+        name = cls.module_name(Sandbox._SelfFile.contents())
+        engine = sys.modules.get(name)
+        if engine is None:
+            engine = types.ModuleType(name, "Sandbox engine shared by run_code.")
+            for class_name in cls.CLASS_NAMES:
+                setattr(engine, class_name, module_globals[class_name])
+            # Another file may have been loading concurrently.
+            engine = sys.modules.setdefault(name, engine)
+        for class_name in cls.CLASS_NAMES:
+            module_globals[class_name] = getattr(engine, class_name)
+        return engine
+
+
+SharedEngine.adopt(globals())
+
 # fmt: on
 
 
+# Everything below is only used when running this file as a script: sample
+# code, self-tests, the benchmark and the import time check. It is kept as
+# source text, so that Open WebUI does not compile it every time it loads this
+# file. Running this file as a script compiles it, keeping its line numbers.
+_SCRIPT_SOURCE_LINE = inspect.currentframe().f_lineno + 1
+_SCRIPT_SOURCE = r'''
 _SAMPLE_BASH_INSTRUCTIONS = (
     "echo 'Hello from the sandbox!'",
     "date",
@@ -3277,8 +5127,236 @@ def _do_self_tests(debug, filter=""):
     assert False, "Unreachable"
 
 
+_FAKE_RUNSC_SCRIPT = """#!%(python)s
+# Stand-in for `runsc` that runs the would-be sandboxed process as a plain
+# subprocess, with no isolation whatsoever. For benchmarking only.
+import json, os, subprocess, sys, tempfile
+
+bundle_path = [a for a in sys.argv if a.startswith("--bundle=")][0][len("--bundle=") :]
+with open(os.path.join(bundle_path, "config.json")) as config_f:
+    config = json.load(config_f)
+mounts = {m["destination"]: m["source"] for m in config["mounts"] if m["type"] == "bind"}
+args = config["process"]["args"]
+args = args[args.index(%(python)r) :]  # Drop the `unshare` wrapper.
+args[-1] = os.path.join(mounts["/sandbox"], "self.py")
+env = dict(os.environ)
+env.update(e.split("=", 1) for e in config["process"]["env"])
+if env.get("PYTHONPATH") in mounts:
+    env["PYTHONPATH"] = mounts[env["PYTHONPATH"]]
+with tempfile.TemporaryDirectory(prefix="fake_runsc_home_") as home_path:
+    env["HOME"] = env["PWD"] = home_path
+    env[%(paths_variable)r] = json.dumps(
+        {
+            "sandbox": mounts["/sandbox"],
+            "persistent": mounts.get("/sandbox/persistent"),
+            "workspace": mounts.get("/sandbox/workspace"),
+            "home": home_path,
+        }
+    )
+    sys.exit(subprocess.run(args, env=env, cwd=home_path).returncode)
+"""
+
+_BENCHMARK_PHASES = (
+    "setup",
+    "switcheroo",
+    "runsc_spawn",
+    "first_connect",
+    "eval",
+    "copy_out",
+    "shutdown",
+    "total",
+)
+
+
+def _print_benchmark_results(phase_samples, failures, iterations, wall_seconds):
+    """Print latency percentiles for each phase, in milliseconds."""
+
+    def _percentile(sorted_samples, percent):
+        # Nearest-rank method.
+        rank = -(-percent * len(sorted_samples) // 100)
+        return sorted_samples[max(0, rank - 1)]
+
+    print(
+        f"{'phase':<16}{'n':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'mean ms':>10}"
+    )
+    for phase, samples in phase_samples.items():
+        if not samples:
+            continue
+        samples = sorted(samples)
+        columns = [_percentile(samples, p) for p in (50, 90, 99)]
+        columns += [samples[-1], sum(samples) / len(samples)]
+        print(
+            f"{phase:<16}{len(samples):>6}"
+            + "".join(f"{c * 1000:>10.1f}" for c in columns)
+        )
+    print(
+        f"{iterations} iterations, {failures} failed, {wall_seconds:.2f}s wall clock, {iterations / wall_seconds:.2f} executions/s"
+    )
+
+
+def _run_benchmark_sandboxes(sandboxes, concurrency, slots_path):
+    """
+    Run sandboxes through an `AdmissionController` allowing `concurrency` of
+    them at once, the way parallel code blocks are run.
+
+    :return: A list with one entry per sandbox, in order: the `CompletedProcess`
+             returned by its `run` method, or the exception it raised.
+    """
+    admission = AdmissionController(concurrency, slots_path=slots_path)
+
+    async def _run_one(sandbox):
+        async with admission.admit(user_id="benchmark", emitter=EventEmitter()):
+            return await asyncio.to_thread(sandbox.run)
+
+    async def _run_all():
+        return await asyncio.gather(
+            *(_run_one(sandbox) for sandbox in sandboxes), return_exceptions=True
+        )
+
+    return asyncio.run(_run_all())
+
+
+def _do_benchmark(language, code, iterations, concurrency, fake_runsc, debug):
+    """
+    Run the given code `iterations` times, with up to `concurrency` sandboxes
+    running at once, then print how long each phase of sandbox execution took.
+    """
+    valves = _Tools(_Tools.Valves()).valves
+    max_ram_bytes = None
+    if valves.MAX_RAM_MEGABYTES != 0:
+        max_ram_bytes = valves.MAX_RAM_MEGABYTES * 1024 * 1024
+    phase_samples = {phase: [] for phase in _BENCHMARK_PHASES}
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix="sandbox_benchmark_") as benchmark_dir:
+        if fake_runsc:
+            fake_runsc_path = os.path.join(benchmark_dir, "runsc")
+            with open(fake_runsc_path, "w") as fake_runsc_f:
+                fake_runsc_f.write(
+                    _FAKE_RUNSC_SCRIPT
+                    % {
+                        "python": sys.executable,
+                        "paths_variable": Sandbox._SERVER_PATHS_ENVIRONMENT_VARIABLE,
+                    }
+                )
+            os.chmod(fake_runsc_path, 0o755)
+            os.environ["PATH"] = benchmark_dir + os.pathsep + os.environ["PATH"]
+        elif Sandbox.get_runsc_path() is None:
+            print(
+                "\u2620 runsc is not installed; use --benchmark_fake_runsc to benchmark without gVisor.",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        sandboxes = []
+        for i in range(iterations):
+            tmp_dir = os.path.join(benchmark_dir, f"sandbox_{i}")
+            os.makedirs(tmp_dir)
+            sandboxes.append(
+                Sandbox(
+                    tmp_dir=tmp_dir,
+                    snippets=((language, code),),
+                    debug=debug,
+                    networking_allowed=valves.NETWORKING_ALLOWED,
+                    max_runtime_seconds=valves.MAX_RUNTIME_SECONDS,
+                    max_ram_bytes=max_ram_bytes,
+                    require_resource_limiting=valves.REQUIRE_RESOURCE_LIMITING,
+                    persistent_home_dir=None,
+                    max_output_bytes=valves.MAX_OUTPUT_KILOBYTES * 1024,
+                )
+            )
+        started_at = time.monotonic()
+        outcomes = _run_benchmark_sandboxes(
+            sandboxes, concurrency, os.path.join(benchmark_dir, "admission")
+        )
+        wall_seconds = time.monotonic() - started_at
+        for sandbox, outcome in zip(sandboxes, outcomes):
+            if isinstance(outcome, Exception):
+                if failures == 0:
+                    print(
+                        f"\u274c First failure: {outcome.__class__.__name__}: {outcome}",
+                        file=sys.stderr,
+                    )
+                failures += 1
+                continue
+            for phase, seconds in sandbox.timings().items():
+                phase_samples.setdefault(phase, []).append(seconds)
+    _print_benchmark_results(phase_samples, failures, iterations, wall_seconds)
+    sys.exit(1 if failures else 0)
+
+
+# Loads this file the way Open WebUI does (`exec` of its source in a fresh
+# module), in a process that already has what Open WebUI itself imports.
+_IMPORT_TIME_SCRIPT = """
+import json, sys, time, types
+import asyncio, pydantic
+
+class _Warmup(pydantic.BaseModel):
+    field: int = 0
+
+path = sys.argv[1]
+with open(path) as f:
+    source = f.read()
+modules_before = set(sys.modules)
+module = types.ModuleType("run_code")
+module.__file__ = path
+started_at = time.perf_counter()
+code = compile(source, path, "exec")
+compiled_at = time.perf_counter()
+exec(code, module.__dict__)
+done_at = time.perf_counter()
+print(json.dumps({
+    "compile_seconds": compiled_at - started_at,
+    "exec_seconds": done_at - compiled_at,
+    "new_modules": sorted(set(sys.modules) - modules_before),
+}))
+"""
+
+
+def _do_import_time_check(budget_ms, runs=5):
+    """
+    Measure how long loading this file from its source takes, and fail if
+    executing it takes longer than `budget_ms` milliseconds. Compilation is
+    reported but not counted against the budget, as it only depends on the
+    size of the code outside of `_SCRIPT_SOURCE`.
+    Also verifies that `UpdateCheck.SELF_VERSION` matches the frontmatter.
+    """
+    self_path = os.path.abspath(__file__)
+    frontmatter_version = UpdateCheck.frontmatter_version(self_path)
+    if frontmatter_version != UpdateCheck.SELF_VERSION:
+        print(
+            f"\u274c UpdateCheck.SELF_VERSION is {UpdateCheck._format_version(UpdateCheck.SELF_VERSION)} but the frontmatter says {UpdateCheck._format_version(frontmatter_version)}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    measurements = []
+    for _ in range(runs):
+        result = subprocess.run(
+            (sys.executable, "-c", _IMPORT_TIME_SCRIPT, self_path),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        measurements.append(json.loads(result.stdout))
+    # The fastest run is the one least disturbed by the rest of the system.
+    fastest = min(measurements, key=lambda m: m["exec_seconds"])
+    exec_ms = fastest["exec_seconds"] * 1000
+    compile_ms = min(m["compile_seconds"] for m in measurements) * 1000
+    print(f"Compile: {compile_ms:.1f}ms", file=sys.stderr)
+    print(f"Execute: {exec_ms:.1f}ms (budget: {budget_ms}ms)", file=sys.stderr)
+    print(
+        f"Newly imported modules: {', '.join(fastest['new_modules']) or 'none'}",
+        file=sys.stderr,
+    )
+    if exec_ms > budget_ms:
+        print("\u274c Loading this file is over budget.", file=sys.stderr)
+        sys.exit(1)
+    print("\u2705 Loading this file is within budget.", file=sys.stderr)
+    sys.exit(0)
+
+
 # Debug utility: Run code from stdin if running as a normal Python script.
 if __name__ == "__main__":
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Run arbitrary code in a gVisor sandbox."
     )
@@ -3309,6 +5387,48 @@ if __name__ == "__main__":
     parser.add_argument(
         "--debug", action="store_true", default=False, help="Enable debug mode."
     )
+    parser.add_argument(
+        "--diagnostics",
+        action="store_true",
+        default=False,
+        help="Print the outcome and duration of each sandbox environment probe.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="Run the code many times and print how long each phase of sandbox execution took.",
+    )
+    parser.add_argument(
+        "--benchmark_iterations",
+        type=int,
+        default=20,
+        help="Number of code executions to time in benchmark mode.",
+    )
+    parser.add_argument(
+        "--benchmark_concurrency",
+        type=int,
+        default=1,
+        help="Maximum number of sandboxes running at once in benchmark mode.",
+    )
+    parser.add_argument(
+        "--benchmark_fake_runsc",
+        action="store_true",
+        default=False,
+        help="In benchmark mode, use a stand-in for runsc that runs code without any sandboxing. For hosts without gVisor.",
+    )
+    parser.add_argument(
+        "--import_time",
+        action="store_true",
+        default=False,
+        help="Measure how long loading this file takes, and fail if over budget.",
+    )
+    parser.add_argument(
+        "--import_time_budget_ms",
+        type=int,
+        default=25,
+        help="Maximum time that executing this file may take, in milliseconds.",
+    )
     parser.add_argument(
         "--want_status",
         type=str,
@@ -3322,6 +5442,13 @@ if __name__ == "__main__":
             _Tools.Valves()._VALVE_OVERRIDE_ENVIRONMENT_VARIABLE_NAME_PREFIX + "DEBUG"
         ] = "true"
 
+    if args.diagnostics:
+        print(json.dumps(Sandbox.diagnostics(), indent=2))
+        sys.exit(0)
+
+    if args.import_time:
+        _do_import_time_check(budget_ms=args.import_time_budget_ms)
+
     if args.self_test:
         _do_self_tests(debug=args.debug, filter=args.self_test_filter)
 
@@ -3333,6 +5460,16 @@ if __name__ == "__main__":
     else:
         code = sys.stdin.read()
 
+    if args.benchmark:
+        _do_benchmark(
+            language=args.language,
+            code=code,
+            iterations=args.benchmark_iterations,
+            concurrency=args.benchmark_concurrency,
+            fake_runsc=args.benchmark_fake_runsc,
+            debug=args.debug,
+        )
+
     async def _local_run():
         def _dummy_emitter(event):
             if not args.want_status:
@@ -3362,3 +5499,7 @@ if __name__ == "__main__":
             print(output_str)
 
     asyncio.run(_local_run())
+'''
+
+if __name__ == "__main__":
+    exec(compile("\n" * (_SCRIPT_SOURCE_LINE - 1) + _SCRIPT_SOURCE, __file__, "exec"))